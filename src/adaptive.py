@@ -0,0 +1,143 @@
+import logging
+import time
+import numba
+import numpy as np
+from camera import Camera
+from bidirectional import bidirectional_buffers, bidirectional_pixel
+from unidirectional import unidirectional_sample
+from routines import generate_path
+from constants import *
+
+logger = logging.getLogger('rtv3-adaptive')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+@numba.njit(parallel=True)
+def adaptive_screen_sample(camera: Camera, bvh, bidirectional, pixel_samples, sums, squares, counts):
+    # pixel_samples[i, j] more samples of each pixel, tiles in parallel and seeded like bidirectional_screen_sample
+    seed = np.random.randint(0, 2 ** 30)
+    tile_counts = np.zeros((camera.tile_count(), MAX_BOUNCES + 2, MAX_BOUNCES + 2), dtype=np.int64)
+    for tile in numba.prange(camera.tile_count()):
+        np.random.seed(seed + tile)
+        adaptive_tile_sample(camera, bvh, tile, bidirectional, pixel_samples, sums, squares, counts, tile_counts[tile])
+    np.random.seed(seed + camera.tile_count())
+    for tile_count in tile_counts:
+        camera.sample_counts += tile_count
+
+
+@numba.njit(nogil=True)
+def adaptive_tile_sample(camera: Camera, bvh, tile, bidirectional, pixel_samples, sums, squares, counts,
+                         sample_counts):
+    # adds each sample's color to sums and its squared luminance to squares, which is all the variance needs
+    occluders = np.full((MAX_BOUNCES + 2) ** 2, -1, dtype=np.int64)
+    buffers = bidirectional_buffers(bvh)
+    i_start, i_end, j_start, j_end = camera.tile(tile)
+    for i in range(i_start, i_end):
+        for j in range(j_start, j_end):
+            for _ in range(pixel_samples[i, j]):
+                if bidirectional:
+                    # a pixel's estimate is every (s, t) sample that got through
+                    value = np.zeros(3, dtype=np.float64)
+                    bidirectional_pixel(camera, bvh, i, j, buffers, occluders, sample_counts, value)
+                else:
+                    camera_path = generate_path(bvh, camera.make_ray(i, j), Direction.FROM_CAMERA.value,
+                                                stop_for_light=True)
+                    value = unidirectional_sample(camera_path)
+                if not np.isfinite(value).all():
+                    value = np.zeros(3, dtype=np.float64)
+                luminance = np.dot(value, LUMINANCE)
+                sums[i, j] += value
+                squares[i, j] += luminance * luminance
+                counts[i, j] += 1
+
+
+class AdaptiveSampler:
+    # renders until every pixel's noise is under target_noise or time_budget seconds have gone by. each pass
+    # estimates every pixel's variance from the samples it has so far and hands the pass's samples to the pixels
+    # furthest from the target, so flat, converged regions stop costing anything. the camera's image holds each
+    # pixel's mean rather than a sum, since pixels have different numbers of samples
+    def __init__(self, camera: Camera, bvh, bidirectional=False, target_noise=ADAPTIVE_TARGET_NOISE,
+                 time_budget=None, min_samples=ADAPTIVE_MIN_SAMPLES, max_samples=ADAPTIVE_MAX_SAMPLES,
+                 pass_samples=ADAPTIVE_PASS_SAMPLES):
+        self.camera = camera
+        self.bvh = bvh
+        self.bidirectional = bidirectional
+        self.target_noise = target_noise
+        self.time_budget = time_budget
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.pass_samples = pass_samples
+        shape = (camera.pixel_height, camera.pixel_width)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.sums = np.zeros(shape + (3,), dtype=np.float64)
+        self.squares = np.zeros(shape, dtype=np.float64)
+        self.passes = 0
+        self.converged = False
+        self.start = None
+
+    def mean(self):
+        return self.sums / np.maximum(self.counts, 1)[..., np.newaxis]
+
+    def variance(self):
+        # unbiased variance of each pixel's luminance samples, infinite for pixels with fewer than 2
+        n = self.counts.astype(np.float64)
+        mean = np.dot(self.sums, LUMINANCE) / np.maximum(n, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (self.squares - n * mean ** 2) / (n - 1)
+        return np.where(n > 1, np.maximum(variance, 0), np.inf)
+
+    def error(self):
+        # standard error of each pixel's mean, relative to its brightness or a floor set by the whole image's
+        luminance = np.dot(self.mean(), LUMINANCE)
+        floor = max(ADAPTIVE_DARK_FRACTION * luminance.mean(), np.finfo(np.float64).tiny)
+        return np.sqrt(self.variance() / np.maximum(self.counts, 1)) / np.maximum(luminance, floor)
+
+    def schedule(self):
+        # samples for each pixel in the next pass. a pixel whose error is e after n samples needs about
+        # n * ((e / target) ** 2 - 1) more to reach the target. no pixel more than doubles its samples in one pass,
+        # since its error is only an estimate, and if the pixels need more than the pass has they share it in
+        # proportion to what they need
+        if self.counts.min() < self.min_samples:
+            return np.maximum(self.min_samples - self.counts, 0)
+        error = self.error()
+        with np.errstate(invalid='ignore'):
+            needed = np.ceil(self.counts * ((error / self.target_noise) ** 2 - 1))
+        needed = np.clip(np.nan_to_num(needed), 0, np.minimum(self.counts, self.max_samples - self.counts))
+        budget = self.pass_samples * self.counts.size
+        if needed.sum() > budget:
+            needed = np.ceil(needed * budget / needed.sum())
+        return needed.astype(np.int64)
+
+    def noise(self):
+        # root mean square of the pixels' errors, one number for how converged the whole image is
+        return float(np.sqrt(np.mean(self.error() ** 2)))
+
+    def finished(self):
+        return self.converged or (self.time_budget is not None and self.start is not None and
+                                  time.time() - self.start >= self.time_budget)
+
+    def sample(self):
+        # one pass, returning how many samples it took. none means every pixel has converged
+        if self.start is None:
+            self.start = time.time()
+        pixel_samples = self.schedule()
+        total = int(pixel_samples.sum())
+        self.converged = total == 0
+        if self.converged:
+            return 0
+        adaptive_screen_sample(self.camera, self.bvh, self.bidirectional, pixel_samples, self.sums, self.squares,
+                               self.counts)
+        self.camera.image = self.mean()
+        self.camera.samples = int(self.counts.mean())
+        self.passes += 1
+        logger.info('pass %d took %d samples in %d pixels, noise %.4f', self.passes, total,
+                    np.count_nonzero(pixel_samples), self.noise())
+        return total
+
+    def render(self, callback=None):
+        # passes until finished, calling callback with the sampler after each
+        while not self.finished():
+            if self.sample() and callback is not None:
+                callback(self)
+        return self.camera.image
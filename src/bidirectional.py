@@ -1,166 +1,362 @@
 from camera import Camera
-from primitives import Ray, Box, unit, point
-from routines import generate_light_ray, BRDF_sample, BRDF_function, BRDF_pdf, geometry_term
-from collision import visibility_test, traverse_bvh
+from primitives import VertexArrays, ConnectionArrays
+from routines import emission_direction, BRDF_sample, BRDF_function, BRDF_pdf, geometry
+from collision import closest_index, surface_at, occlusion_test_batch
 from constants import *
 import numba
 from utils import timed
 
 
-@numba.njit
-def extend_path(path, root, path_direction):
-    for i in range(MAX_BOUNCES):
-        ray = path[-1]
-        triangle, t = traverse_bvh(root, ray)
-        if triangle is not None:
-            # generate new ray
-            #  new vectors
-            origin = ray.origin + ray.direction * t
-            direction = BRDF_sample(triangle.material, -1 * ray.direction, triangle.normal, path_direction)
-            new_ray = Ray(origin, direction)
-
-            #  store info from triangle
-            new_ray.normal = triangle.normal
-            new_ray.material = triangle.material
-            new_ray.local_color = triangle.color
-            if path_direction == Direction.FROM_CAMERA.value and triangle.emitter:
-                new_ray.hit_light = True
-
-            # probability, weight, and color updates
-            G = geometry_term(ray, new_ray)
-
-            if i == 0:
-                # only need to multiply by G because p of this direction is already stored at creation
-                new_ray.p = ray.p * G
-                # same deal, "brdf" of source is already in ray.color
-                new_ray.color = ray.color * G
-                new_ray.G = G
-            else:
-                # so the idea here is that each vertex has information about everything up to it but not including it,
-                # because we can't be sure of anything about the final bounce until we know the joining vertex
-                bounce_p = BRDF_pdf(ray.material, -1 * path[-2].direction, ray.normal, ray.direction, path_direction)
-                new_ray.p = ray.p * G * bounce_p
-                new_ray.color = ray.color * ray.local_color * G * BRDF_function(ray.material, -1 * path[-2].direction,
-                                                                                ray.normal, ray.direction, path_direction)
-                new_ray.G = G
-                ray.local_p = bounce_p
-
-            path.append(new_ray)
-        else:
-            break
+@numba.njit(nogil=True)
+def bidirectional_buffers(bvh, connections=(MAX_BOUNCES + 2) ** 2):
+    # everything a thread needs to sample pixels, allocated once and reused for every pixel it renders: a camera
+    # and a light subpath, room for one connection's color, a pixel's worth of connections and a traversal stack.
+    # paths are at most MAX_BOUNCES segments long and connections need a camera subpath of at least two vertices,
+    # so the light subpath never needs more than MAX_BOUNCES - 1, and there is at most one connection per (s, t)
+    return VertexArrays(MAX_BOUNCES + 1), VertexArrays(max(MAX_BOUNCES - 1, 1)), np.zeros(3), \
+        ConnectionArrays(connections), bvh.stack()
+
+
+@numba.njit(nogil=True)
+def start_camera_subpath(vertices: VertexArrays, camera: Camera, i, j):
+    # the lens vertex. its sums start at 0 because no connections are made to the lens (t == 1), so there is no
+    # strategy for them to weigh against
+    origin, direction = camera.sample_pixel(i, j)
+    vertices.start(origin, direction, direction, WHITE, WHITE, 1., 1., 0., 0.)
+
 
+@numba.njit(nogil=True)
+def start_light_subpath(vertices: VertexArrays, origin, normal, color, light_pdf):
+    # a point on a light, as picked by the light sampler, and a direction leaving it. the throughput is the emitted
+    # color over the point's density, which is what connections to the light vertex itself need
+    direction = emission_direction(normal)
+    cos = np.dot(normal, direction)
+    vertices.start(origin, direction, normal, color, color / light_pdf, light_pdf, EMISSION_PDF, 1 / EMISSION_PDF,
+                   cos / (light_pdf * EMISSION_PDF))
 
-# using this might be a little inefficient but it makes the code a lot simpler
-@numba.njit
-def dir(a, b):
-    # return direction from A to B
-    return unit(b.origin - a.origin)
-
-
-@numba.njit
-def bidirectional_pixel_sample(camera_path, light_path, root):
-    extend_path(camera_path, root, Direction.FROM_CAMERA.value)
-    extend_path(light_path, root, Direction.FROM_EMITTER.value)
-    samples = [[WHITE * -1 for t in range(len(camera_path) + 1)] for s in range(len(light_path) + 1)]
-    for t in range(len(camera_path) + 1):
-        for s in range(len(light_path) + 1):
-            if s == 0 or t == 0:
-                # no visibility test needed
-                if t == 0:
-                    continue
-                if not camera_path[t - 1].hit_light:
-                    continue
-                light_p = 1.0
-                light_f = WHITE
-                camera_p = camera_path[t - 1].p
-                camera_f = camera_path[t - 1].color
+
+@numba.njit(nogil=True)
+def extend_subpath(vertices: VertexArrays, bvh, path_direction, bounces, stack):
+    # traces up to bounces vertices on from the last one. lights absorb, as they do for unidirectional paths, so a
+    # subpath ends at the first one it hits.
+    # besides each vertex's throughput this keeps the two running sums of the recursive MIS weights from VCM
+    # (Georgiev et al. 2012, as in SmallVCM): dVCM and dVC. between them they hold, relative to the probability of
+    # the subpath as it was sampled, the sum of the probabilities of every other way of sampling it, less the last
+    # vertex's pdf of being reached from the other end, which isn't known until the subpath is connected. each
+    # vertex only needs its predecessor's sums and the pdfs of its own bounce, so a connection's weight costs the
+    # same however long its subpaths are
+    reverse_direction = Direction.FROM_EMITTER.value
+    if path_direction == Direction.FROM_EMITTER.value:
+        reverse_direction = Direction.FROM_CAMERA.value
+    for _ in range(bounces):
+        k = vertices.size - 1
+        if vertices.hit_light[k] or not vertices.pdf_forward[k] > 0:
+            break
+        instance, hit, t = closest_index(bvh, vertices.origins[k], vertices.directions[k], stack)
+        if hit < 0:
+            break
+        normal, material, color, emitter = surface_at(bvh, instance, hit)
+        direction = vertices.directions[k]
+
+        # leaving vertex k. vertex 0's sums were set by whoever started the subpath
+        if k == 0:
+            throughput = vertices.throughputs[0] * np.abs(np.dot(vertices.normals[0], direction)) / \
+                vertices.pdf_forward[0]
+            dVCM = vertices.dVCM[0]
+            dVC = vertices.dVC[0]
+        else:
+            throughput = vertices.throughputs[k] * vertices.local_colors[k] * BRDF_function(
+                vertices.materials[k], vertices.incidents[k], vertices.normals[k], direction,
+                Direction.FROM_CAMERA.value) / vertices.pdf_forward[k]
+            cos_out = np.abs(np.dot(vertices.normals[k], direction))
+            if vertices.materials[k] == Material.SPECULAR.value:
+                # only the path as sampled could have made this bounce, and its forward and reverse pdfs cancel
+                dVCM = 0.
+                dVC = vertices.dVC[k] * cos_out
             else:
-                if t == 1:
-                    # project new camera_vertex for visibility test
-                    continue
-                # need visibility test
-                light_vertex = light_path[s - 1]
-                camera_vertex = camera_path[t - 1]
-                dir_l_to_c = unit(camera_vertex.origin - light_vertex.origin)
-                if visibility_test(root, camera_vertex, light_vertex):
-                    if t == 1:
-                        camera_brdf = 1
-                    else:
-                        camera_brdf = BRDF_function(camera_vertex.material, -1 * camera_path[t - 2].direction,
-                                                    camera_vertex.normal, -1 * dir_l_to_c, Direction.FROM_CAMERA.value)
-                    if s == 1:
-                        light_brdf = np.dot(dir_l_to_c, light_vertex.normal)
-                    else:
-                        light_brdf = BRDF_function(light_vertex.material, -1 * light_path[s - 2].direction,
-                                                    light_vertex.normal, dir_l_to_c, Direction.FROM_EMITTER.value)
-                    camera_f = camera_vertex.color * camera_vertex.local_color * camera_brdf
-                    camera_p = camera_vertex.p
-                    light_f = light_vertex.color * light_vertex.local_color * light_brdf
-                    light_p = light_vertex.p
-                else:
-                    continue
-
-            f = camera_f * light_f
-            p = camera_p * light_p
-
-            path = [light_path[i] if i < s else camera_path[s - i] for i in range(s + t)]
-            p_ratios = np.zeros(s + t, dtype=np.float64)
-            # adapted from Veach section 10.2
-            # note that this does not reach the efficiency that he describes, kind of an intermediate state
-            # where it is correct in terms of calculations but not efficient yet in minimizing computation
-            for i in range(s + t):
-                # i is the subscript in the denominator, computing ratios of p(i + 1) / p(i)
-                if i == 0:
-                    num = 1
-                elif i == 1:
-                    num = path[0].p
-                else:
-                    num = BRDF_pdf(path[i - 1].material, dir(path[i - 1], path[i - 2]), path[i - 1].normal,
-                               dir(path[i - 1], path[i]), Direction.FROM_CAMERA.value) * geometry_term(path[i - 1], path[i])
-                if i == s + t - 1:
-                    denom = 1
-                elif i == s + t - 2:
-                    denom = path[-1].p
-                else:
-                    denom = BRDF_pdf(path[i + 1].material, dir(path[i + 1], path[i + 2]), path[i + 1].normal,
-                                     dir(path[i + 1], path[i]), Direction.FROM_EMITTER.value) * geometry_term(path[i + 1], path[i])
-                p_ratios[i] = num / denom
-
-            # p_ratios is like [p1/p0, p2/p1, p3/p2, ... ]
-
-            for k in range(1, s + t):
-                p_ratios[k] = p_ratios[k] * p_ratios[k - 1]
-
-            # p_ratios is like [p1/p0, p2/p0, p3/p0 ...]
-
-            # p_ratios[s - 1] is ps/p0
-            w = np.sum(p_ratios[s - 1] / p_ratios[:-2]) + 1 / p_ratios[s - 1]
-            # w is sum(ps/pi) for all pi we actually consider
-
-            sample = np.maximum(0, f / (p * w))
-            samples[s][t] = sample
-    return samples
-
-# final optimized version probably looks like:
-# do all visibility tests first, save all the directions, then do brdfs and pdfs for all possible joins
-# make a grid of G ratios
+                dVC = cos_out / vertices.pdf_forward[k] * (vertices.dVC[k] * vertices.pdf_reverse[k] + vertices.dVCM[k])
+                dVCM = 1 / vertices.pdf_forward[k]
+
+        # arriving at vertex n, which turns the solid angle pdfs into area ones
+        n = k + 1
+        cos_in = np.abs(np.dot(normal, direction))
+        vertices.origins[n] = vertices.origins[k] + direction * t
+        vertices.normals[n] = normal
+        vertices.materials[n] = material
+        vertices.local_colors[n] = color
+        vertices.incidents[n] = -1 * direction
+        vertices.throughputs[n] = throughput
+        vertices.lengths[n] = n + 1
+        vertices.G[n] = geometry(vertices.origins[k], vertices.normals[k], vertices.origins[n], normal)
+        vertices.dVCM[n] = dVCM * t * t / cos_in
+        vertices.dVC[n] = dVC / cos_in
+        vertices.hit_light[n] = emitter
+        vertices.light_ids[n] = bvh.light_index(instance, hit) if emitter else -1
+        if not emitter:
+            incident = vertices.incidents[n]
+            vertices.directions[n] = BRDF_sample(material, incident, normal, path_direction)
+            vertices.pdf_forward[n] = BRDF_pdf(material, incident, normal, vertices.directions[n], path_direction)
+            vertices.pdf_reverse[n] = BRDF_pdf(material, vertices.directions[n], normal, incident, reverse_direction)
+        vertices.size = n + 1
+
+
+@numba.njit(nogil=True)
+def emitter_sample(vertices: VertexArrays, t, light_pdf, sample):
+    # the s == 0 sample of a camera subpath that hit a light at vertex t - 1, weighted against the light subpaths
+    # that could have started there. light_pdf is the density light subpaths are started there with
+    c = t - 1
+    w_camera = light_pdf * (vertices.dVCM[c] + EMISSION_PDF * vertices.dVC[c])
+    sample[:] = vertices.throughputs[c] * vertices.local_colors[c] / (1 + w_camera)
+
+
+@numba.njit(nogil=True)
+def connection_sample(camera_vertices: VertexArrays, c, light_vertices: VertexArrays, l, sample):
+    # the weighted color of joining camera vertex c, and the camera vertices before it, to light vertex l and the
+    # light vertices before it. returns False if they can't be joined, only diffuse surfaces facing each other can.
+    # a light subpath that lands on a light ends there, as camera subpaths do, so that vertex is never joined.
+    # the weight compares this strategy with its neighbours on either side, the sums carry the rest of the way along
+    # each subpath
+    if light_vertices.hit_light[l]:
+        return False
+    delta = light_vertices.origins[l] - camera_vertices.origins[c]
+    distance2 = np.dot(delta, delta)
+    direction = delta / np.sqrt(distance2)
+    camera_cos = np.dot(camera_vertices.normals[c], direction)
+    light_cos = -np.dot(light_vertices.normals[l], direction)
+    if camera_vertices.materials[c] != Material.DIFFUSE.value or not (camera_cos > 0 and light_cos > 0):
+        return False
+
+    camera_material = camera_vertices.materials[c]
+    camera_normal = camera_vertices.normals[c]
+    camera_incident = camera_vertices.incidents[c]
+    camera_brdf = camera_vertices.local_colors[c] * BRDF_function(camera_material, camera_incident, camera_normal,
+                                                                  direction, Direction.FROM_CAMERA.value)
+    camera_pdf = BRDF_pdf(camera_material, camera_incident, camera_normal, direction, Direction.FROM_CAMERA.value)
+    camera_reverse = BRDF_pdf(camera_material, direction, camera_normal, camera_incident,
+                              Direction.FROM_EMITTER.value)
+    if light_vertices.lengths[l] == 1:
+        # the light vertex itself, which emits the same in every direction so only its cosine matters
+        light_brdf = light_cos * ONES
+        light_pdf = EMISSION_PDF
+        w_light = camera_pdf * light_cos / (distance2 * light_vertices.light_pdfs[l])
+    else:
+        light_material = light_vertices.materials[l]
+        light_normal = light_vertices.normals[l]
+        if light_material != Material.DIFFUSE.value:
+            return False
+        light_incident = light_vertices.incidents[l]
+        light_brdf = light_vertices.local_colors[l] * BRDF_function(light_material, light_incident, light_normal,
+                                                                    -1 * direction, Direction.FROM_CAMERA.value)
+        light_pdf = BRDF_pdf(light_material, light_incident, light_normal, -1 * direction,
+                             Direction.FROM_EMITTER.value)
+        light_reverse = BRDF_pdf(light_material, -1 * direction, light_normal, light_incident,
+                                 Direction.FROM_CAMERA.value)
+        w_light = camera_pdf * light_cos / distance2 * (light_vertices.dVCM[l] + light_vertices.dVC[l] * light_reverse)
+    w_camera = light_pdf * camera_cos / distance2 * (camera_vertices.dVCM[c] + camera_vertices.dVC[c] * camera_reverse)
+    sample[:] = light_vertices.throughputs[l] * light_brdf * camera_brdf * camera_vertices.throughputs[c] / (
+        distance2 * (1 + w_light + w_camera))
+    return True
+
+
+@numba.njit(nogil=True)
+def add_connection(connections: ConnectionArrays, camera_vertices: VertexArrays, c, light_vertices: VertexArrays, l,
+                   sample):
+    connections.add(camera_vertices.origins[c], light_vertices.origins[l], sample, light_vertices.lengths[l],
+                    camera_vertices.lengths[c])
+
+
+@numba.njit(nogil=True)
+def record_connections(camera: Camera, bvh, i, j, connections: ConnectionArrays, occluders, stack, sample_counts,
+                       value):
+    # shadow rays for all of a pixel's connections in one batch, keyed by their (s, t) in the occluder cache, then
+    # the samples of those that got through
+    n = connections.size
+    occlusion_test_batch(bvh, connections.origins[:n], connections.targets[:n], occluders, connections.keys[:n],
+                         connections.visible[:n], stack)
+    for k in range(n):
+        if connections.visible[k]:
+            record_sample(camera, i, j, connections.light_lengths[k], connections.camera_lengths[k],
+                          connections.colors[k], sample_counts, value)
+    connections.size = 0
+
+
+@numba.njit(nogil=True)
+def record_sample(camera: Camera, i, j, s, t, sample, sample_counts, value):
+    # samples that get through go straight into their (s, t) image, are counted, and are added to value
+    if sample.max() > 0 and np.isfinite(sample).all():
+        camera.images[s, t, i, j] += sample
+        sample_counts[s, t] += 1
+        value += sample
+
+
+@numba.njit(nogil=True)
+def bidirectional_pixel(camera: Camera, bvh, i, j, buffers, occluders, sample_counts, value):
+    # one pair of subpaths for pixel i, j, joined every way that makes a path of at most MAX_BOUNCES segments.
+    # the samples are MIS weighted, so together they are one estimate of the pixel. every strategy but t < 2 is
+    # used for every path length, which the recursive weights rely on
+    camera_vertices, light_vertices, sample, pending, stack = buffers
+    start_camera_subpath(camera_vertices, camera, i, j)
+    extend_subpath(camera_vertices, bvh, Direction.FROM_CAMERA.value, MAX_BOUNCES, stack)
+    if camera_vertices.size < 2:
+        return
+    # the light subpath is picked for the camera's first vertex, which every strategy used here has in common, so
+    # the light sampler's density near it is the one all of their weights see
+    first = camera_vertices.origins[1]
+    light_vertices.size = 0
+    if not camera_vertices.hit_light[1]:
+        light_origin, light_normal, light_color, light_pdf = bvh.light_sampler.sample_near(first)
+        start_light_subpath(light_vertices, light_origin, light_normal, light_color, light_pdf)
+        extend_subpath(light_vertices, bvh, Direction.FROM_EMITTER.value, MAX_BOUNCES - 2, stack)
+    for t in range(2, camera_vertices.size + 1):
+        if camera_vertices.hit_light[t - 1]:
+            # no visibility test needed, and nothing to connect since lights absorb
+            light_pdf = bvh.light_sampler.pdf_near(first, camera_vertices.light_ids[t - 1])
+            emitter_sample(camera_vertices, t, light_pdf, sample)
+            record_sample(camera, i, j, 0, t, sample, sample_counts, value)
+            continue
+        for s in range(1, min(light_vertices.size, MAX_BOUNCES + 1 - t) + 1):
+            if connection_sample(camera_vertices, t - 1, light_vertices, s - 1, sample) and sample.max() > 0:
+                add_connection(pending, camera_vertices, t - 1, light_vertices, s - 1, sample)
+    record_connections(camera, bvh, i, j, pending, occluders, stack, sample_counts, value)
+
+
+@timed
+@numba.njit(parallel=True)
+def bidirectional_screen_sample(camera: Camera, bvh):
+    # tiles are rendered in parallel. each only writes its own pixels and counts its samples in its own row of
+    # tile_counts, which are added up once all are done. random numbers are per thread, and each tile seeds them
+    # from its index so the result doesn't depend on which thread renders which tile
+    seed = np.random.randint(0, 2 ** 30)
+    tile_counts = np.zeros((camera.tile_count(), MAX_BOUNCES + 2, MAX_BOUNCES + 2), dtype=np.int64)
+    for tile in numba.prange(camera.tile_count()):
+        np.random.seed(seed + tile)
+        bidirectional_tile_sample(camera, bvh, tile, tile_counts[tile])
+    # whichever tile ran last on this thread left its state behind, so the next pass's seed would depend on that
+    np.random.seed(seed + camera.tile_count())
+    for counts in tile_counts:
+        camera.sample_counts += counts
+    camera.samples += 1
+
+
+@numba.njit(nogil=True)
+def bidirectional_tile_sample(camera: Camera, bvh, tile, sample_counts):
+    # last triangle (or instance) to block each (s, t) connection, shared between neighbouring pixels
+    occluders = np.full((MAX_BOUNCES + 2) ** 2, -1, dtype=np.int64)
+    buffers = bidirectional_buffers(bvh)
+    i_start, i_end, j_start, j_end = camera.tile(tile)
+    for i in range(i_start, i_end):
+        for j in range(j_start, j_end):
+            bidirectional_pixel(camera, bvh, i, j, buffers, occluders, sample_counts, camera.image[i, j])
+
+
+@numba.njit(parallel=True)
+def trace_light_cache(cache: VertexArrays, bvh, paths):
+    # traces paths light subpaths and packs their vertices, in order, into cache. a vertex where a subpath landed
+    # on a light is left out, it can't be joined to anything. chunks of subpaths are traced in parallel into slots
+    # of their own and seeded like tiles are in bidirectional_screen_sample, then moved together at the end
+    length = max(MAX_BOUNCES - 1, 1)
+    counts = np.zeros(paths, dtype=np.int64)
+    chunks = -(-paths // LIGHT_CACHE_CHUNK)
+    seed = np.random.randint(0, 2 ** 30)
+    for chunk in numba.prange(chunks):
+        np.random.seed(seed + chunk)
+        vertices = VertexArrays(length)
+        stack = bvh.stack()
+        for path in range(chunk * LIGHT_CACHE_CHUNK, min((chunk + 1) * LIGHT_CACHE_CHUNK, paths)):
+            origin, normal, color, light_pdf = bvh.light_sampler.sample()
+            start_light_subpath(vertices, origin, normal, color, light_pdf)
+            extend_subpath(vertices, bvh, Direction.FROM_EMITTER.value, MAX_BOUNCES - 2, stack)
+            counts[path] = vertices.size - 1 if vertices.hit_light[vertices.size - 1] else vertices.size
+            for k in range(counts[path]):
+                cache.copy(vertices, k, path * length + k)
+    np.random.seed(seed + chunks)
+
+    size = 0
+    for path in range(paths):
+        for k in range(counts[path]):
+            cache.copy(cache, path * length + k, size)
+            size += 1
+    cache.size = size
+
+
+@numba.njit(nogil=True)
+def cached_pixel(camera: Camera, bvh, i, j, buffers, cache: VertexArrays, scale, connections, occluders,
+                 sample_counts, value):
+    # bidirectional_pixel with the light subpath replaced by the cache: every camera vertex is joined to connections
+    # cached light vertices picked uniformly, each scaled by scale to make up for the ones it wasn't joined to.
+    # connections that would make a path longer than MAX_BOUNCES segments count as misses
+    camera_vertices, _, sample, pending, stack = buffers
+    start_camera_subpath(camera_vertices, camera, i, j)
+    extend_subpath(camera_vertices, bvh, Direction.FROM_CAMERA.value, MAX_BOUNCES, stack)
+    for t in range(2, camera_vertices.size + 1):
+        c = t - 1
+        if camera_vertices.hit_light[c]:
+            # light subpaths in the cache are picked for no pixel in particular
+            emitter_sample(camera_vertices, t, bvh.light_sampler.pdf(camera_vertices.light_ids[c]), sample)
+            record_sample(camera, i, j, 0, t, sample, sample_counts, value)
+            continue
+        if camera_vertices.materials[c] != Material.DIFFUSE.value or cache.size == 0:
+            continue
+        for _ in range(connections):
+            l = np.random.randint(0, cache.size)
+            s = cache.lengths[l]
+            if s + t - 1 > MAX_BOUNCES:
+                continue
+            if connection_sample(camera_vertices, c, cache, l, sample) and sample.max() > 0:
+                sample *= scale
+                add_connection(pending, camera_vertices, c, cache, l, sample)
+    record_connections(camera, bvh, i, j, pending, occluders, stack, sample_counts, value)
+
+
+@numba.njit(parallel=True)
+def cached_screen_sample(camera: Camera, bvh, cache: VertexArrays, paths, connections):
+    # one pass of cached_pixel over the screen, parallel and seeded like bidirectional_screen_sample. picking one
+    # of size vertices uniformly and scaling by size / paths makes a connection worth, on average, joining every
+    # vertex of one light subpath, and connections of those are averaged
+    seed = np.random.randint(0, 2 ** 30)
+    scale = cache.size / (connections * paths)
+    tile_counts = np.zeros((camera.tile_count(), MAX_BOUNCES + 2, MAX_BOUNCES + 2), dtype=np.int64)
+    for tile in numba.prange(camera.tile_count()):
+        np.random.seed(seed + tile)
+        cached_tile_sample(camera, bvh, tile, cache, scale, connections, tile_counts[tile])
+    np.random.seed(seed + camera.tile_count())
+    for counts in tile_counts:
+        camera.sample_counts += counts
+    camera.samples += 1
+
+
+@numba.njit(nogil=True)
+def cached_tile_sample(camera: Camera, bvh, tile, cache: VertexArrays, scale, connections, sample_counts):
+    occluders = np.full((MAX_BOUNCES + 2) ** 2, -1, dtype=np.int64)
+    # every camera vertex but the lens can make connections
+    buffers = bidirectional_buffers(bvh, MAX_BOUNCES * connections)
+    i_start, i_end, j_start, j_end = camera.tile(tile)
+    for i in range(i_start, i_end):
+        for j in range(j_start, j_end):
+            cached_pixel(camera, bvh, i, j, buffers, cache, scale, connections, occluders, sample_counts,
+                         camera.image[i, j])
+
+
+class LightCacheRenderer:
+    # bidirectional screen samples that share light subpaths between pixels instead of tracing one for each.
+    # every pass traces paths light subpaths, one per pixel unless told otherwise, and keeps all of their vertices
+    # in a cache that every camera vertex on the screen picks its connections from. tracing the light subpaths is
+    # spread over the whole screen, so each camera vertex can afford several connections. the strategies and their
+    # MIS weights are bidirectional_pixel's, only the light vertices they are joined to are picked differently
+    # (Davidovic et al. 2014)
+    def __init__(self, camera: Camera, bvh, paths=None, connections=LIGHT_CACHE_CONNECTIONS):
+        self.camera = camera
+        self.bvh = bvh
+        self.paths = paths or camera.pixel_width * camera.pixel_height
+        self.connections = connections
+        self.cache = VertexArrays(self.paths * max(MAX_BOUNCES - 1, 1))
+
+    def sample(self):
+        trace_light_cache(self.cache, self.bvh, self.paths)
+        cached_screen_sample(self.camera, self.bvh, self.cache, self.paths, self.connections)
 
 
 @timed
-@numba.njit
-def bidirectional_screen_sample(camera: Camera, root: Box):
-    for i in range(camera.pixel_height):
-        for j in range(camera.pixel_width):
-            light_path = numba.typed.List()
-            light_path.append(generate_light_ray(root))
-            camera_path = numba.typed.List()
-            camera_path.append(camera.make_ray(i, j))
-
-            samples = bidirectional_pixel_sample(camera_path, light_path, root)
-            for s, row in enumerate(samples):
-                for t, sample in enumerate(row):
-                    if np.greater(sample, 0).all():
-                        camera.images[s][t][i][j] += sample
-                        camera.sample_counts[s][t] += 1
-                    camera.image[i][j] += sample
-    camera.samples += 1
\ No newline at end of file
+def light_cache_screen_sample(camera: Camera, bvh):
+    # drop-in for bidirectional_screen_sample, use a LightCacheRenderer to keep its cache between passes
+    LightCacheRenderer(camera, bvh).sample()
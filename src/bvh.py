@@ -1,7 +1,13 @@
-from primitives import Box, Triangle
+from primitives import Box, Triangle, TriangleArrays, FlatBVH, WideBVH, QuantizedBVH, InstancedBVH, LightSampler, \
+    GEOMETRY_CLASSES, as_float64
+import math
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from load import load_obj
+from numba.typed import List as TypedList
+from load import load_obj, Mesh
+from cache import content_hash, save_arrays, load_arrays
 import logging
 from constants import *
 import numba
@@ -12,129 +18,821 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
-class TreeBox:
-    def __init__(self, low_corner, high_corner, parent=None, children=None, members=None):
-        self.parent = parent
-        self.children = children if children is not None else []
-        self.members = members if members is not None else []
-        self.box = Box(low_corner, high_corner)
+@numba.njit(nogil=True)
+def surface_area(low, high):
+    span = high - low
+    return 2 * (span[0] * span[1] + span[1] * span[2] + span[0] * span[2])
 
-    def extend(self, triangle: Triangle):
-        self.box.extend(triangle)
-        self.members.append(triangle)
 
-    def finalize(self):
-        if not self.children:
-            members = numba.typed.List()
-            [members.append(member) for member in self.members]
-            self.box.triangles = members
+@numba.njit(nogil=True)
+def bin_index(centroid, low, extent, n_bins):
+    b = int((centroid - low) * n_bins / extent)
+    return min(max(b, 0), n_bins - 1)
+
+
+@numba.njit(nogil=True)
+def find_split(mins, maxes, centroids, order, start, end, node_area, n_bins):
+    # binned SAH: returns the best (cost, axis, bin) where triangles with centroids in bins <= bin go left.
+    # costs are not normalized by the node's area so degenerate (flat) nodes need no special casing
+    best_cost, best_axis, best_bin = np.inf, -1, -1
+    bin_counts = np.zeros(n_bins, dtype=np.int64)
+    bin_bounds = np.empty((n_bins, 2, 3), dtype=np.float64)
+    left_areas = np.zeros(n_bins - 1, dtype=np.float64)
+    right_areas = np.zeros(n_bins - 1, dtype=np.float64)
+    for axis in range(3):
+        low, high = np.inf, -np.inf
+        for k in range(start, end):
+            c = centroids[order[k], axis]
+            low = min(low, c)
+            high = max(high, c)
+        extent = high - low
+        if extent <= 0:
+            continue
+
+        bin_counts[:] = 0
+        bin_bounds[:, 0] = np.inf
+        bin_bounds[:, 1] = -np.inf
+        for k in range(start, end):
+            triangle = order[k]
+            b = bin_index(centroids[triangle, axis], low, extent, n_bins)
+            bin_counts[b] += 1
+            bin_bounds[b, 0] = np.minimum(bin_bounds[b, 0], mins[triangle])
+            bin_bounds[b, 1] = np.maximum(bin_bounds[b, 1], maxes[triangle])
+
+        # prefix sums from both ends give the size and area of each side for every candidate plane
+        left_counts = np.cumsum(bin_counts)[:-1]
+        right_counts = (end - start) - left_counts
+        left_low, left_high = bin_bounds[0, 0].copy(), bin_bounds[0, 1].copy()
+        right_low, right_high = bin_bounds[n_bins - 1, 0].copy(), bin_bounds[n_bins - 1, 1].copy()
+        for b in range(n_bins - 1):
+            left_low = np.minimum(left_low, bin_bounds[b, 0])
+            left_high = np.maximum(left_high, bin_bounds[b, 1])
+            left_areas[b] = surface_area(left_low, left_high) if left_counts[b] else 0.
+            r = n_bins - 2 - b
+            right_low = np.minimum(right_low, bin_bounds[r + 1, 0])
+            right_high = np.maximum(right_high, bin_bounds[r + 1, 1])
+            right_areas[r] = surface_area(right_low, right_high) if right_counts[r] else 0.
+
+        costs = TRAVERSAL_COST * node_area + INTERSECT_COST * (left_areas * left_counts + right_areas * right_counts)
+        for b in range(n_bins - 1):
+            if left_counts[b] and right_counts[b] and costs[b] < best_cost:
+                best_cost, best_axis, best_bin = costs[b], axis, b
+    return best_cost, best_axis, best_bin
+
+
+@numba.njit(nogil=True)
+def partition(centroids, order, start, end, axis, split_bin, n_bins):
+    low, high = np.inf, -np.inf
+    for k in range(start, end):
+        low = min(low, centroids[order[k], axis])
+        high = max(high, centroids[order[k], axis])
+    i, j = start, end - 1
+    while i <= j:
+        if bin_index(centroids[order[i], axis], low, high - low, n_bins) <= split_bin:
+            i += 1
+        else:
+            order[i], order[j] = order[j], order[i]
+            j -= 1
+    return i
+
+
+@numba.njit(nogil=True)
+def split_node(mins, maxes, centroids, order, start, end, depth, max_members, max_depth, n_bins):
+    # bounds of the node holding order[start:end] and how to split it. partitions that range and returns
+    # (low, high, split, axis), split being -1 if the node should be a leaf
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for k in range(start, end):
+        low = np.minimum(low, mins[order[k]])
+        high = np.maximum(high, maxes[order[k]])
+
+    count = end - start
+    split = -1
+    axis = 0
+    if count > 1 and depth < max_depth:
+        node_area = surface_area(low, high)
+        cost, axis, split_bin = find_split(mins, maxes, centroids, order, start, end, node_area, n_bins)
+        if axis >= 0 and (cost < INTERSECT_COST * count * node_area or count > max_members):
+            split = partition(centroids, order, start, end, axis, split_bin, n_bins)
+    return low, high, split, axis
+
+
+@numba.njit(nogil=True)
+def build_nodes(mins, maxes, max_members, max_depth, n_bins):
+    # nodes are emitted depth-first, see FlatBVH for the layout
+    n = len(mins)
+    centroids = (mins + maxes) / 2
+    order = np.arange(n)
+    capacity = max(2 * n - 1, 1)
+    bounds = np.empty((capacity, 2, 3), dtype=np.float64)
+    offsets = np.zeros(capacity, dtype=np.int64)
+    counts = np.zeros(capacity, dtype=np.int64)
+    axes = np.zeros(capacity, dtype=np.int64)
+    node_count = 0
+    oversized = 0
+    # start, end, depth, index of the parent waiting for its right child (or -1)
+    stack = [(0, n, 0, -1)]
+    while len(stack):
+        start, end, depth, parent = stack.pop()
+        index = node_count
+        node_count += 1
+        if parent >= 0:
+            offsets[parent] = index
+
+        low, high, split, axis = split_node(mins, maxes, centroids, order, start, end, depth, max_members, max_depth,
+                                            n_bins)
+        bounds[index, 0] = low
+        bounds[index, 1] = high
+        if split < 0:
+            offsets[index] = start
+            counts[index] = end - start
+            if end - start > max_members:
+                oversized += 1
+        else:
+            axes[index] = axis
+            stack.append((split, end, depth + 1, index))
+            stack.append((start, split, depth + 1, -1))
+
+    return (bounds[:node_count].copy(), offsets[:node_count].copy(), counts[:node_count].copy(),
+            axes[:node_count].copy(), order, oversized)
+
+
+@numba.njit(nogil=True)
+def build_top_nodes(mins, maxes, max_members, max_depth, n_bins, subtree_size):
+    # the top of the tree build_nodes would build, stopping at nodes of at most subtree_size triangles.
+    # those are left as placeholders to be built separately, listed as (node, start, end, depth) in subtrees
+    n = len(mins)
+    centroids = (mins + maxes) / 2
+    order = np.arange(n)
+    capacity = max(2 * n - 1, 1)
+    bounds = np.empty((capacity, 2, 3), dtype=np.float64)
+    offsets = np.zeros(capacity, dtype=np.int64)
+    counts = np.zeros(capacity, dtype=np.int64)
+    axes = np.zeros(capacity, dtype=np.int64)
+    subtrees = np.empty((capacity, 4), dtype=np.int64)
+    node_count = 0
+    subtree_count = 0
+    stack = [(0, n, 0, -1)]
+    while len(stack):
+        start, end, depth, parent = stack.pop()
+        index = node_count
+        node_count += 1
+        if parent >= 0:
+            offsets[parent] = index
+        if end - start <= subtree_size:
+            subtrees[subtree_count] = (index, start, end, depth)
+            subtree_count += 1
+            continue
+
+        low, high, split, axis = split_node(mins, maxes, centroids, order, start, end, depth, max_members, max_depth,
+                                            n_bins)
+        bounds[index, 0] = low
+        bounds[index, 1] = high
+        if split < 0:
+            offsets[index] = start
+            counts[index] = end - start
+        else:
+            axes[index] = axis
+            stack.append((split, end, depth + 1, index))
+            stack.append((start, split, depth + 1, -1))
+
+    return (bounds[:node_count].copy(), offsets[:node_count].copy(), counts[:node_count].copy(),
+            axes[:node_count].copy(), order, subtrees[:subtree_count].copy())
+
+
+def parallel_build_nodes(mins, maxes, max_members, max_depth, n_bins, workers):
+    # the same tree as build_nodes, built on several threads. the top of the tree is split the same way on one thread
+    # until there are enough independent subtrees to keep the workers busy, then those are built concurrently
+    # (build_nodes releases the GIL) and spliced back in where their placeholders were
+    subtree_size = max(len(mins) // (PARALLEL_BUILD_SUBTREES * workers), 1)
+    bounds, offsets, counts, axes, order, subtrees = build_top_nodes(mins, maxes, max_members, max_depth, n_bins,
+                                                                     subtree_size)
+
+    def build_subtree(subtree):
+        node, start, end, depth = subtree
+        triangles = order[start:end]
+        return build_nodes(mins[triangles], maxes[triangles], max_members, max_depth - depth, n_bins)
+    with ThreadPoolExecutor(workers) as pool:
+        built = list(pool.map(build_subtree, subtrees))
+
+    # a placeholder becomes its subtree's whole run of nodes, so every node after it moves along by that much
+    sizes = np.ones(len(offsets), dtype=np.int64)
+    for (node, _, _, _), nodes in zip(subtrees, built):
+        sizes[node] = len(nodes[1])
+    positions = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    total = sizes.sum()
+    parts = {'bounds': np.empty((total, 2, 3)), 'offsets': np.empty(total, dtype=np.int64),
+             'counts': np.empty(total, dtype=np.int64), 'axes': np.empty(total, dtype=np.int64)}
+    top = sizes == 1
+    top[subtrees[:, 0]] = False
+    inner = top & (counts == 0)
+    offsets[inner] = positions[offsets[inner]]
+    parts['bounds'][positions[top]] = bounds[top]
+    parts['offsets'][positions[top]] = offsets[top]
+    parts['counts'][positions[top]] = counts[top]
+    parts['axes'][positions[top]] = axes[top]
+
+    oversized = 0
+    for (node, start, end, depth), (sub_bounds, sub_offsets, sub_counts, sub_axes, sub_order, sub_oversized) \
+            in zip(subtrees, built):
+        place = slice(positions[node], positions[node] + len(sub_offsets))
+        parts['bounds'][place] = sub_bounds
+        # inner nodes point at their right child, leaves at their first triangle
+        parts['offsets'][place] = np.where(sub_counts > 0, sub_offsets + start, sub_offsets + positions[node])
+        parts['counts'][place] = sub_counts
+        parts['axes'][place] = sub_axes
+        order[start:end] = order[start:end][sub_order]
+        oversized += sub_oversized
+    oversized += np.count_nonzero(counts[top] > max_members)
+    return parts['bounds'], parts['offsets'], parts['counts'], parts['axes'], order, oversized
+
+
+@numba.njit(nogil=True)
+def clip_triangle(vertices, axis, low, high, clipped):
+    # bounds of the part of a triangle between low and high along axis, written into clipped (a 2x3 array).
+    # they are left empty, min inf and max -inf, if there is no such part
+    clipped[0] = np.inf
+    clipped[1] = -np.inf
+    for k in range(3):
+        a, b = vertices[k], vertices[(k + 1) % 3]
+        if low <= a[axis] <= high:
+            for d in range(3):
+                clipped[0, d] = min(clipped[0, d], a[d])
+                clipped[1, d] = max(clipped[1, d], a[d])
+        # wherever the edge crosses either plane
+        for plane in (low, high):
+            if (a[axis] - plane) * (b[axis] - plane) < 0:
+                f = (plane - a[axis]) / (b[axis] - a[axis])
+                for d in range(3):
+                    crossing = plane if d == axis else a[d] + (b[d] - a[d]) * f
+                    clipped[0, d] = min(clipped[0, d], crossing)
+                    clipped[1, d] = max(clipped[1, d], crossing)
+
+
+@numba.njit(nogil=True)
+def clip_reference(vertices, ref_low, ref_high, axis, low, high, clipped):
+    # a reference's bounds are those of its triangle already clipped by earlier splits, so clip again within them
+    clip_triangle(vertices, axis, max(low, ref_low[axis]), min(high, ref_high[axis]), clipped)
+    for d in range(3):
+        clipped[0, d] = max(clipped[0, d], ref_low[d])
+        clipped[1, d] = min(clipped[1, d], ref_high[d])
+
+
+@numba.njit(nogil=True)
+def find_spatial_split(vertices, refs, ref_mins, ref_maxes, low, high, node_area, n_bins):
+    # SAH over planes between equal-width spatial bins, references straddling a plane go to both sides clipped to
+    # each. each reference is chopped into the bins it spans, entering the first and leaving the last.
+    # returns the best (cost, axis, plane position, left count, right count)
+    best = (np.inf, -1, 0., 0, 0)
+    bin_bounds = np.empty((n_bins, 2, 3), dtype=np.float64)
+    entries = np.zeros(n_bins, dtype=np.int64)
+    exits = np.zeros(n_bins, dtype=np.int64)
+    clipped = np.empty((2, 3))
+    for axis in range(3):
+        extent = high[axis] - low[axis]
+        if extent <= 0:
+            continue
+        width = extent / n_bins
+        bin_bounds[:, 0] = np.inf
+        bin_bounds[:, 1] = -np.inf
+        entries[:] = 0
+        exits[:] = 0
+        for r in range(len(refs)):
+            first = bin_index(ref_mins[r, axis], low[axis], extent, n_bins)
+            last = bin_index(ref_maxes[r, axis], low[axis], extent, n_bins)
+            entries[first] += 1
+            exits[last] += 1
+            if first == last:
+                bin_bounds[first, 0] = np.minimum(bin_bounds[first, 0], ref_mins[r])
+                bin_bounds[first, 1] = np.maximum(bin_bounds[first, 1], ref_maxes[r])
+                continue
+            for b in range(first, last + 1):
+                clip_reference(vertices[refs[r]], ref_mins[r], ref_maxes[r], axis, low[axis] + b * width,
+                               low[axis] + (b + 1) * width, clipped)
+                for d in range(3):
+                    bin_bounds[b, 0, d] = min(bin_bounds[b, 0, d], clipped[0, d])
+                    bin_bounds[b, 1, d] = max(bin_bounds[b, 1, d], clipped[1, d])
+
+        left_low, left_high = np.full(3, np.inf), np.full(3, -np.inf)
+        left_areas = np.zeros(n_bins - 1)
+        for b in range(n_bins - 1):
+            left_low = np.minimum(left_low, bin_bounds[b, 0])
+            left_high = np.maximum(left_high, bin_bounds[b, 1])
+            left_areas[b] = surface_area(left_low, left_high) if (left_low <= left_high).all() else 0.
+        right_low, right_high = np.full(3, np.inf), np.full(3, -np.inf)
+        left_count = np.cumsum(entries)
+        right_count = np.cumsum(exits[::-1])[::-1]
+        for b in range(n_bins - 2, -1, -1):
+            right_low = np.minimum(right_low, bin_bounds[b + 1, 0])
+            right_high = np.maximum(right_high, bin_bounds[b + 1, 1])
+            right_area = surface_area(right_low, right_high) if (right_low <= right_high).all() else 0.
+            n_left, n_right = left_count[b], right_count[b + 1]
+            if not n_left or not n_right or (n_left == len(refs) and n_right == len(refs)):
+                continue
+            cost = TRAVERSAL_COST * node_area + INTERSECT_COST * (left_areas[b] * n_left + right_area * n_right)
+            if cost < best[0]:
+                best = (cost, axis, low[axis] + (b + 1) * width, n_left, n_right)
+    return best
+
+
+@numba.njit(nogil=True)
+def spatial_partition(vertices, refs, ref_mins, ref_maxes, axis, position):
+    # splits references at a plane, straddling ones are clipped and referenced from both sides
+    count = len(refs)
+    left_refs, left_mins, left_maxes = np.empty(count, dtype=np.int64), np.empty((count, 3)), np.empty((count, 3))
+    right_refs, right_mins, right_maxes = np.empty(count, dtype=np.int64), np.empty((count, 3)), np.empty((count, 3))
+    left_clip, right_clip = np.empty((2, 3)), np.empty((2, 3))
+    l, r = 0, 0
+    for k in range(count):
+        left_clip[0], left_clip[1] = ref_mins[k], ref_maxes[k]
+        right_clip[0], right_clip[1] = ref_mins[k], ref_maxes[k]
+        go_left = ref_mins[k, axis] < position
+        go_right = ref_maxes[k, axis] > position
+        if go_left and go_right:
+            clip_reference(vertices[refs[k]], ref_mins[k], ref_maxes[k], axis, -np.inf, position, left_clip)
+            clip_reference(vertices[refs[k]], ref_mins[k], ref_maxes[k], axis, position, np.inf, right_clip)
+            # a sliver can clip away to nothing on one side
+            go_left = (left_clip[0] <= left_clip[1]).all()
+            go_right = (right_clip[0] <= right_clip[1]).all()
+            if not go_left and not go_right:
+                go_left = True
+                left_clip[0], left_clip[1] = ref_mins[k], ref_maxes[k]
+        elif not go_left and not go_right:
+            # flat in the plane itself
+            go_left = True
+        if go_left:
+            left_refs[l], left_mins[l], left_maxes[l] = refs[k], left_clip[0], left_clip[1]
+            l += 1
+        if go_right:
+            right_refs[r], right_mins[r], right_maxes[r] = refs[k], right_clip[0], right_clip[1]
+            r += 1
+    return ((left_refs[:l].copy(), left_mins[:l].copy(), left_maxes[:l].copy()),
+            (right_refs[:r].copy(), right_mins[:r].copy(), right_maxes[:r].copy()))
+
+
+@numba.njit(nogil=True)
+def build_spatial_nodes(vertices, max_members, max_depth, n_bins, budget):
+    # SBVH: like build_nodes, but a node can also be split at a plane with triangles crossing it referenced from both
+    # children, each clipped to its side. that is only tried where the best object split leaves children that overlap,
+    # and only while the total number of references stays within (1 + budget) times the number of triangles.
+    # the same layout comes out, except that order can hold a triangle more than once
+    n = len(vertices)
+    mins, maxes = np.empty((n, 3)), np.empty((n, 3))
+    for k in range(n):
+        mins[k] = np.minimum(np.minimum(vertices[k, 0], vertices[k, 1]), vertices[k, 2])
+        maxes[k] = np.maximum(np.maximum(vertices[k, 0], vertices[k, 1]), vertices[k, 2])
+    max_references = n + int(budget * n)
+    references = n
+    capacity = max(2 * max_references - 1, 1)
+    bounds = np.empty((capacity, 2, 3), dtype=np.float64)
+    offsets = np.zeros(capacity, dtype=np.int64)
+    counts = np.zeros(capacity, dtype=np.int64)
+    axes = np.zeros(capacity, dtype=np.int64)
+    order = np.empty(max_references, dtype=np.int64)
+    node_count = 0
+    leaf_references = 0
+    oversized = 0
+    root_area = 0.
+
+    # references, their bounds, depth, index of the parent waiting for its right child (or -1)
+    stack = [(np.arange(n), mins, maxes, 0, -1)]
+    while len(stack):
+        refs, ref_mins, ref_maxes, depth, parent = stack.pop()
+        index = node_count
+        node_count += 1
+        if parent >= 0:
+            offsets[parent] = index
+
+        count = len(refs)
+        low = np.full(3, np.inf)
+        high = np.full(3, -np.inf)
+        for k in range(count):
+            low = np.minimum(low, ref_mins[k])
+            high = np.maximum(high, ref_maxes[k])
+        bounds[index, 0] = low
+        bounds[index, 1] = high
+        node_area = surface_area(low, high)
+        if index == 0:
+            root_area = node_area
+
+        left, right = (refs[:0], ref_mins[:0], ref_maxes[:0]), (refs[:0], ref_mins[:0], ref_maxes[:0])
+        if count > 1 and depth < max_depth:
+            local = np.arange(count)
+            centroids = (ref_mins + ref_maxes) / 2
+            cost, axis, split_bin = find_split(ref_mins, ref_maxes, centroids, local, 0, count, node_area, n_bins)
+            split = -1
+            if axis >= 0:
+                split = partition(centroids, local, 0, count, axis, split_bin, n_bins)
+                # the children of the object split
+                left_low, left_high = np.full(3, np.inf), np.full(3, -np.inf)
+                right_low, right_high = np.full(3, np.inf), np.full(3, -np.inf)
+                for k in range(split):
+                    left_low = np.minimum(left_low, ref_mins[local[k]])
+                    left_high = np.maximum(left_high, ref_maxes[local[k]])
+                for k in range(split, count):
+                    right_low = np.minimum(right_low, ref_mins[local[k]])
+                    right_high = np.maximum(right_high, ref_maxes[local[k]])
+                overlap_low, overlap_high = np.maximum(left_low, right_low), np.minimum(left_high, right_high)
+                overlap = surface_area(overlap_low, overlap_high) if (overlap_low < overlap_high).all() else 0.
+            else:
+                overlap = np.inf
+
+            if overlap > SBVH_OVERLAP_RATIO * root_area and references < max_references:
+                spatial_cost, spatial_axis, position, n_left, n_right = find_spatial_split(
+                    vertices, refs, ref_mins, ref_maxes, low, high, node_area, n_bins)
+                if spatial_cost < cost and references + n_left + n_right - count <= max_references:
+                    spatial_left, spatial_right = spatial_partition(vertices, refs, ref_mins, ref_maxes, spatial_axis,
+                                                                    position)
+                    # the sweep's counts are estimates, clipping decides exactly which side each reference lands on
+                    added = len(spatial_left[0]) + len(spatial_right[0]) - count
+                    if len(spatial_left[0]) and len(spatial_right[0]) and references + added <= max_references:
+                        cost, axis = spatial_cost, spatial_axis
+                        left, right = spatial_left, spatial_right
+
+            if axis >= 0 and (cost < INTERSECT_COST * count * node_area or count > max_members):
+                if len(left[0]):
+                    references += len(left[0]) + len(right[0]) - count
+                else:
+                    left = (refs[local[:split]], ref_mins[local[:split]], ref_maxes[local[:split]])
+                    right = (refs[local[split:]], ref_mins[local[split:]], ref_maxes[local[split:]])
+            else:
+                left, right = (refs[:0], ref_mins[:0], ref_maxes[:0]), (refs[:0], ref_mins[:0], ref_maxes[:0])
+
+        if not len(left[0]) or not len(right[0]):
+            offsets[index] = leaf_references
+            counts[index] = count
+            order[leaf_references:leaf_references + count] = refs
+            leaf_references += count
+            if count > max_members:
+                oversized += 1
         else:
-            self.box.left = self.children[0].box
-            self.box.right = self.children[1].box
+            axes[index] = axis
+            stack.append((right[0], right[1], right[2], depth + 1, index))
+            stack.append((left[0], left[1], left[2], depth + 1, -1))
 
-        # root box holds list of emissive surfaces
-        if self.parent is None:
-            lights = numba.typed.List()
-            [lights.append(member) for member in self.members if member.emitter]
-            self.box.lights = lights
-            self.box.light_SA = sum(light.surface_area for light in lights)
+    return (bounds[:node_count].copy(), offsets[:node_count].copy(), counts[:node_count].copy(),
+            axes[:node_count].copy(), order[:leaf_references].copy(), oversized)
 
-    def add(self, triangle: Triangle):
-        # useful if we know the bounds won't change, or don't want them to
-        self.members.append(triangle)
 
-    def __contains__(self, triangle: Triangle):
-        return self.box.contains(triangle.v0) or self.box.contains(triangle.v1) or self.box.contains(triangle.v2)
+@numba.njit(nogil=True)
+def refit_nodes(flat: FlatBVH):
+    # node bounds of the triangles where they are now, in double precision whatever the tree's, like a build's.
+    # children always come after their parents, so walking backwards updates every child before its parent.
+    # leaves bound whole triangles again, which undoes the clipping of spatial splits but stays correct
+    triangles = flat.triangles
+    bounds = np.empty((flat.node_count(), 2, 3), dtype=np.float64)
+    for index in range(flat.node_count() - 1, -1, -1):
+        low = np.full(3, np.inf)
+        high = np.full(3, -np.inf)
+        if flat.is_leaf(index):
+            first = flat.offsets[index]
+            for k in range(first, first + flat.counts[index]):
+                v0 = as_float64(triangles.v0[k])
+                for vertex in (v0, v0 + as_float64(triangles.e1[k]), v0 + as_float64(triangles.e2[k])):
+                    low = np.minimum(low, vertex)
+                    high = np.maximum(high, vertex)
+        else:
+            for child in (index + 1, flat.offsets[index]):
+                low = np.minimum(low, bounds[child, 0])
+                high = np.maximum(high, bounds[child, 1])
+        bounds[index, 0] = low
+        bounds[index, 1] = high
+    return bounds
 
-    def __len__(self):
-        return len(self.members)
 
-    def __repr__(self):
-        return "{members} members, area {area}".format(members=len(self.members), area=np.product(self.box.span))
+@numba.njit(nogil=True)
+def sah_cost(flat: FlatBVH):
+    # expected cost of tracing a random ray that hits the root, by the same measure the builder minimizes
+    cost = 0.
+    for index in range(flat.node_count()):
+        area = surface_area(flat.bounds[index, 0], flat.bounds[index, 1])
+        if flat.is_leaf(index):
+            cost += INTERSECT_COST * flat.counts[index] * area
+        else:
+            cost += TRAVERSAL_COST * area
+    root_area = surface_area(flat.bounds[0, 0], flat.bounds[0, 1])
+    return cost / root_area if root_area > 0 else cost
+
+
+@numba.njit(nogil=True)
+def collapse_nodes(flat: FlatBVH, width):
+    # turns a binary tree into one with up to width children per node. each wide node starts from a binary inner
+    # node's two children and keeps replacing the inner one with the largest surface area by its own two children
+    # until it has width of them. returns child_bounds, children and child_counts as described in WideBVH
+    capacity = max(flat.node_count(), 1)
+    child_bounds = np.empty((capacity, 2, 3, width), dtype=np.float64)
+    child_bounds[:, 0] = np.inf
+    child_bounds[:, 1] = -np.inf
+    children = np.full((capacity, width), -1, dtype=np.int64)
+    child_counts = np.zeros((capacity, width), dtype=np.int64)
+    node_count = 1
+    # binary node, the wide node it becomes
+    stack = [(0, 0)]
+    while len(stack):
+        binary, index = stack.pop()
+        if flat.is_leaf(binary):
+            # only happens at the root of a tree that is a single leaf
+            members = [binary]
+        else:
+            members = [binary + 1, flat.offsets[binary]]
+        while len(members) < width:
+            best, best_area = -1, -1.
+            for k in range(len(members)):
+                member = members[k]
+                area = surface_area(flat.bounds[member, 0], flat.bounds[member, 1])
+                if not flat.is_leaf(member) and area > best_area:
+                    best, best_area = k, area
+            if best < 0:
+                break
+            member = members.pop(best)
+            members.append(member + 1)
+            members.append(flat.offsets[member])
+
+        for lane in range(len(members)):
+            member = members[lane]
+            for side in range(2):
+                for axis in range(3):
+                    child_bounds[index, side, axis, lane] = flat.bounds[member, side, axis]
+            if flat.is_leaf(member):
+                children[index, lane] = flat.offsets[member]
+                child_counts[index, lane] = flat.counts[member]
+            else:
+                children[index, lane] = node_count
+                stack.append((member, node_count))
+                node_count += 1
+    return child_bounds[:node_count].copy(), children[:node_count].copy(), child_counts[:node_count].copy()
+
+
+@numba.njit(nogil=True)
+def quantize_nodes(child_bounds):
+    # QuantizedBVH's encoding of WideBVH child bounds, returns origins, exponents and the quantized bounds.
+    # origins are rounded down to float32 and steps are powers of two, so decoding is exact in float64
+    n, _, _, width = child_bounds.shape
+    origins = np.empty((n, 3), dtype=np.float32)
+    exponents = np.empty((n, 3), dtype=np.int8)
+    quantized = np.empty((n, 2, 3, width), dtype=np.uint8)
+    for index in range(n):
+        for axis in range(3):
+            low, high = np.inf, -np.inf
+            for lane in range(width):
+                if child_bounds[index, 0, axis, lane] <= child_bounds[index, 1, axis, lane]:
+                    low = min(low, child_bounds[index, 0, axis, lane])
+                    high = max(high, child_bounds[index, 1, axis, lane])
+            origin = np.float32(low)
+            if origin > low:
+                origin = np.nextafter(origin, np.float32(-np.inf))
+            extent = high - origin
+            exponent = math.ceil(np.log2(extent / 255)) if extent > 0 else -QUANTIZED_MIN_EXPONENT
+            exponent = max(exponent, -QUANTIZED_MIN_EXPONENT)
+            step = math.ldexp(1., exponent)
+            origins[index, axis] = origin
+            exponents[index, axis] = exponent
+            for lane in range(width):
+                lane_low, lane_high = child_bounds[index, 0, axis, lane], child_bounds[index, 1, axis, lane]
+                if lane_low > lane_high:
+                    quantized[index, 0, axis, lane] = 255
+                    quantized[index, 1, axis, lane] = 0
+                else:
+                    # the subtraction can round either way, so step out once more if the decoded bounds fall inside
+                    q_low = max(math.floor((lane_low - origin) / step), 0)
+                    if q_low > 0 and origin + q_low * step > lane_low:
+                        q_low -= 1
+                    q_high = min(math.ceil((lane_high - origin) / step), 255)
+                    if q_high < 255 and origin + q_high * step < lane_high:
+                        q_high += 1
+                    quantized[index, 0, axis, lane] = q_low
+                    quantized[index, 1, axis, lane] = q_high
+    return origins, exponents, quantized
+
+
+def round_bounds(bounds, precision, padding):
+    # bounds of either layout in a lower precision, padded and rounded outwards so they still contain triangles
+    # whose vertices were rounded too. empty (inf, -inf) bounds stay empty
+    rounded = np.empty(bounds.shape, dtype=precision)
+    rounded[:, 0] = np.nextafter((bounds[:, 0] - padding).astype(precision), precision(-np.inf))
+    rounded[:, 1] = np.nextafter((bounds[:, 1] + padding).astype(precision), precision(np.inf))
+    return rounded
+
+
+def triangle_arrays(triangles: List[Triangle]):
+    # vertices, colors, materials and emitter flags of a list of triangles
+    vertices = np.array([(triangle.v0, triangle.v1, triangle.v2) for triangle in triangles],
+                        dtype=np.float64).reshape(-1, 3, 3)
+    colors = np.array([triangle.color for triangle in triangles], dtype=np.float64).reshape(-1, 3)
+    materials = np.array([triangle.material for triangle in triangles], dtype=np.int64)
+    emitters = np.array([triangle.emitter for triangle in triangles], dtype=np.bool_)
+    return vertices, colors, materials, emitters
+
+
+def scene_arrays(scene):
+    # triangle_arrays of a Mesh, a list of triangles, or a list mixing triangles and meshes, in order.
+    # meshes are taken as they are, without making a Triangle for each face
+    if isinstance(scene, Mesh):
+        scene = [scene]
+    parts, run = [], []
+    for item in scene:
+        if isinstance(item, Mesh):
+            if run:
+                parts.append(triangle_arrays(run))
+                run = []
+            parts.append((item.triangle_vertices(), item.colors.astype(np.float64, copy=False),
+                          item.materials.astype(np.int64, copy=False), item.emitters))
+        else:
+            run.append(item)
+    if run or not parts:
+        parts.append(triangle_arrays(run))
+    if len(parts) == 1:
+        return parts[0]
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
 
 
-def AABB(triangles: List[Triangle]):
-    # < 0.001 seconds
-    box = TreeBox(MAX3, MIN3)
-    for triangle in triangles:
-        box.extend(triangle)
-    return box
+def scene_mesh(scene):
+    # the whole of a scene as one Mesh, which unlike Triangles can be pickled and sent to other processes
+    vertices, colors, materials, emitters = scene_arrays(scene)
+    return Mesh(vertices.reshape(-1, 3), np.arange(3 * len(vertices)).reshape(-1, 3), colors, materials, emitters)
 
 
 class BoundingVolumeHierarchy:
-    def __init__(self, triangles):
-        self.root = None
+    # triangles is a list of Triangles, a Mesh or a list of both.
+    # spatial_budget turns on spatial splits (SBVH), allowing that fraction of extra triangle references.
+    # they pay off where big triangles overlap lots of small ones, like walls around detailed models
+    # workers is the number of threads to build with, by default one per core.
+    # precision is the float type triangles and bounds are stored in. the tree is always built in double precision,
+    # so single precision trees are the same shape and share the cache
+    # light_tree has bidirectional pick each pixel's lights for what it sees first, see LightSampler
+    def __init__(self, triangles, max_members=BVH_MAX_MEMBERS, max_depth=BVH_MAX_DEPTH, n_bins=SAH_BINS,
+                 cache_dir=None, spatial_budget=0., workers=None, precision=GEOMETRY_PRECISION, light_tree=False):
         self.triangles = triangles
+        self.vertices, self.colors, self.materials, self.emitters = scene_arrays(triangles)
+        self.max_members = max_members
+        self.max_depth = max_depth
+        self.n_bins = n_bins
+        self.cache_dir = cache_dir
+        self.spatial_budget = spatial_budget
+        self.workers = workers or os.cpu_count()
+        self.precision = np.dtype(precision)
+        self.geometry_classes = GEOMETRY_CLASSES[self.precision]
+        self.light_tree = light_tree
+        self.order = None
+        self.flat = None
+        self.cost = None
         self.build()
 
-    def build(self, max_members=32, max_depth=15):
-        self.root = AABB(self.triangles)
-        self.root.members = list(self.triangles)
-        logger.info('root bounding box is from %s to %s', self.root.box.min, self.root.box.max)
-        stack: List[TreeBox] = [self.root]
-        while stack:
-            box = stack.pop()
-            if (len(box.members) <= max_members) or len(stack) > max_depth:
-                if len(stack) > max_depth and len(box.members) > max_members:
-                    logger.info('too deep! making a leaf with %d members', len(box.members))
-                box.finalize()
-                continue
-            l, r = self.split(box)
-            if r is not None:
-                box.children.append(r)
-                r.parent = box
-                stack.append(r)
-            if l is not None:
-                box.children.append(l)
-                l.parent = box
-                stack.append(l)
-            box.finalize()
-
-    @staticmethod
-    def divide_box(box: Box, axis: int, fraction: float):
-        # ~0.0001 seconds
-        # return two boxes resulting from splitting input box along axis at fraction
-        left_max = box.max.copy()
-        left_max[axis] -= box.span[axis] * fraction
-        right_min = box.min.copy()
-        right_min[axis] += box.span[axis] * (1 - fraction)
-        return TreeBox(box.min, left_max), TreeBox(right_min, box.max)
-
-    @staticmethod
-    def surface_area_heuristic(split):
-        l, r = split
-        l_sa = l.box.surface_area()
-        r_sa = r.box.surface_area()
-        return TRAVERSAL_COST + l_sa * len(l.members) * INTERSECT_COST + r_sa * len(r.members) * INTERSECT_COST
-
-    @classmethod
+    def cache_path(self, vertices):
+        key = content_hash([vertices], max_members=self.max_members, max_depth=self.max_depth, n_bins=self.n_bins,
+                           spatial_budget=self.spatial_budget)
+        return os.path.join(self.cache_dir, key + '.bvh')
+
+    def load_cached(self, path):
+        try:
+            arrays, meta = load_arrays(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.info('ignoring unreadable BVH cache %s: %s', path, e)
+            return None
+        if meta.get('triangles') != len(self.vertices):
+            logger.info('ignoring mismatched BVH cache %s', path)
+            return None
+        logger.info('loaded BVH from %s', path)
+        return arrays['bounds'], arrays['offsets'], arrays['counts'], arrays['axes'], arrays['order']
+
     @timed
-    def split(cls, box_to_split: TreeBox, n=4):
-        # simple rigid splitting method for now
-        box = box_to_split.box
-        triangles = box_to_split.members
-        splits = [cls.divide_box(box, axis, fraction)
-                  for axis in [0, 1, 2]
-                  for fraction in np.arange(1/n, 1, 1/n)]
-        for triangle in triangles:
-            for lbox, rbox in splits:
-                # arbitrary decision to tiebreak toward left
-                if triangle in lbox:
-                    lbox.add(triangle)
-                elif triangle in rbox:
-                    rbox.add(triangle)
-                else:
-                    logger.error('Triangle %s in neither box')
-        splits = [(lbox, rbox) for lbox, rbox in splits if lbox.members and rbox.members]
-        splits = sorted(splits, key=lambda s: cls.surface_area_heuristic(s))
-
-        if splits:
-            split = splits[0]
-            left, right = AABB(split[0].members), AABB(split[1].members)
-            return left, right
+    def build(self):
+        vertices, colors, materials, emitters = self.vertices, self.colors, self.materials, self.emitters
+        mins, maxes = vertices.min(axis=1), vertices.max(axis=1)
+        if len(vertices):
+            logger.info('root bounding box is from %s to %s', mins.min(axis=0), maxes.max(axis=0))
+
+        path = self.cache_path(vertices) if self.cache_dir is not None else None
+        nodes = self.load_cached(path) if path is not None and os.path.exists(path) else None
+        if nodes is None:
+            if self.spatial_budget > 0:
+                bounds, offsets, counts, axes, order, oversized = build_spatial_nodes(
+                    vertices, self.max_members, self.max_depth, self.n_bins, self.spatial_budget)
+                logger.info('spatial splits added %d triangle references', len(order) - len(vertices))
+            elif self.workers > 1 and len(vertices) >= PARALLEL_BUILD_MIN_TRIANGLES:
+                bounds, offsets, counts, axes, order, oversized = parallel_build_nodes(
+                    mins, maxes, self.max_members, self.max_depth, self.n_bins, self.workers)
+            else:
+                bounds, offsets, counts, axes, order, oversized = build_nodes(mins, maxes, self.max_members,
+                                                                              self.max_depth, self.n_bins)
+            if oversized:
+                logger.info('could not split %d leaves below %d members', oversized, self.max_members)
+            if path is not None:
+                save_arrays(path, {'bounds': bounds, 'offsets': offsets, 'counts': counts, 'axes': axes,
+                                   'order': order}, triangles=len(vertices))
+                logger.info('saved BVH to %s', path)
         else:
-            logger.info('splitting failed on box: %s', box_to_split)
-            return None, None
+            bounds, offsets, counts, axes, order = nodes
+        self.order = order
+
+        triangle_arrays_class, flat_class, _, _ = self.geometry_classes
+        triangles = triangle_arrays_class(vertices[order].astype(self.precision), colors[order], materials[order],
+                                          emitters[order])
+        if self.precision != bounds.dtype:
+            bounds = round_bounds(bounds, self.precision.type, triangles.epsilon)
+        self.flat = flat_class(bounds, offsets, counts, axes, triangles, LightSampler())
+        if len(order) > len(vertices):
+            # triangles referenced from several leaves are still only one light each, whichever slot is hit
+            _, first_slots, triangle_slots = np.unique(order, return_index=True, return_inverse=True)
+            self.flat.first_references = first_slots[triangle_slots]
+            first_references = np.sort(first_slots)
+            self.flat.set_lights(first_references[emitters[order[first_references]]])
+        self.flat.light_sampler.use_tree = self.light_tree
+        self.cost = sah_cost(self.flat)
+        logger.info('BVH has %d nodes and %d triangles, SAH cost %.2f', len(offsets), triangles.count(), self.cost)
+
+    def wide(self, width=BVH_WIDTH):
+        # the tree collapsed to width children per node, sharing this one's triangles
+        child_bounds, children, child_counts = collapse_nodes(self.flat, width)
+        logger.info('collapsed %d binary nodes into %d %d-wide nodes', self.flat.node_count(), len(children), width)
+        _, _, wide_class, _ = self.geometry_classes
+        return wide_class(child_bounds.astype(self.precision, copy=False), children, child_counts, self.flat.triangles,
+                          self.flat.lights, self.flat.light_ids, self.flat.light_sampler)
+
+    def quantized(self, width=BVH_WIDTH):
+        # the wide tree with its child bounds quantized to 8 bits, sharing this one's triangles
+        child_bounds, children, child_counts = collapse_nodes(self.flat, width)
+        origins, exponents, quantized = quantize_nodes(child_bounds)
+        _, _, _, quantized_class = self.geometry_classes
+        return quantized_class(origins, exponents, quantized, children.astype(np.int32), child_counts.astype(np.int32),
+                               self.flat.triangles, self.flat.lights, self.flat.light_ids, self.flat.light_sampler)
+
+    def refit(self, vertices, rebuild_ratio=REFIT_REBUILD_RATIO):
+        # moves the triangles to new vertex positions, given as an (n, 3, 3) array in the original triangle order,
+        # and updates the node bounds in a single pass while keeping the tree's topology. refitted trees degrade
+        # as things move, so once one costs rebuild_ratio times what the last full build did it is rebuilt.
+        # returns whether it was rebuilt, in which case flat is a new object
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(self.vertices.shape)
+        self.flat.triangles.move(self.vertices[self.order])
+        bounds = refit_nodes(self.flat)
+        if self.precision != bounds.dtype:
+            # padded and rounded outwards like a build's, or grazing hits on the triangles could miss their boxes
+            bounds = round_bounds(bounds, self.precision.type, self.flat.triangles.epsilon)
+        self.flat.bounds[:] = bounds
+        self.flat.set_lights(self.flat.lights)
+        cost = sah_cost(self.flat)
+        if cost <= self.cost * rebuild_ratio:
+            return False
+        logger.info('refitted SAH cost %.2f is over %.1f times the built cost %.2f, rebuilding',
+                    cost, rebuild_ratio, self.cost)
+        self.build()
+        return True
+
+
+def affine(transform):
+    # 3x4 affine transform and its inverse from either a 3x4 or a 4x4 matrix
+    matrix = np.eye(4)
+    matrix[:3] = np.asarray(transform, dtype=np.float64)[:3]
+    return matrix[:3].copy(), np.linalg.inv(matrix)[:3].copy()
+
+
+def transformed_bounds(bounds, transform):
+    # world-space box around the eight corners of an object-space box
+    corners = np.array([(bounds[i, 0], bounds[j, 1], bounds[k, 2]) for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+    corners = corners @ transform[:, :3].T + transform[:, 3]
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+class InstanceHierarchy:
+    # two-level BVH over meshes that are each placed any number of times. every mesh gets its own
+    # BoundingVolumeHierarchy, built once however many instances it has, and a top-level tree is built over the
+    # instances' world-space bounds. meshes is a list of triangle lists or Meshes, instances a list of
+    # (mesh index, transform) pairs with 3x4 or 4x4 object-to-world transforms
+    def __init__(self, meshes, instances, max_members=INSTANCE_MAX_MEMBERS, max_depth=BVH_MAX_DEPTH,
+                 n_bins=SAH_BINS, cache_dir=None, light_tree=False):
+        self.meshes = [BoundingVolumeHierarchy(triangles, cache_dir=cache_dir) for triangles in meshes]
+        self.instance_meshes = np.array([mesh for mesh, _ in instances], dtype=np.int64)
+        transforms = [affine(transform) for _, transform in instances]
+        self.transforms = np.array([transform for transform, _ in transforms]).reshape(-1, 3, 4)
+        self.inverses = np.array([inverse for _, inverse in transforms]).reshape(-1, 3, 4)
+        self.max_members = max_members
+        self.max_depth = max_depth
+        self.n_bins = n_bins
+        self.light_tree = light_tree
+        self.order = None
+        self.flat = None
+        self.build()
+
+    @timed
+    def build(self):
+        # instances get sorted into leaf order along with their transforms, like triangles in BoundingVolumeHierarchy
+        mins = np.empty((len(self.instance_meshes), 3))
+        maxes = np.empty((len(self.instance_meshes), 3))
+        for instance, (mesh, transform) in enumerate(zip(self.instance_meshes, self.transforms)):
+            mins[instance], maxes[instance] = transformed_bounds(self.meshes[mesh].flat.bounds[0], transform)
+        bounds, offsets, counts, axes, order, _ = build_nodes(mins, maxes, self.max_members, self.max_depth,
+                                                              self.n_bins)
+        self.order = order
+
+        meshes = TypedList.empty_list(FlatBVH.class_type.instance_type)
+        for mesh in self.meshes:
+            meshes.append(mesh.flat)
+        self.flat = InstancedBVH(bounds, offsets, counts, axes, meshes, self.instance_meshes[order],
+                                 self.transforms[order], self.inverses[order], LightSampler())
+        self.flat.light_sampler.use_tree = self.light_tree
+        logger.info('instanced BVH has %d nodes over %d instances of %d meshes, %d triangles in total',
+                    len(offsets), len(order), len(self.meshes),
+                    sum(self.meshes[mesh].flat.triangles.count() for mesh in self.instance_meshes))
 
 
 def triangles_for_box(box: Box, material=Material.DIFFUSE.value):
@@ -0,0 +1,148 @@
+import cv2
+import logging
+import numba
+import numpy as np
+from primitives import FlatBVH, node_depths
+from collision import closest_hit
+from bvh import surface_area, sah_cost
+from constants import SBVH_BUDGET
+
+logger = logging.getLogger('rtv3-BVH-stats')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+@numba.njit
+def sibling_overlaps(flat: FlatBVH):
+    # surface area of the overlap between the two children of every inner node, 0 for leaves.
+    # rays through an overlap have to visit both children
+    overlaps = np.zeros(flat.node_count())
+    for index in range(flat.node_count()):
+        if flat.is_leaf(index):
+            continue
+        left, right = flat.bounds[index + 1], flat.bounds[flat.offsets[index]]
+        low = np.maximum(left[0], right[0])
+        high = np.minimum(left[1], right[1])
+        if (low < high).all():
+            overlaps[index] = surface_area(low, high)
+    return overlaps
+
+
+def bvh_report(flat: FlatBVH):
+    # summary of a tree's quality, see format_report
+    leaves = flat.counts > 0
+    depths = node_depths(flat.offsets, flat.counts)
+    areas = np.array([surface_area(low, high) for low, high in flat.bounds])
+    overlaps = sibling_overlaps(flat)
+    inner_areas = areas[~leaves]
+    return {
+        'nodes': flat.node_count(),
+        'leaves': int(leaves.sum()),
+        'references': flat.triangles.count(),
+        'sah_cost': sah_cost(flat),
+        'depth': flat.depth,
+        'leaf_depths': np.bincount(depths[leaves]),
+        'leaf_sizes': np.bincount(flat.counts[leaves]),
+        # mean overlap relative to the parent, and the summed overlap relative to the root, which is roughly the
+        # number of extra nodes a random ray hitting the root visits because of it
+        'mean_overlap': float(np.mean(overlaps[~leaves] / np.maximum(inner_areas, 1e-12))) if len(inner_areas) else 0.,
+        'total_overlap': float(overlaps.sum() / areas[0]) if areas[0] > 0 else 0.,
+    }
+
+
+# per-node arrays of each kind of tree, the triangles themselves are shared between them
+NODE_ARRAYS = {
+    'FlatBVH': ('bounds', 'offsets', 'counts', 'axes'),
+    'WideBVH': ('child_bounds', 'children', 'child_counts'),
+    'QuantizedBVH': ('origins', 'exponents', 'child_bounds', 'children', 'child_counts'),
+}
+
+
+def memory_report(bvh):
+    # size of a FlatBVH, WideBVH or QuantizedBVH's nodes, in total, per node and per triangle
+    total = sum(getattr(bvh, name).nbytes for name in NODE_ARRAYS[type(bvh).__name__])
+    return {
+        'node_bytes': total,
+        'bytes_per_node': total / max(bvh.node_count(), 1),
+        'bytes_per_triangle': total / max(bvh.triangles.count(), 1),
+    }
+
+
+def format_memory(report):
+    return '%d bytes of nodes, %.1f per node and %.1f per triangle' % (
+        report['node_bytes'], report['bytes_per_node'], report['bytes_per_triangle'])
+
+
+def histogram_lines(counts, label):
+    peak = max(counts.max(), 1)
+    return ['  %s %3d: %6d %s' % (label, value, count, '#' * int(np.ceil(40 * count / peak)))
+            for value, count in enumerate(counts) if count]
+
+
+def format_report(report):
+    lines = [
+        'nodes %d, leaves %d, triangle references %d' % (report['nodes'], report['leaves'], report['references']),
+        'SAH cost %.2f, depth %d' % (report['sah_cost'], report['depth']),
+        'sibling overlap %.1f%% of the parent on average, %.2f of the root in total' % (
+            100 * report['mean_overlap'], report['total_overlap']),
+        'leaves by depth:',
+    ]
+    lines += histogram_lines(report['leaf_depths'], 'depth')
+    lines.append('leaves by size:')
+    lines += histogram_lines(report['leaf_sizes'], 'size')
+    return '\n'.join(lines)
+
+
+@numba.njit
+def traversal_counts(bvh, origins, directions):
+    # instrumented closest-hit traversal of each ray through a FlatBVH, WideBVH or QuantizedBVH,
+    # returns the hits and the numbers of nodes and triangles tested
+    n = len(origins)
+    hits = np.full(n, -1, dtype=np.int64)
+    nodes = np.zeros(n, dtype=np.int64)
+    tests = np.zeros(n, dtype=np.int64)
+    stack = bvh.stack()
+    counters = np.zeros(2, dtype=np.int64)
+    for k in range(n):
+        inv_direction = 1 / directions[k]
+        sign = (inv_direction < 0).astype(np.uint8)
+        counters[:] = 0
+        hits[k], t = closest_hit(bvh, origins[k], directions[k], inv_direction, sign, np.inf, stack, counters)
+        nodes[k] = counters[0]
+        tests[k] = counters[1]
+    return hits, nodes, tests
+
+
+def camera_traversal_counts(camera, bvh):
+    # nodes and triangles tested for each pixel's primary ray, as two images
+    origins, directions = camera.make_rays(0, camera.pixel_height, 0, camera.pixel_width)
+    _, nodes, tests = traversal_counts(bvh, origins, directions)
+    shape = (camera.pixel_height, camera.pixel_width)
+    return nodes.reshape(shape), tests.reshape(shape)
+
+
+def heatmap_image(counts, scale=None):
+    # counts as a color-mapped image, blue for none through red for scale (the maximum by default).
+    # pass the same scale to compare heatmaps of different trees
+    scale = scale or max(counts.max(), 1)
+    levels = (255 * np.clip(counts / scale, 0, 1)).astype(np.uint8)
+    return cv2.applyColorMap(levels, cv2.COLORMAP_JET)
+
+
+if __name__ == '__main__':
+    from bvh import BoundingVolumeHierarchy, triangles_for_box
+    from camera import Camera
+    from load import load_obj
+    from primitives import point, Box
+    triangles = triangles_for_box(Box(point(-10, -3, -10), point(10, 17, 10))) + [load_obj('../resources/teapot.obj')]
+    camera = Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=320, pixel_height=180, phys_width=16 / 9)
+    for name, options in [('binned', {}), ('spatial', {'spatial_budget': SBVH_BUDGET})]:
+        hierarchy = BoundingVolumeHierarchy(triangles, **options)
+        logger.info('%s BVH\n%s', name, format_report(bvh_report(hierarchy.flat)))
+        for label, bvh in [(name, hierarchy.flat), (name + '_wide', hierarchy.wide()),
+                           (name + '_quantized', hierarchy.quantized())]:
+            logger.info('%s: %s', label, format_memory(memory_report(bvh)))
+            nodes, tests = camera_traversal_counts(camera, bvh)
+            logger.info('%s: %.1f nodes and %.1f triangles tested per primary ray', label, nodes.mean(), tests.mean())
+            cv2.imwrite('../renders/%s_nodes.png' % label, heatmap_image(nodes, 200))
+            cv2.imwrite('../renders/%s_tests.png' % label, heatmap_image(tests, 500))
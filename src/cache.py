@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger('rtv3-cache')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# bump whenever the layout of anything we cache changes, old files then simply stop matching
+CACHE_VERSION = 2
+MAGIC = b'CLV2'
+ALIGNMENT = 64
+
+
+def content_hash(arrays, **params):
+    # hash of array contents plus whatever parameters went into producing the cached result
+    digest = hashlib.sha1()
+    digest.update(json.dumps(dict(params, version=CACHE_VERSION), sort_keys=True).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_arrays(path, arrays, **meta):
+    # file is MAGIC, a little-endian uint64 header length, a json header, then each array at an aligned offset
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': specs}).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + specs[name]['offset'])
+            np.ascontiguousarray(array).tofile(f)
+    # rename is atomic, so concurrent readers see either no file or a complete one
+    os.replace(temp_path, path)
+
+
+def load_arrays(path, mode='c'):
+    # arrays come back memory-mapped. the default copy-on-write mode keeps them writable for numba
+    # without ever touching the file
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a cache file' % path)
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode())
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.asarray(np.memmap(path, dtype=spec['dtype'], mode=mode,
+                                                offset=data_start + spec['offset'], shape=shape))
+    return arrays, header['meta']
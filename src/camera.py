@@ -59,22 +59,53 @@ class Camera:
     def make_ray(self, i, j):
         # was having difficulty making a good mass-ray-generation routine, settled on on-demand
         # speed is fine and it'll be good for future adaptive sampling stuff
-        n1 = np.random.random()
-        n2 = np.random.random()
-        origin = self.origin + self.dx_dp * (j + n1) + self.dy_dp * (i + n2)
-        ray = Ray(origin, unit(self.focal_point - origin))
+        origin, direction = self.sample_pixel(i, j)
+        ray = Ray(origin, direction)
         ray.i = i
         ray.j = j
         return ray
 
+    def sample_pixel(self, i, j):
+        # origin and direction of a jittered ray through pixel i, j
+        n1 = np.random.random()
+        n2 = np.random.random()
+        origin = self.origin + self.dx_dp * (j + n1) + self.dy_dp * (i + n2)
+        return origin, unit(self.focal_point - origin)
+
+    def tile_count(self):
+        return -(-self.pixel_height // TILE_SIZE) * -(-self.pixel_width // TILE_SIZE)
+
+    def tile(self, index):
+        # pixel rows i_start to i_end and columns j_start to j_end of a tile, tiles going row by row
+        columns = -(-self.pixel_width // TILE_SIZE)
+        i_start = index // columns * TILE_SIZE
+        j_start = index % columns * TILE_SIZE
+        return i_start, min(i_start + TILE_SIZE, self.pixel_height), j_start, min(j_start + TILE_SIZE, self.pixel_width)
+
+    def make_rays(self, i_start, i_end, j_start, j_end):
+        # jittered primary rays for a tile of pixels in row-major order, as arrays for packet traversal
+        n = (i_end - i_start) * (j_end - j_start)
+        origins = np.empty((n, 3), dtype=np.float64)
+        directions = np.empty((n, 3), dtype=np.float64)
+        k = 0
+        for i in range(i_start, i_end):
+            for j in range(j_start, j_end):
+                n1 = np.random.random()
+                n2 = np.random.random()
+                origins[k] = self.origin + self.dx_dp * (j + n1) + self.dy_dp * (i + n2)
+                directions[k] = unit(self.focal_point - origins[k])
+                k += 1
+        return origins, directions
+
 
 def composite_image(camera):
+    # the (s, t) images are MIS weighted, so the picture is just their sum
     total_image = camera.image * 0
     for s, row in enumerate(camera.images):
         for t, sub_image in enumerate(row):
-            weighted_sub_image = np.nan_to_num(sub_image) * camera.sample_counts[s][t] / np.sum(camera.sample_counts)
-            total_image += weighted_sub_image
-            cv2.imwrite('../renders/components/%ds_%dt.jpg' % (s, t), tone_map(weighted_sub_image))
+            sub_image = np.nan_to_num(sub_image)
+            total_image += sub_image
+            cv2.imwrite('../renders/components/%ds_%dt.jpg' % (s, t), tone_map(sub_image))
     return tone_map(total_image)
 
 
@@ -1,7 +1,9 @@
-from primitives import Ray, Triangle, Box, BoxStack
+from primitives import Ray, Triangle, TriangleArrays, Box, FlatBVH, WideBVH, QuantizedBVH, InstancedBVH, FlatBVH32, \
+    WideBVH32, QuantizedBVH32, unit, transform_point, transform_vector, as_float64
+import math
 import numpy as np
 import numba
-from constants import COLLISION_SHIFT
+from constants import COLLISION_SHIFT, PACKET_SIZE
 
 
 @numba.jit(nogil=True, fastmath=True)
@@ -36,18 +38,28 @@ def ray_triangle_intersect(ray: Ray, triangle: Triangle):
 
 @numba.jit(nogil=True, fastmath=True)
 def ray_box_intersect(ray: Ray, box: Box):
-    txmin = (box.bounds[ray.sign[0]][0] - ray.origin[0]) * ray.inv_direction[0]
-    txmax = (box.bounds[1 - ray.sign[0]][0] - ray.origin[0]) * ray.inv_direction[0]
-    tymin = (box.bounds[ray.sign[1]][1] - ray.origin[1]) * ray.inv_direction[1]
-    tymax = (box.bounds[1 - ray.sign[1]][1] - ray.origin[1]) * ray.inv_direction[1]
+    return ray_bounds_intersect(ray, box.bounds)
+
+
+@numba.jit(nogil=True, fastmath=True)
+def ray_bounds_intersect(ray: Ray, bounds):
+    return slab_intersect(ray.origin, ray.inv_direction, ray.sign, bounds)
+
+
+@numba.jit(nogil=True, fastmath=True)
+def slab_intersect(origin, inv_direction, sign, bounds):
+    txmin = (bounds[sign[0]][0] - origin[0]) * inv_direction[0]
+    txmax = (bounds[1 - sign[0]][0] - origin[0]) * inv_direction[0]
+    tymin = (bounds[sign[1]][1] - origin[1]) * inv_direction[1]
+    tymax = (bounds[1 - sign[1]][1] - origin[1]) * inv_direction[1]
 
     if txmin > tymax or tymin > txmax:
         return False, 0., 0.
     tmin = max(txmin, tymin)
     tmax = min(txmax, tymax)
 
-    tzmin = (box.bounds[ray.sign[2]][2] - ray.origin[2]) * ray.inv_direction[2]
-    tzmax = (box.bounds[1 - ray.sign[2]][2] - ray.origin[2]) * ray.inv_direction[2]
+    tzmin = (bounds[sign[2]][2] - origin[2]) * inv_direction[2]
+    tzmax = (bounds[1 - sign[2]][2] - origin[2]) * inv_direction[2]
 
     if tmin > tzmax or tzmin > tmax:
         return False, 0., 0.
@@ -60,64 +72,543 @@ def ray_box_intersect(ray: Ray, box: Box):
 
 
 @numba.jit(nogil=True, fastmath=True)
-def bvh_hit_inner(ray: Ray, box: Box, least_t: float):
-    hit, t_low, t_high = ray_box_intersect(ray, box)
-    return hit and t_low <= least_t
+def intersect_leaf(triangles: TriangleArrays, first, count, origin, direction, least_t, any_hit):
+    # Moller-Trumbore with backface culling against a contiguous range of triangles, written out in scalars
+    # so the loop allocates nothing. returns the index and distance of the closest hit nearer than least_t,
+    # or of the first one found if any_hit is set, and (-1, least_t) if there is none. single precision triangles
+    # are read as they are but the arithmetic stays in double
+    ox, oy, oz = origin[0], origin[1], origin[2]
+    dx, dy, dz = direction[0], direction[1], direction[2]
+    least_hit = -1
+    for k in range(first, first + count):
+        normal = triangles.normals[k]
+        if dx * normal[0] + dy * normal[1] + dz * normal[2] >= 0:
+            continue
+        e1 = triangles.e1[k]
+        e2 = triangles.e2[k]
+        hx = dy * e2[2] - dz * e2[1]
+        hy = dz * e2[0] - dx * e2[2]
+        hz = dx * e2[1] - dy * e2[0]
+        a = hx * e1[0] + hy * e1[1] + hz * e1[2]
+        if a <= 0:
+            continue
+        f = 1. / a
+        v0 = triangles.v0[k]
+        sx, sy, sz = ox - v0[0], oy - v0[1], oz - v0[2]
+        u = f * (sx * hx + sy * hy + sz * hz)
+        if u < 0. or u > 1.:
+            continue
+        qx = sy * e1[2] - sz * e1[1]
+        qy = sz * e1[0] - sx * e1[2]
+        qz = sx * e1[1] - sy * e1[0]
+        v = f * (qx * dx + qy * dy + qz * dz)
+        if v < 0. or u + v > 1.:
+            continue
+        t = f * (e2[0] * qx + e2[1] * qy + e2[2] * qz)
+        if triangles.epsilon < t < least_t:
+            least_t = t
+            least_hit = k
+            if any_hit:
+                break
+    return least_hit, least_t
+
+
+@numba.jit(nogil=True)
+def push_children(bvh, index, sign, stack, size):
+    # works on any tree laid out like FlatBVH. the far child goes on first so the near one is popped next.
+    # the left child holds the low side of the split, so it is the near one for rays travelling in the positive
+    # direction along the split axis
+    near, far = index + 1, bvh.offsets[index]
+    if sign[bvh.axes[index]]:
+        near, far = far, near
+    stack[size] = far
+    stack[size + 1] = near
+    return size + 2
+
+
+@numba.jit(nogil=True)
+def facing_each_other(ray_a: Ray, ray_b: Ray):
+    direction = unit(ray_b.origin - ray_a.origin)
+    return np.dot(ray_a.normal, direction) > 0 and np.dot(ray_b.normal, -1 * direction) > 0
+
+
+@numba.jit(nogil=True, fastmath=True)
+def find_occluder(bvh: FlatBVH, origin, direction, max_t, stack):
+    # any-hit traversal, returns the index of the first triangle found closer than max_t, or -1
+    inv_direction = 1 / direction
+    sign = (inv_direction < 0).astype(np.uint8)
+    stack[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        index = stack[size]
+        hit, t_low, t_high = slab_intersect(origin, inv_direction, sign, bvh.bounds[index])
+        if not hit or t_low > max_t:
+            continue
+        if bvh.is_leaf(index):
+            hit, t = intersect_leaf(bvh.triangles, bvh.offsets[index], bvh.counts[index], origin, direction, max_t,
+                                    True)
+            if hit >= 0:
+                return hit
+        else:
+            size = push_children(bvh, index, sign, stack, size)
+    return -1
 
 
 @numba.jit(nogil=True, fastmath=True)
-def bvh_hit_leaf(ray: Ray, box: Box, least_t):
-    hit, t_low, t_high = ray_box_intersect(ray, box)
-    if not hit:
-        return None, least_t
-    least_hit = None
-    for triangle in box.triangles:
-        t = ray_triangle_intersect(ray, triangle)
-        if t is not None and 0 < t < least_t:
-            least_t = t
-            least_hit = triangle
+def closest_triangle(bvh: FlatBVH, origin, direction, inv_direction, sign, least_t, stack, counters=None):
+    # closest-hit traversal, returns the index of the closest triangle nearer than least_t (-1 for none) and its
+    # distance. if counters is given, the number of nodes tested and of triangles tested are added to its first two
+    # entries, numba compiles the counting away entirely when it isn't
+    least_hit = -1
+    stack[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        index = stack[size]
+        if counters is not None:
+            counters[0] += 1
+        # nodes are culled when they are popped, so a far child pushed before a closer hit was found gets skipped
+        hit, t_low, t_high = slab_intersect(origin, inv_direction, sign, bvh.bounds[index])
+        if not hit or t_low > least_t:
+            continue
+        if bvh.is_leaf(index):
+            if counters is not None:
+                counters[1] += bvh.counts[index]
+            hit, t = intersect_leaf(bvh.triangles, bvh.offsets[index], bvh.counts[index], origin, direction, least_t,
+                                    False)
+            if hit >= 0:
+                least_hit = hit
+                least_t = t
+        else:
+            size = push_children(bvh, index, sign, stack, size)
     return least_hit, least_t
 
 
+@numba.njit(nogil=True)
+def closest_instance(scene: InstancedBVH, origin, direction, least_t, stack):
+    # closest-hit traversal of a two-level BVH, returns the instance and triangle of the closest hit nearer than
+    # least_t ((-1, -1) for none) and its distance. the first part of the stack is used for the top-level tree and
+    # the rest for each bottom-level one. rays are moved into object space without normalizing their direction,
+    # which keeps distances the same in both spaces
+    inv_direction = 1 / direction
+    sign = (inv_direction < 0).astype(np.uint8)
+    top = stack[:scene.depth + 1]
+    bottom = stack[scene.depth + 1:]
+    least_instance, least_hit = -1, -1
+    top[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        index = top[size]
+        hit, t_low, t_high = slab_intersect(origin, inv_direction, sign, scene.bounds[index])
+        if not hit or t_low > least_t:
+            continue
+        if not scene.is_leaf(index):
+            size = push_children(scene, index, sign, top, size)
+            continue
+        first = scene.offsets[index]
+        for instance in range(first, first + scene.counts[index]):
+            object_origin = transform_point(scene.inverses[instance], origin)
+            object_direction = transform_vector(scene.inverses[instance], direction)
+            object_inv_direction = 1 / object_direction
+            object_sign = (object_inv_direction < 0).astype(np.uint8)
+            hit, t = closest_triangle(scene.mesh(instance), object_origin, object_direction, object_inv_direction,
+                                      object_sign, least_t, bottom)
+            if hit >= 0:
+                least_instance, least_hit, least_t = instance, hit, t
+    return least_instance, least_hit, least_t
+
+
+@numba.njit(nogil=True)
+def instance_occludes(scene: InstancedBVH, instance, origin, direction, max_t, stack):
+    return find_occluder(scene.mesh(instance), transform_point(scene.inverses[instance], origin),
+                         transform_vector(scene.inverses[instance], direction), max_t, stack) >= 0
+
+
+@numba.njit(nogil=True)
+def find_instance_occluder(scene: InstancedBVH, origin, direction, max_t, stack):
+    # any-hit traversal of a two-level BVH, returns the first instance found to block the segment, or -1
+    inv_direction = 1 / direction
+    sign = (inv_direction < 0).astype(np.uint8)
+    top = stack[:scene.depth + 1]
+    bottom = stack[scene.depth + 1:]
+    top[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        index = top[size]
+        hit, t_low, t_high = slab_intersect(origin, inv_direction, sign, scene.bounds[index])
+        if not hit or t_low > max_t:
+            continue
+        if not scene.is_leaf(index):
+            size = push_children(scene, index, sign, top, size)
+            continue
+        first = scene.offsets[index]
+        for instance in range(first, first + scene.counts[index]):
+            if instance_occludes(scene, instance, origin, direction, max_t, bottom):
+                return instance
+    return -1
+
+
+@numba.jit(nogil=True, fastmath=True)
+def intersect_children(wide: WideBVH, index, origin, inv_direction, sign, least_t, lanes, distances):
+    # slab test of one ray against every child of a wide node, lane by lane over the SoA bounds so it vectorizes.
+    # the lanes hit nearer than least_t and their entry distances go into lanes and distances, returns how many
+    bounds = wide.child_bounds[index]
+    hits = 0
+    for lane in range(wide.width()):
+        t_low = (bounds[sign[0], 0, lane] - origin[0]) * inv_direction[0]
+        t_high = (bounds[1 - sign[0], 0, lane] - origin[0]) * inv_direction[0]
+        t_low = max(t_low, (bounds[sign[1], 1, lane] - origin[1]) * inv_direction[1])
+        t_high = min(t_high, (bounds[1 - sign[1], 1, lane] - origin[1]) * inv_direction[1])
+        t_low = max(t_low, (bounds[sign[2], 2, lane] - origin[2]) * inv_direction[2])
+        t_high = min(t_high, (bounds[1 - sign[2], 2, lane] - origin[2]) * inv_direction[2])
+        if t_low <= t_high and t_high > COLLISION_SHIFT and t_low <= least_t:
+            lanes[hits] = lane
+            distances[hits] = t_low
+            hits += 1
+    return hits
+
+
+@numba.jit(nogil=True, fastmath=True)
+def intersect_quantized_children(quantized: QuantizedBVH, index, origin, inv_direction, sign, least_t, lanes,
+                                 distances):
+    # intersect_children for a QuantizedBVH. each bound is decoded, the node's origin plus that many of its
+    # quantization steps, before the slab test. folding the steps into slab distances instead would multiply by
+    # infinite inverse directions, which is NaN for axis-aligned rays
+    bounds = quantized.child_bounds[index]
+    node_origin = quantized.origins[index]
+    step_x = math.ldexp(1., quantized.exponents[index, 0])
+    step_y = math.ldexp(1., quantized.exponents[index, 1])
+    step_z = math.ldexp(1., quantized.exponents[index, 2])
+    hits = 0
+    for lane in range(quantized.width()):
+        t_low = (node_origin[0] + bounds[sign[0], 0, lane] * step_x - origin[0]) * inv_direction[0]
+        t_high = (node_origin[0] + bounds[1 - sign[0], 0, lane] * step_x - origin[0]) * inv_direction[0]
+        t_low = max(t_low, (node_origin[1] + bounds[sign[1], 1, lane] * step_y - origin[1]) * inv_direction[1])
+        t_high = min(t_high, (node_origin[1] + bounds[1 - sign[1], 1, lane] * step_y - origin[1]) * inv_direction[1])
+        t_low = max(t_low, (node_origin[2] + bounds[sign[2], 2, lane] * step_z - origin[2]) * inv_direction[2])
+        t_high = min(t_high, (node_origin[2] + bounds[1 - sign[2], 2, lane] * step_z - origin[2]) * inv_direction[2])
+        if t_low <= t_high and t_high > COLLISION_SHIFT and t_low <= least_t:
+            lanes[hits] = lane
+            distances[hits] = t_low
+            hits += 1
+    return hits
+
+
+def wide_traversal(intersect):
+    # closest_triangle and find_occluder for a tree whose child boxes are tested by intersect. WideBVH and
+    # QuantizedBVH each get their own pair, dispatching on the tree type per node costs about a quarter of the speed
+    @numba.jit(nogil=True, fastmath=True)
+    def closest(wide, origin, direction, inv_direction, sign, least_t, stack, counters=None):
+        # children are visited nearest first: leaf children are intersected straight away, which can shorten
+        # least_t before the farther ones are looked at, and inner children go on the stack farthest first
+        lanes = np.empty(wide.width(), dtype=np.int64)
+        distances = np.empty(wide.width(), dtype=np.float64)
+        least_hit = -1
+        stack[0] = 0
+        size = 1
+        while size:
+            size -= 1
+            index = stack[size]
+            if counters is not None:
+                counters[0] += 1
+            hits = intersect(wide, index, origin, inv_direction, sign, least_t, lanes, distances)
+            for k in range(1, hits):
+                lane, distance = lanes[k], distances[k]
+                j = k
+                while j > 0 and distances[j - 1] > distance:
+                    lanes[j], distances[j] = lanes[j - 1], distances[j - 1]
+                    j -= 1
+                lanes[j], distances[j] = lane, distance
+
+            for k in range(hits):
+                count = wide.child_counts[index, lanes[k]]
+                if count > 0 and distances[k] <= least_t:
+                    if counters is not None:
+                        counters[1] += count
+                    hit, t = intersect_leaf(wide.triangles, wide.children[index, lanes[k]], count, origin, direction,
+                                            least_t, False)
+                    if hit >= 0:
+                        least_hit = hit
+                        least_t = t
+            for k in range(hits - 1, -1, -1):
+                if wide.is_inner(index, lanes[k]) and distances[k] <= least_t:
+                    stack[size] = wide.children[index, lanes[k]]
+                    size += 1
+        return least_hit, least_t
+
+    @numba.jit(nogil=True, fastmath=True)
+    def occluder(wide, origin, direction, max_t, stack):
+        inv_direction = 1 / direction
+        sign = (inv_direction < 0).astype(np.uint8)
+        lanes = np.empty(wide.width(), dtype=np.int64)
+        distances = np.empty(wide.width(), dtype=np.float64)
+        stack[0] = 0
+        size = 1
+        while size:
+            size -= 1
+            index = stack[size]
+            hits = intersect(wide, index, origin, inv_direction, sign, max_t, lanes, distances)
+            for k in range(hits):
+                count = wide.child_counts[index, lanes[k]]
+                if count > 0:
+                    hit, t = intersect_leaf(wide.triangles, wide.children[index, lanes[k]], count, origin, direction,
+                                            max_t, True)
+                    if hit >= 0:
+                        return hit
+                elif wide.is_inner(index, lanes[k]):
+                    stack[size] = wide.children[index, lanes[k]]
+                    size += 1
+        return -1
+
+    return closest, occluder
+
+
+closest_triangle_wide, find_occluder_wide = wide_traversal(intersect_children)
+closest_triangle_quantized, find_occluder_quantized = wide_traversal(intersect_quantized_children)
+
+
+# both precisions of each kind of tree, for the dispatching functions below
+FLAT_TYPES = (FlatBVH.class_type.instance_type, FlatBVH32.class_type.instance_type)
+WIDE_TYPES = (WideBVH.class_type.instance_type, WideBVH32.class_type.instance_type)
+QUANTIZED_TYPES = (QuantizedBVH.class_type.instance_type, QuantizedBVH32.class_type.instance_type)
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def closest_hit(bvh, origin, direction, inv_direction, sign, least_t, stack, counters):
+    # closest_triangle for a FlatBVH, WideBVH or QuantizedBVH, counters can be None
+    if bvh in QUANTIZED_TYPES:
+        def closest_hit_quantized(bvh, origin, direction, inv_direction, sign, least_t, stack, counters):
+            return closest_triangle_quantized(bvh, origin, direction, inv_direction, sign, least_t, stack, counters)
+        return closest_hit_quantized
+    if bvh in WIDE_TYPES:
+        def closest_hit_wide(bvh, origin, direction, inv_direction, sign, least_t, stack, counters):
+            return closest_triangle_wide(bvh, origin, direction, inv_direction, sign, least_t, stack, counters)
+        return closest_hit_wide
+
+    def closest_hit_flat(bvh, origin, direction, inv_direction, sign, least_t, stack, counters):
+        return closest_triangle(bvh, origin, direction, inv_direction, sign, least_t, stack, counters)
+    return closest_hit_flat
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def closest_surface(bvh, ray):
+    # closest hit of a ray in any kind of BVH, so the renderer works with all of them.
+    # returns whether anything was hit, the distance, and the world-space normal, material, color and emitter flag
+    if bvh == InstancedBVH.class_type.instance_type:
+        def closest_surface_instanced(bvh, ray):
+            instance, hit, t = closest_instance(bvh, ray.origin, ray.direction, np.inf, bvh.stack())
+            if hit < 0:
+                return False, t, ray.direction, 0, ray.direction, False
+            normal, material, color, emitter = bvh.surface(instance, hit)
+            return True, t, normal, material, color, emitter
+        return closest_surface_instanced
+
+    def closest_surface_flat(bvh, ray):
+        hit, t = closest_hit(bvh, ray.origin, ray.direction, ray.inv_direction, ray.sign, np.inf, bvh.stack(), None)
+        if hit < 0:
+            return False, t, ray.direction, 0, ray.direction, False
+        triangles = bvh.triangles
+        return (True, t, as_float64(triangles.normals[hit]), triangles.materials[hit], triangles.colors[hit],
+                triangles.emitters[hit])
+    return closest_surface_flat
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def closest_index(bvh, origin, direction, stack):
+    # closest_surface without looking up the surface, for callers that keep hits around before shading them.
+    # returns the instance (-1 unless bvh is an InstancedBVH) and triangle hit, -1 for a miss, and the distance
+    if bvh == InstancedBVH.class_type.instance_type:
+        def closest_index_instanced(bvh, origin, direction, stack):
+            return closest_instance(bvh, origin, direction, np.inf, stack)
+        return closest_index_instanced
+
+    def closest_index_flat(bvh, origin, direction, stack):
+        inv_direction = 1 / direction
+        hit, t = closest_hit(bvh, origin, direction, inv_direction, (inv_direction < 0).astype(np.uint8), np.inf,
+                             stack, None)
+        return -1, hit, t
+    return closest_index_flat
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def closest_indices(bvh, origins, directions):
+    # closest_index for a batch of rays, returning arrays of instances, hits and distances. binary BVHs trace them
+    # as packets, so rays that are next to each other should be coherent, like a tile's primary rays
+    if bvh in FLAT_TYPES:
+        def closest_indices_packet(bvh, origins, directions):
+            hits, ts = traverse_bvh_packet(bvh, origins, directions)
+            return np.full(len(origins), -1, dtype=np.int64), hits, ts
+        return closest_indices_packet
+
+    def closest_indices_single(bvh, origins, directions):
+        instances = np.full(len(origins), -1, dtype=np.int64)
+        hits = np.full(len(origins), -1, dtype=np.int64)
+        ts = np.full(len(origins), np.inf)
+        stack = bvh.stack()
+        for k in range(len(origins)):
+            instances[k], hits[k], ts[k] = closest_index(bvh, origins[k], directions[k], stack)
+        return instances, hits, ts
+    return closest_indices_single
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def surface_at(bvh, instance, hit):
+    # world-space normal, material, color and emitter flag of a hit found by closest_index
+    if bvh == InstancedBVH.class_type.instance_type:
+        def surface_at_instanced(bvh, instance, hit):
+            return bvh.surface(instance, hit)
+        return surface_at_instanced
+
+    def surface_at_flat(bvh, instance, hit):
+        triangles = bvh.triangles
+        return as_float64(triangles.normals[hit]), triangles.materials[hit], triangles.colors[hit], \
+            triangles.emitters[hit]
+    return surface_at_flat
+
+
+@numba.generated_jit(nopython=True, nogil=True)
+def first_occluder(bvh, origin, direction, max_t, cached, stack):
+    # any-hit test of a segment in any kind of BVH, returns what blocks it or -1. that is an instance index for an
+    # InstancedBVH and a triangle index otherwise, and the cached one from a previous query is tried first
+    if bvh == InstancedBVH.class_type.instance_type:
+        def first_occluder_instanced(bvh, origin, direction, max_t, cached, stack):
+            if cached >= 0 and instance_occludes(bvh, cached, origin, direction, max_t, stack[bvh.depth + 1:]):
+                return cached
+            return find_instance_occluder(bvh, origin, direction, max_t, stack)
+        return first_occluder_instanced
+    if bvh in QUANTIZED_TYPES:
+        def first_occluder_quantized(bvh, origin, direction, max_t, cached, stack):
+            if cached >= 0 and intersect_leaf(bvh.triangles, cached, 1, origin, direction, max_t, True)[0] >= 0:
+                return cached
+            return find_occluder_quantized(bvh, origin, direction, max_t, stack)
+        return first_occluder_quantized
+    if bvh in WIDE_TYPES:
+        def first_occluder_wide(bvh, origin, direction, max_t, cached, stack):
+            if cached >= 0 and intersect_leaf(bvh.triangles, cached, 1, origin, direction, max_t, True)[0] >= 0:
+                return cached
+            return find_occluder_wide(bvh, origin, direction, max_t, stack)
+        return first_occluder_wide
+
+    def first_occluder_flat(bvh, origin, direction, max_t, cached, stack):
+        if cached >= 0 and intersect_leaf(bvh.triangles, cached, 1, origin, direction, max_t, True)[0] >= 0:
+            return cached
+        return find_occluder(bvh, origin, direction, max_t, stack)
+    return first_occluder_flat
+
+
+@numba.njit(nogil=True)
+def occlusion_test_batch(bvh, origins, targets, occluders, keys, visible=None, stack=None):
+    # returns whether each segment from origins[k] to targets[k] is unobstructed, in either kind of BVH.
+    # occluders[keys[k]] remembers the last triangle (or instance) that blocked a query with that key and is tried
+    # before traversing, since the same connection in neighbouring pixels is usually blocked by the same thing.
+    # segments stop just short of their targets so the surface being connected to doesn't block itself.
+    # renderers pass in visible and stack so nothing is allocated per batch
+    if visible is None:
+        visible = np.empty(len(origins), dtype=np.bool_)
+    if stack is None:
+        stack = bvh.stack()
+    epsilon = bvh.epsilon()
+    for k in range(len(origins)):
+        visible[k] = True
+        delta = targets[k] - origins[k]
+        distance = np.linalg.norm(delta)
+        direction = delta / distance
+        max_t = distance - epsilon
+        occluder = first_occluder(bvh, origins[k], direction, max_t, occluders[keys[k]], stack)
+        if occluder >= 0:
+            occluders[keys[k]] = occluder
+            visible[k] = False
+    return visible
+
+
 @numba.njit
-def visibility_test(root: Box, ray_a: Ray, ray_b: Ray):
-    delta = ray_b.origin - ray_a.origin
-    least_t = np.linalg.norm(delta)
-    direction = delta / least_t
-    if np.dot(ray_a.normal, direction) <= 0 or np.dot(ray_b.normal, -1 * direction) <= 0:
+def visibility_test(bvh: FlatBVH, ray_a: Ray, ray_b: Ray):
+    if not facing_each_other(ray_a, ray_b):
         return False
-    test_ray = Ray(ray_a.origin, direction)
-    stack = BoxStack()
-    stack.push(root)
-    while stack.size:
-        box = stack.pop()
-        if box.left is not None and box.right is not None:
-            if bvh_hit_inner(test_ray, box, least_t):
-                stack.push(box.left)
-                stack.push(box.right)
-        else:
-            hit, t = bvh_hit_leaf(test_ray, box, least_t)
-            if hit is not None and t < least_t:
-                return False
-    return True
+    delta = ray_b.origin - ray_a.origin
+    distance = np.linalg.norm(delta)
+    return find_occluder(bvh, ray_a.origin, delta / distance, distance - bvh.epsilon(), bvh.stack()) < 0
 
 
 @numba.njit
-def traverse_bvh(root: Box, ray: Ray):
-    least_t = np.inf
-    least_hit = None
-    stack = BoxStack()
-    stack.push(root)
-    while stack.size:
-        box = stack.pop()
-        if box.left is not None and box.right is not None:
-            if bvh_hit_inner(ray, box, least_t):
-                stack.push(box.left)
-                stack.push(box.right)
-        else:
-            hit, t = bvh_hit_leaf(ray, box, least_t)
-            if hit is not None and t < least_t:
-                least_hit = hit
-                least_t = t
+def traverse_bvh(bvh: FlatBVH, ray: Ray):
+    # returns the index into bvh.triangles of the closest hit (-1 for a miss) and its distance
+    return closest_triangle(bvh, ray.origin, ray.direction, ray.inv_direction, ray.sign, np.inf, bvh.stack())
 
-    return least_hit, least_t
+
+@numba.njit
+def traverse_wide(wide, ray: Ray):
+    # traverse_bvh for a WideBVH or QuantizedBVH
+    return closest_hit(wide, ray.origin, ray.direction, ray.inv_direction, ray.sign, np.inf, wide.stack(), None)
+
+
+@numba.njit
+def traverse_instances(scene: InstancedBVH, ray: Ray):
+    # returns the instance and the index into its mesh's triangles of the closest hit ((-1, -1) for a miss)
+    # and its distance
+    return closest_instance(scene, ray.origin, ray.direction, np.inf, scene.stack())
+
+
+@numba.njit(nogil=True)
+def traverse_packet(bvh: FlatBVH, origins, directions, inv_directions, signs, start, end, hits, least_t):
+    # the packet shares one stack. each entry remembers the first ray that entered the parent, rays before it
+    # cannot enter the children either, so most inner nodes cost a single slab test.
+    # children are ordered by the direction of that first ray
+    active = np.zeros(end - start, dtype=np.bool_)
+    stack = bvh.stack()
+    firsts = bvh.stack()
+    stack[0] = 0
+    firsts[0] = start
+    size = 1
+    while size:
+        size -= 1
+        index = stack[size]
+        first = firsts[size]
+        bounds = bvh.bounds[index]
+        while first < end:
+            hit, t_low, t_high = slab_intersect(origins[first], inv_directions[first], signs[first], bounds)
+            if hit and t_low <= least_t[first]:
+                break
+            first += 1
+        if first == end:
+            # no ray in the packet enters this node
+            continue
+
+        if not bvh.is_leaf(index):
+            firsts[size] = first
+            firsts[size + 1] = first
+            size = push_children(bvh, index, signs[first], stack, size)
+            continue
+        active[:] = False
+        active[first - start] = True
+        for r in range(first + 1, end):
+            hit, t_low, t_high = slab_intersect(origins[r], inv_directions[r], signs[r], bounds)
+            active[r - start] = hit and t_low <= least_t[r]
+        for r in range(first, end):
+            if active[r - start]:
+                hit, t = intersect_leaf(bvh.triangles, bvh.offsets[index], bvh.counts[index], origins[r],
+                                        directions[r], least_t[r], False)
+                if hit >= 0:
+                    least_t[r] = t
+                    hits[r] = hit
+
+
+@numba.njit(nogil=True)
+def traverse_bvh_packet(bvh: FlatBVH, origins, directions, max_t=None):
+    # returns the index into bvh.triangles of the closest hit for each ray (-1 for misses) and its distance.
+    # rays are traversed PACKET_SIZE at a time in the order given, so neighbouring rays should be coherent
+    n = len(origins)
+    hits = np.full(n, -1, dtype=np.int64)
+    if max_t is None:
+        least_t = np.full(n, np.inf)
+    else:
+        least_t = max_t.copy()
+    inv_directions = 1 / directions
+    signs = (inv_directions < 0).astype(np.uint8)
+    for start in range(0, n, PACKET_SIZE):
+        traverse_packet(bvh, origins, directions, inv_directions, signs, start, min(start + PACKET_SIZE, n),
+                        hits, least_t)
+    return hits, least_t
@@ -30,9 +30,55 @@ CYAN = np.array([1., 1., 0.3], dtype=np.float64)
 # BVH constants
 TRAVERSAL_COST = 1
 INTERSECT_COST = 2
+SAH_BINS = 16
+BVH_MAX_MEMBERS = 32
+BVH_MAX_DEPTH = 32
+# instances are far more expensive to test than triangles, so top-level leaves stay small
+INSTANCE_MAX_MEMBERS = 4
+REFIT_REBUILD_RATIO = 1.5
+# children per node of wide BVHs
+BVH_WIDTH = 4
+# float type triangles and BVH bounds are stored in, np.float32 halves their memory
+GEOMETRY_PRECISION = np.float64
+# hits closer than this many units in the last place at the scale of the scene count as self-intersections
+RAY_EPSILON_ULPS = 32
+# quantized nodes don't get steps finer than 2 ** -QUANTIZED_MIN_EXPONENT, which also covers flat boxes
+QUANTIZED_MIN_EXPONENT = 64
+# spatial splits are only tried where an object split's children overlap by more than this fraction of the root's
+# area, and may add at most this fraction of extra triangle references
+SBVH_OVERLAP_RATIO = 1e-5
+SBVH_BUDGET = .3
+# smaller meshes are built on one thread, bigger ones are split into this many subtrees per thread
+PARALLEL_BUILD_MIN_TRIANGLES = 4096
+PARALLEL_BUILD_SUBTREES = 4
 
 # Tracing constants
-MAX_BOUNCES = 2
+# longest path bidirectional renders, in segments from the lens
+MAX_BOUNCES = 4
+# lights emit uniformly over the hemisphere in front of them
+EMISSION_PDF = 1 / (2 * np.pi)
+PACKET_SIZE = 64
+# screens are rendered in parallel in square tiles of this many pixels across
+TILE_SIZE = 16
+# the wavefront renderer keeps this many paths in flight, and works through them this many to a thread at a time
+WAVEFRONT_SIZE = 1 << 14
+WAVEFRONT_CHUNK = 256
+# the light vertex cache joins each camera vertex to this many cached light vertices, and traces its light subpaths
+# this many to a thread at a time
+LIGHT_CACHE_CONNECTIONS = 4
+LIGHT_CACHE_CHUNK = 256
+# luminance of a bgr color, what adaptive sampling measures noise in
+LUMINANCE = np.array([0.0722, 0.7152, 0.2126], dtype=np.float64)
+# adaptive sampling: samples every pixel gets before its variance is trusted, the most any pixel gets, and how many
+# samples per pixel each pass hands out on average
+ADAPTIVE_MIN_SAMPLES = 8
+ADAPTIVE_MAX_SAMPLES = 4096
+ADAPTIVE_PASS_SAMPLES = 4
+# default target for a pixel's standard error relative to its brightness
+ADAPTIVE_TARGET_NOISE = 0.05
+# pixels darker than this fraction of the image's mean are held to the error of one that bright, so noise in
+# near-black pixels doesn't keep them sampling forever
+ADAPTIVE_DARK_FRACTION = 0.1
 
 
 # Bidirectional constants
@@ -1,29 +1,175 @@
-import objloader
+import hashlib
 import logging
+import os
+import re
 import numpy as np
-from primitives import point, Triangle
+from cache import content_hash, save_arrays, load_arrays
 from utils import timed
-from constants import Material
+from constants import Material, WHITE
 
 logger = logging.getLogger('rtv3-loader')
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
+# roughly how many bytes of an OBJ file are parsed at a time
+OBJ_CHUNK_BYTES = 1 << 24
+# texture and normal indices after a face's vertex index, which the loader doesn't use
+FACE_SUFFIX = re.compile(r'/\S*')
+MESH_ARRAYS = ('vertices', 'faces', 'colors', 'materials', 'emitters')
+
+
+class Mesh:
+    # triangles as arrays rather than Triangle objects: an (n, 3) array of vertices, an (m, 3) array of vertex
+    # indices per face, and each face's color, material and emitter flag. BoundingVolumeHierarchy takes these
+    # in place of, or mixed into, a list of triangles. load_obj keeps faces, colors and materials in the smallest
+    # types that hold them, which keeps its cache files small
+    def __init__(self, vertices, faces, colors, materials, emitters):
+        self.vertices = vertices
+        self.faces = faces
+        self.colors = colors
+        self.materials = materials
+        self.emitters = emitters
+
+    def __len__(self):
+        return len(self.faces)
+
+    def triangle_vertices(self):
+        # (m, 3, 3) array of each face's corners
+        return self.vertices[self.faces]
+
+    def bounds(self):
+        if not len(self.vertices):
+            return np.zeros((2, 3))
+        return np.stack((self.vertices.min(axis=0), self.vertices.max(axis=0)))
+
+
+def parse_faces(lines, vertex_counts):
+    # 0-based vertex indices of the triangles in a list of face lines, fanning out polygons from their first corner.
+    # vertex_counts is the number of vertices defined before each line, which negative indices count back from
+    text = FACE_SUFFIX.sub('', '\n'.join(lines))
+    # 'f' can't be parsed as a number and 0 is never a valid index, so it marks where each polygon starts
+    values = np.fromstring(text.replace('f', '0'), dtype=np.int64, sep=' ')
+    starts = np.flatnonzero(values == 0)
+    sizes = np.diff(np.append(starts, len(values))) - 1
+    if (sizes < 3).any():
+        raise ValueError('faces need at least 3 vertices')
+    indices = np.where(values > 0, values - 1, values + np.repeat(vertex_counts, sizes + 1))
+
+    triangle_counts = sizes - 2
+    first = np.repeat(starts + 1, triangle_counts)
+    corner = np.arange(triangle_counts.sum()) - np.repeat(np.cumsum(triangle_counts) - triangle_counts,
+                                                          triangle_counts)
+    return np.stack((indices[first], indices[first + corner + 1], indices[first + corner + 2]), axis=1)
+
+
+def parse_vertices(lines):
+    # (n, 3) positions from a list of vertex lines, ignoring any w or color values after them
+    values = np.fromstring(' '.join(line[2:] for line in lines), sep=' ')
+    if len(values) == 3 * len(lines):
+        return values.reshape(-1, 3)
+    return np.array([line.split()[1:4] for line in lines], dtype=np.float64).reshape(-1, 3)
+
+
+def read_obj(path, chunk_bytes=OBJ_CHUNK_BYTES):
+    # vertex positions and triangulated faces of an OBJ file, read a chunk of lines at a time.
+    # everything other than positions and faces is skipped
+    vertex_chunks, face_chunks = [], []
+    vertex_count = 0
+    with open(path) as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            kinds = np.array([line[:2] for line in lines])
+            is_vertex = (kinds == 'v ') | (kinds == 'v\t')
+            is_face = (kinds == 'f ') | (kinds == 'f\t')
+            vertex_lines = [line for line, keep in zip(lines, is_vertex) if keep]
+            face_lines = [line for line, keep in zip(lines, is_face) if keep]
+            if vertex_lines:
+                vertex_chunks.append(parse_vertices(vertex_lines))
+            if face_lines:
+                vertex_counts = vertex_count + np.cumsum(is_vertex)[is_face]
+                face_chunks.append(parse_faces(face_lines, vertex_counts))
+            vertex_count += len(vertex_lines)
+
+    vertices = np.concatenate(vertex_chunks) if vertex_chunks else np.empty((0, 3))
+    faces = np.concatenate(face_chunks) if face_chunks else np.empty((0, 3), dtype=np.int64)
+    if len(faces) and (faces.min() < 0 or faces.max() >= len(vertices)):
+        raise ValueError('%s has faces referring to vertices that don\'t exist' % path)
+    return vertices, faces
+
+
+def save_mesh(path, mesh, **meta):
+    # a mesh in cache.py's binary format, with a hash of its contents and its bounds in the header
+    arrays = {name: getattr(mesh, name) for name in MESH_ARRAYS}
+    save_arrays(path, arrays, content_hash=content_hash(arrays.values()), bounds=mesh.bounds().tolist(), **meta)
+
+
+def load_mesh(path):
+    # the mesh and header saved by save_mesh. the arrays are memory-mapped, so nothing is read until it's used and
+    # processes loading the same file share its pages
+    arrays, meta = load_arrays(path)
+    return Mesh(*(arrays[name] for name in MESH_ARRAYS)), meta
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(OBJ_CHUNK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def mesh_cache_path(path, cache_dir, **params):
+    # one cache file per model and set of loading parameters
+    key = content_hash([], path=os.path.abspath(path), **params)
+    return os.path.join(cache_dir, '%s.%s.mesh' % (os.path.basename(path), key[:16]))
+
+
+def load_cached_mesh(cache_path, path):
+    # the cached mesh if it was made from the model as it is now. a changed size or modification time means the
+    # model has to be hashed again, but only a changed hash means the cache is stale
+    try:
+        mesh, meta = load_mesh(cache_path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.info('ignoring unreadable mesh cache %s: %s', cache_path, e)
+        return None
+    stat = os.stat(path)
+    if (meta.get('source_size'), meta.get('source_mtime')) != (stat.st_size, stat.st_mtime_ns) and \
+            meta.get('source_hash') != file_hash(path):
+        logger.info('ignoring stale mesh cache %s', cache_path)
+        return None
+    return mesh
+
+
 @timed
-def load_obj(path, material=Material.DIFFUSE.value):
-    obj = objloader.Obj.open(path)
-    logger.info('model %s has %d vertices and %d faces', path, len(obj.vert), len(obj.face)/3)
-    if obj.norm:
-        logger.info('model %s specifies normal vectors', path)
-    if obj.text:
-        logger.info('model %s is texture-mapped', path)
-    # build the vertices and triangles
-    verts = [point(*vert) for vert in obj.vert]
-    triangles = [Triangle(verts[v0 - 1], verts[v1 - 1], verts[v2 - 1], material=material)
-                 for (v0, _, _), (v1, _, _), (v2, _, _) in zip(*[iter(obj.face)]*3)]
-    return triangles
+def load_obj(path, material=Material.DIFFUSE.value, color=WHITE, emitter=False, cache_dir=None):
+    # the model at path as a Mesh. nothing is cached by default. if cache_dir is given, e.g. '../cache/meshes' next
+    # to the BVH cache, the model is also saved there in a binary format on first load, see save_mesh, and later
+    # loads memory-map that instead of parsing the model again
+    params = {'material': material, 'color': [float(c) for c in color], 'emitter': bool(emitter)}
+    cache_path = mesh_cache_path(path, cache_dir, **params) if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        mesh = load_cached_mesh(cache_path, path)
+        if mesh is not None:
+            logger.info('loaded model %s from %s', path, cache_path)
+            return mesh
+
+    stat = os.stat(path)
+    vertices, faces = read_obj(path)
+    logger.info('model %s has %d vertices and %d triangles', path, len(vertices), len(faces))
+    mesh = Mesh(vertices, faces.astype(np.int32), np.tile(np.asarray(color, dtype=np.float32), (len(faces), 1)),
+                np.full(len(faces), material, dtype=np.uint8), np.full(len(faces), emitter, dtype=np.bool_))
+    if cache_path is not None:
+        try:
+            save_mesh(cache_path, mesh, source_size=stat.st_size, source_mtime=stat.st_mtime_ns,
+                      source_hash=file_hash(path), **params)
+            logger.info('saved model %s to %s', path, cache_path)
+        except OSError as e:
+            logger.info('could not cache model %s: %s', path, e)
+    return mesh
 
 
 if __name__ == '__main__':
     teapot = load_obj('resources/teapot.obj')
-    print(len(teapot))
\ No newline at end of file
+    print(len(teapot))
@@ -5,10 +5,13 @@ from utils import timed
 from datetime import datetime
 from bvh import BoundingVolumeHierarchy, triangles_for_box
 from load import load_obj
-from bidirectional import bidirectional_screen_sample
+from bidirectional import bidirectional_screen_sample, light_cache_screen_sample
+from process_render import ProcessRenderer
+from adaptive import AdaptiveSampler
 from unidirectional import unidirectional_screen_sample
 from constants import Material
 from collections import ChainMap
+from itertools import count, takewhile
 
 WINDOW_WIDTH = 160
 WINDOW_HEIGHT = 90
@@ -23,8 +26,16 @@ default_config = {
     'sample_count': 10,
     'primitives': triangles_for_box(Box(point(-10, -3, -10), point(10, 17, 10))),
     'bvh_constructor': BoundingVolumeHierarchy,
+    'bvh_cache_dir': '../cache/bvh',
     'sample_function': unidirectional_screen_sample,
     'postprocess_function': lambda x: tone_map(x.image),
+    # render in this many processes rather than threads, 0 for threads only
+    'processes': 0,
+    # keyword arguments for AdaptiveSampler, e.g. {'target_noise': .05, 'time_budget': 300}, to sample until the
+    # image converges rather than sample_count times. None for fixed passes
+    'adaptive': None,
+    # pick bidirectional's lights for what each pixel sees rather than by power alone, for scenes with many lights
+    'light_tree': False,
 }
 
 bidirectional_config = ChainMap({
@@ -32,24 +43,47 @@ bidirectional_config = ChainMap({
     'postprocess_function': composite_image,
 }, default_config)
 
+# bidirectional with light subpaths shared between pixels
+light_cache_config = ChainMap({
+    'sample_function': light_cache_screen_sample,
+    'postprocess_function': composite_image,
+}, default_config)
+
 
 if __name__ == '__main__':
     cfg = bidirectional_config
     camera = Camera(cfg['cam_center'], cfg['cam_direction'], pixel_height=cfg['window_height'],
                     pixel_width=cfg['window_width'], phys_width=cfg['window_width'] / cfg['window_height'], phys_height=1.)
-    bvh = cfg['bvh_constructor'](cfg['primitives'])
+    postprocess = cfg['postprocess_function']
+    passes = range(cfg['sample_count'])
+    if cfg['processes']:
+        renderer = ProcessRenderer(camera, cfg['primitives'], cfg['sample_function'], cfg['processes'],
+                                   cache_dir=cfg['bvh_cache_dir'], light_tree=cfg['light_tree'])
+        sample = renderer.sample
+    else:
+        bvh = cfg['bvh_constructor'](cfg['primitives'], cache_dir=cfg['bvh_cache_dir'], light_tree=cfg['light_tree'])
+        sample = lambda: cfg['sample_function'](camera, bvh.flat)
+        if cfg['adaptive'] is not None:
+            sampler = AdaptiveSampler(camera, bvh.flat, cfg['sample_function'] is bidirectional_screen_sample,
+                                      **cfg['adaptive'])
+            sample = sampler.sample
+            passes = takewhile(lambda n: not sampler.finished(), count())
+            # the image holds each pixel's mean, the per-(s, t) images aren't weighted for that
+            postprocess = lambda x: tone_map(x.image)
 
     try:
-        for n in range(cfg['sample_count']):
-            cfg['sample_function'](camera, bvh.root.box)
+        for n in passes:
+            sample()
             print('sample', n, 'done')
-            cv2.imshow('render', cfg['postprocess_function'](camera))
+            cv2.imshow('render', postprocess(camera))
             cv2.waitKey(1)
     except KeyboardInterrupt:
         print('stopped early')
     else:
         print('done')
-    cv2.imwrite('../renders/%s.jpg' % datetime.now(), cfg['postprocess_function'](camera))
+    if cfg['processes']:
+        renderer.close()
+    cv2.imwrite('../renders/%s.jpg' % datetime.now(), postprocess(camera))
 
 
 # todo: Feature Schedule
@@ -65,8 +99,7 @@ if __name__ == '__main__':
 #  - Automated tests
 #       - BVH unit tests
 #       - integration tests around paths in a simple scene
-#  - jit OBJ loading and bvh construction, eliminate TreeBox class
-#  - BVH caching
+#  - jit OBJ loading
 #  - fix having to use this .value thing on all the enums. numba is supposed to support them
 #  - requirements.txt
 
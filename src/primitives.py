@@ -19,12 +19,41 @@ def vec(x, y, z):
 def unit(v):
     return v / np.linalg.norm(v)
 
+
+@numba.njit
+def transform_point(matrix, p):
+    # matrix is a 3x4 affine transform, the last column being the translation
+    return transform_vector(matrix, p) + matrix[:, 3]
+
+
+@numba.njit
+def transform_vector(matrix, v):
+    # directions ignore the translation
+    return np.array([matrix[0, 0] * v[0] + matrix[0, 1] * v[1] + matrix[0, 2] * v[2],
+                     matrix[1, 0] * v[0] + matrix[1, 1] * v[1] + matrix[1, 2] * v[2],
+                     matrix[2, 0] * v[0] + matrix[2, 1] * v[1] + matrix[2, 2] * v[2]])
+
+
+@numba.njit
+def transform_normal(inverse, n):
+    # normals go through the inverse transpose so they stay perpendicular under non-uniform scaling
+    return unit(np.array([inverse[0, 0] * n[0] + inverse[1, 0] * n[1] + inverse[2, 0] * n[2],
+                          inverse[0, 1] * n[0] + inverse[1, 1] * n[1] + inverse[2, 1] * n[2],
+                          inverse[0, 2] * n[0] + inverse[1, 2] * n[1] + inverse[2, 2] * n[2]]))
+
+
+@numba.generated_jit(nopython=True)
+def as_float64(v):
+    # v itself if it's float64 already, otherwise a float64 copy. geometry can be stored in single precision but
+    # rays and shading always work in double
+    if v.dtype == numba.float64:
+        return lambda v: v
+    return lambda v: v.astype(np.float64)
+
 # fast primitives
 
 
 ray_type = numba.deferred_type()
-node_type = numba.deferred_type()
-box_type = numba.deferred_type()
 
 
 @numba.experimental.jitclass([
@@ -93,11 +122,7 @@ class Triangle:
         self.color = color.copy()
         self.emitter = emitter
         self.material = material
-        e1_mag = np.linalg.norm(self.e1)
-        e2_mag = np.linalg.norm(self.e2)
-        cos_theta = np.dot(self.e1 / e1_mag, self.e2 / e2_mag)
-        sin_theta = np.sqrt(1 - cos_theta * cos_theta)
-        self.surface_area = np.abs(.5 * np.dot(self.e1, self.e2) * sin_theta)
+        self.surface_area = .5 * np.linalg.norm(np.cross(self.e1, self.e2))
 
     def sample_surface(self):
         r1 = np.random.random()
@@ -108,16 +133,76 @@ class Triangle:
         return self.v0 * u + self.v1 * v + self.v2 * w
 
 
+def triangle_arrays_spec(float_type):
+    return [
+        ('v0', float_type[:, ::1]),
+        ('e1', float_type[:, ::1]),
+        ('e2', float_type[:, ::1]),
+        ('normals', float_type[:, ::1]),
+        ('colors', numba.float64[:, ::1]),
+        ('materials', numba.int64[::1]),
+        ('emitters', numba.boolean[::1]),
+        ('surface_areas', numba.float64[::1]),
+        ('epsilon', numba.float64),
+    ]
+
+
+@numba.experimental.jitclass(triangle_arrays_spec(numba.float64))
+class TriangleArrays:
+    # the same data as Triangle but for many triangles at once, one array per field.
+    # only what intersection and shading need is kept, v1 and v2 are v0 + e1 and v0 + e2.
+    # the geometry is in the precision of the vertices passed in, see TriangleArrays32.
+    # hits closer than epsilon are ignored so rays leaving a surface don't hit it again. it grows with the
+    # precision's rounding error at the scale of the scene, but is never below COLLISION_SHIFT
+    def __init__(self, vertices, colors, materials, emitters):
+        self.v0 = vertices[:, 0].copy()
+        self.e1 = vertices[:, 1] - vertices[:, 0]
+        self.e2 = vertices[:, 2] - vertices[:, 0]
+        self.colors = colors
+        self.materials = materials
+        self.emitters = emitters
+        self.normals = np.empty_like(self.e1)
+        self.surface_areas = np.empty(len(vertices), dtype=np.float64)
+        self.update_normals()
+        self.update_epsilon()
+
+    def move(self, vertices):
+        # new positions for the same triangles, written in place so everything sharing these arrays sees them
+        self.v0[:] = vertices[:, 0]
+        self.e1[:] = vertices[:, 1] - vertices[:, 0]
+        self.e2[:] = vertices[:, 2] - vertices[:, 0]
+        self.update_normals()
+        self.update_epsilon()
+
+    def update_normals(self):
+        for k in range(len(self.v0)):
+            cross = np.cross(self.e1[k], self.e2[k])
+            length = np.linalg.norm(cross)
+            self.normals[k] = cross / length
+            self.surface_areas[k] = .5 * length
+
+    def update_epsilon(self):
+        scale = 1.
+        if len(self.v0):
+            scale = max(scale, np.abs(self.v0).max() + max(np.abs(self.e1).max(), np.abs(self.e2).max()))
+        self.epsilon = max(COLLISION_SHIFT, RAY_EPSILON_ULPS * np.finfo(self.v0.dtype).eps * scale)
+
+    def count(self):
+        return len(self.materials)
+
+    def sample_surface(self, index):
+        r1 = np.random.random()
+        r2 = np.random.random()
+        v = np.sqrt(r1) * (1 - r2)
+        w = r2 * np.sqrt(r1)
+        return as_float64(self.v0[index]) + as_float64(self.e1[index]) * v + as_float64(self.e2[index]) * w
+
+
 @numba.experimental.jitclass([
     ('min', numba.float64[3::1]),
     ('max', numba.float64[3::1]),
     ('bounds', numba.float64[:, ::1]),
     ('span', numba.float64[3::1]),
-    ('left', numba.optional(box_type)),
-    ('right', numba.optional(box_type)),
-    ('triangles', numba.optional(numba.types.ListType(Triangle.class_type.instance_type))),
-    ('lights', numba.optional(numba.types.ListType(Triangle.class_type.instance_type))),
-    ('light_SA', numba.float64),
 ])
 class Box:
     def __init__(self, least_corner, most_corner, color=WHITE):
@@ -125,11 +210,6 @@ class Box:
         self.max = most_corner
         self.bounds = np.stack((least_corner, most_corner))
         self.span = self.max - self.min
-        self.left = None
-        self.right = None
-        self.triangles = None
-        self.lights = None
-        self.light_SA = 0
 
     def contains(self, point: numba.float64[3]):
         return (point >= self.min).all() and (point <= self.max).all()
@@ -144,38 +224,540 @@ class Box:
         return 2 * (self.span[0] * self.span[1] + self.span[1] * self.span[2] + self.span[0] * self.span[2])
 
 
+@numba.njit
+def node_depths(offsets, counts):
+    # depth of every node of a depth-first tree laid out as in FlatBVH. children always come after their parents,
+    # so depths can be filled in a single pass
+    depths = np.zeros(len(offsets), dtype=np.int64)
+    for index in range(len(offsets)):
+        if counts[index] == 0:
+            depths[index + 1] = depths[index] + 1
+            depths[offsets[index]] = depths[index] + 1
+    return depths
+
+
+@numba.njit
+def tree_depth(offsets, counts):
+    return node_depths(offsets, counts).max() if len(offsets) else 0
+
+
+@numba.njit
+def alias_table(weights):
+    # Vose's alias method: picking k uniformly, then keeping it if a uniform number is under thresholds[k] and
+    # taking aliases[k] otherwise, picks each index in proportion to its weight in constant time. also returns the
+    # normalized weights. all zero weights are picked uniformly
+    n = len(weights)
+    total = weights.sum()
+    probabilities = np.full(n, 1 / max(n, 1)) if not total > 0 else weights / total
+    thresholds = np.ones(n, dtype=np.float64)
+    aliases = np.arange(n)
+    scaled = probabilities * n
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    n_small = 0
+    n_large = 0
+    for k in range(n):
+        if scaled[k] < 1:
+            small[n_small] = k
+            n_small += 1
+        else:
+            large[n_large] = k
+            n_large += 1
+    while n_small and n_large:
+        n_small -= 1
+        n_large -= 1
+        less, more = small[n_small], large[n_large]
+        thresholds[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1 - scaled[less]
+        if scaled[more] < 1:
+            small[n_small] = more
+            n_small += 1
+        else:
+            large[n_large] = more
+            n_large += 1
+    # whatever is left over is 1 up to rounding, and keeps itself
+    return probabilities, thresholds, aliases
+
+
+@numba.njit
+def light_tree(lows, highs, powers):
+    # binary tree over lights, split at the median along the longest axis of their centers. laid out like FlatBVH:
+    # depth-first, the left child of an inner node is the next node and offsets holds the right one. leaves have a
+    # count of 1 and offsets holds their light. bounds and powers are those of everything below each node
+    n = len(powers)
+    node_count = max(2 * n - 1, 0)
+    bounds = np.empty((node_count, 2, 3), dtype=np.float64)
+    node_powers = np.zeros(node_count, dtype=np.float64)
+    offsets = np.zeros(node_count, dtype=np.int64)
+    counts = np.zeros(node_count, dtype=np.int64)
+    parents = np.full(node_count, -1, dtype=np.int64)
+    leaves = np.zeros(n, dtype=np.int64)
+    order = np.arange(n)
+    centers = .5 * (lows + highs)
+    # ranges of order still to be made into nodes, with their parent and whether they are its right child
+    stack = np.empty((max(n, 1), 4), dtype=np.int64)
+    size = 0
+    if n:
+        stack[0] = (0, n, -1, 0)
+        size = 1
+    node = 0
+    while size:
+        size -= 1
+        start, end, parent, right = stack[size]
+        parents[node] = parent
+        if right:
+            offsets[parent] = node
+        if end - start == 1:
+            light = order[start]
+            counts[node] = 1
+            offsets[node] = light
+            leaves[light] = node
+            bounds[node, 0] = lows[light]
+            bounds[node, 1] = highs[light]
+            node_powers[node] = powers[light]
+        else:
+            span = np.empty(3)
+            for axis in range(3):
+                span[axis] = centers[order[start:end], axis].max() - centers[order[start:end], axis].min()
+            axis = np.argmax(span)
+            order[start:end] = order[start:end][np.argsort(centers[order[start:end], axis])]
+            middle = (start + end) // 2
+            stack[size] = (middle, end, node, 1)
+            stack[size + 1] = (start, middle, node, 0)
+            size += 2
+        node += 1
+    # children come after their parents
+    for node in range(node_count - 1, -1, -1):
+        if counts[node] == 0:
+            left, right = node + 1, offsets[node]
+            bounds[node, 0] = np.minimum(bounds[left, 0], bounds[right, 0])
+            bounds[node, 1] = np.maximum(bounds[left, 1], bounds[right, 1])
+            node_powers[node] = node_powers[left] + node_powers[right]
+    return bounds, node_powers, offsets, counts, parents, leaves
+
+
 @numba.experimental.jitclass([
-    ('next', numba.optional(node_type)),
-    ('data', box_type),
+    ('v0', numba.float64[:, ::1]),
+    ('e1', numba.float64[:, ::1]),
+    ('e2', numba.float64[:, ::1]),
+    ('normals', numba.float64[:, ::1]),
+    ('colors', numba.float64[:, ::1]),
+    ('areas', numba.float64[::1]),
+    ('area', numba.float64),
+    ('probabilities', numba.float64[::1]),
+    ('thresholds', numba.float64[::1]),
+    ('aliases', numba.int64[::1]),
+    ('node_bounds', numba.float64[:, :, ::1]),
+    ('node_powers', numba.float64[::1]),
+    ('node_offsets', numba.int64[::1]),
+    ('node_counts', numba.int64[::1]),
+    ('parents', numba.int64[::1]),
+    ('leaves', numba.int64[::1]),
+    ('use_tree', numba.boolean),
 ])
-class BoxStackNode:
-    def __init__(self, data):
-        self.data = data
-        self.next = None
+class LightSampler:
+    # picks points on a scene's emitters, each of which is a triangle kept here in world space. lights are picked
+    # in proportion to their power, area times the luminance of their color, with an alias table, and pdfs are the
+    # density of a point over the area of all lights. the light tree picks lights by their estimated contribution
+    # at a given point instead: at each node a child is picked in proportion to its power over its squared distance,
+    # which is no closer than its bounds' radius, so every light with any power can be picked. it is only used by
+    # sample_near and pdf_near, and only if use_tree is set. area is that of all the lights together
+    def __init__(self):
+        self.use_tree = False
+        empty = np.empty((0, 3), dtype=np.float64)
+        self.update(empty, empty, empty, empty, empty)
+
+    def update(self, v0, e1, e2, normals, colors):
+        # new lights, or the same ones moved
+        self.v0 = v0
+        self.e1 = e1
+        self.e2 = e2
+        self.normals = normals
+        self.colors = colors
+        n = len(v0)
+        self.areas = np.empty(n, dtype=np.float64)
+        powers = np.empty(n, dtype=np.float64)
+        lows = np.empty((n, 3), dtype=np.float64)
+        highs = np.empty((n, 3), dtype=np.float64)
+        for k in range(n):
+            self.areas[k] = .5 * np.linalg.norm(np.cross(e1[k], e2[k]))
+            powers[k] = self.areas[k] * max(np.dot(colors[k], LUMINANCE), 0.)
+            lows[k] = np.minimum(v0[k], np.minimum(v0[k] + e1[k], v0[k] + e2[k]))
+            highs[k] = np.maximum(v0[k], np.maximum(v0[k] + e1[k], v0[k] + e2[k]))
+        self.area = self.areas.sum()
+        self.probabilities, self.thresholds, self.aliases = alias_table(powers)
+        self.node_bounds, self.node_powers, self.node_offsets, self.node_counts, self.parents, self.leaves = \
+            light_tree(lows, highs, powers)
+
+    def count(self):
+        return len(self.areas)
+
+    def point(self, light):
+        # a uniformly chosen point on a light, with its normal and color
+        r1 = np.random.random()
+        r2 = np.random.random()
+        v = np.sqrt(r1) * (1 - r2)
+        w = r2 * np.sqrt(r1)
+        return self.v0[light] + self.e1[light] * v + self.e2[light] * w, self.normals[light], self.colors[light]
+
+    def pick(self):
+        light = np.random.randint(0, self.count())
+        if np.random.random() < self.thresholds[light]:
+            return light
+        return self.aliases[light]
+
+    def sample(self):
+        # a point on a light picked by power, with its normal, color and density
+        light = self.pick()
+        point, normal, color = self.point(light)
+        return point, normal, color, self.pdf(light)
+
+    def pdf(self, light):
+        return self.probabilities[light] / self.areas[light]
+
+    def importance(self, node, point):
+        center = .5 * (self.node_bounds[node, 0] + self.node_bounds[node, 1])
+        extent = self.node_bounds[node, 1] - self.node_bounds[node, 0]
+        distance2 = max(np.dot(center - point, center - point), .25 * np.dot(extent, extent), 1e-12)
+        return self.node_powers[node] / distance2
+
+    def left_probability(self, node, point):
+        # chance of going left at an inner node when picking a light for point
+        left = self.importance(node + 1, point)
+        total = left + self.importance(self.node_offsets[node], point)
+        return left / total if total > 0 else .5
+
+    def sample_near(self, point):
+        # sample with lights picked for the light they would give point, if use_tree is set
+        if not self.use_tree:
+            return self.sample()
+        node = 0
+        while self.node_counts[node] == 0:
+            if np.random.random() < self.left_probability(node, point):
+                node = node + 1
+            else:
+                node = self.node_offsets[node]
+        light = self.node_offsets[node]
+        origin, normal, color = self.point(light)
+        return origin, normal, color, self.pdf_near(point, light)
+
+    def pdf_near(self, point, light):
+        # density of sample_near picking a point on light, found by walking up the tree from its leaf
+        if not self.use_tree:
+            return self.pdf(light)
+        probability = 1.
+        node = self.leaves[light]
+        while self.parents[node] >= 0:
+            parent = self.parents[node]
+            left = self.left_probability(parent, point)
+            probability *= left if node == parent + 1 else 1 - left
+            node = parent
+        return probability / self.areas[light]
+
+
+@numba.njit
+def light_geometry(triangles, lights):
+    # the lights among triangles, in double precision for LightSampler.update
+    v0 = np.empty((len(lights), 3), dtype=np.float64)
+    e1 = np.empty((len(lights), 3), dtype=np.float64)
+    e2 = np.empty((len(lights), 3), dtype=np.float64)
+    normals = np.empty((len(lights), 3), dtype=np.float64)
+    colors = np.empty((len(lights), 3), dtype=np.float64)
+    for k in range(len(lights)):
+        v0[k] = as_float64(triangles.v0[lights[k]])
+        e1[k] = as_float64(triangles.e1[lights[k]])
+        e2[k] = as_float64(triangles.e2[lights[k]])
+        normals[k] = as_float64(triangles.normals[lights[k]])
+        colors[k] = triangles.colors[lights[k]]
+    return v0, e1, e2, normals, colors
+
+
+@numba.njit
+def light_ids(lights, first_references):
+    # which light the triangle in each slot is, -1 for those that aren't. lights lists a triangle's first slot, and
+    # first_references gives the first slot of the triangle in every slot
+    ids = np.full(len(first_references), -1, dtype=np.int64)
+    for k in range(len(lights)):
+        ids[lights[k]] = k
+    return ids[first_references]
+
+
+def flat_bvh_spec(float_type, triangle_arrays):
+    return [
+        ('bounds', float_type[:, :, ::1]),
+        ('offsets', numba.int64[::1]),
+        ('counts', numba.int64[::1]),
+        ('axes', numba.int64[::1]),
+        ('depth', numba.int64),
+        ('triangles', triangle_arrays.class_type.instance_type),
+        ('lights', numba.int64[::1]),
+        ('light_ids', numba.int64[::1]),
+        ('first_references', numba.int64[::1]),
+        ('light_sampler', LightSampler.class_type.instance_type),
+    ]
+
+
+@numba.experimental.jitclass(flat_bvh_spec(numba.float64, TriangleArrays))
+class FlatBVH:
+    # nodes are stored depth-first, so the left child of an inner node is always the next node.
+    # for inner nodes offsets holds the index of the right child and counts is 0,
+    # for leaves offsets holds the index of the first triangle and counts the number of triangles.
+    # axes holds the axis inner nodes were split along, the left child being on the low side.
+    # triangles are in leaf order, lights holds the indices of the emissive ones. a triangle can appear in more than
+    # one leaf if the tree was built with spatial splits, lights then only lists it once and first_references gives
+    # the first slot of the triangle in each slot. light_ids maps every slot back to its triangle's index in lights,
+    # and light_sampler, which is filled in here, picks points on them
+    def __init__(self, bounds, offsets, counts, axes, triangles, light_sampler):
+        self.bounds = bounds
+        self.offsets = offsets
+        self.counts = counts
+        self.axes = axes
+        self.triangles = triangles
+        self.light_sampler = light_sampler
+        self.first_references = np.arange(triangles.count())
+        self.set_lights(np.nonzero(triangles.emitters)[0])
+
+        self.depth = tree_depth(offsets, counts)
+
+    def set_lights(self, lights):
+        # also how the light sampler finds out the triangles have moved
+        self.lights = lights
+        self.light_ids = light_ids(lights, self.first_references)
+        v0, e1, e2, normals, colors = light_geometry(self.triangles, lights)
+        self.light_sampler.update(v0, e1, e2, normals, colors)
+
+    def is_leaf(self, index):
+        return self.counts[index] > 0
+
+    def node_count(self):
+        return len(self.offsets)
+
+    def stack(self):
+        # traversal pops one node and pushes at most two, so pending nodes never exceed the depth plus one
+        return np.empty(self.depth + 1, dtype=np.int64)
+
+    def epsilon(self):
+        # closest distance a hit can be at, see TriangleArrays
+        return self.triangles.epsilon
+
+    def sample_light(self):
+        # a point on an emitter picked by power, with the emitter's normal and color and the density of the point
+        # over the area of all lights
+        return self.light_sampler.sample()
+
+    def light_index(self, instance, triangle):
+        # which light in the light sampler a triangle is. instance is ignored, it's there so every BVH can be asked
+        # the same way
+        return self.light_ids[triangle]
+
+
+def wide_bvh_spec(float_type, triangle_arrays):
+    return [
+        ('child_bounds', float_type[:, :, :, ::1]),
+        ('children', numba.int64[:, ::1]),
+        ('child_counts', numba.int64[:, ::1]),
+        ('depth', numba.int64),
+        ('triangles', triangle_arrays.class_type.instance_type),
+        ('lights', numba.int64[::1]),
+        ('light_ids', numba.int64[::1]),
+        ('light_sampler', LightSampler.class_type.instance_type),
+    ]
+
+
+class WideNodes:
+    # what WideBVH and QuantizedBVH have in common, which differ only in how they store child bounds. jitclass copies
+    # methods from base classes, so each gets its own compiled copy
+    def set_nodes(self, children, child_counts, triangles, lights, light_ids, light_sampler):
+        self.children = children
+        self.child_counts = child_counts
+        self.triangles = triangles
+        self.lights = lights
+        self.light_ids = light_ids
+        self.light_sampler = light_sampler
+
+        depths = np.zeros(len(children), dtype=np.int64)
+        for index in range(len(children)):
+            for lane in range(self.width()):
+                if self.is_inner(index, lane):
+                    depths[children[index, lane]] = depths[index] + 1
+        self.depth = depths.max() if len(children) else 0
+
+    def width(self):
+        return self.children.shape[1]
+
+    def node_count(self):
+        return len(self.children)
+
+    def is_inner(self, index, lane):
+        return self.child_counts[index, lane] == 0 and self.children[index, lane] >= 0
+
+    def stack(self):
+        # each pop pushes at most width - 1 more nodes than it removes
+        return np.empty(self.depth * (self.width() - 1) + 1, dtype=np.int64)
+
+    def epsilon(self):
+        return self.triangles.epsilon
+
+    def sample_light(self):
+        return self.light_sampler.sample()
+
+    def light_index(self, instance, triangle):
+        return self.light_ids[triangle]
+
+
+@numba.experimental.jitclass(wide_bvh_spec(numba.float64, TriangleArrays))
+class WideBVH(WideNodes):
+    # BVH with up to width children per node, collapsed from a FlatBVH and sharing its triangles and light sampler.
+    # child_bounds[node, side, axis] holds that bound of all of a node's children side by side, so one ray can be
+    # tested against every child at once. for inner children children holds the child node and child_counts is 0,
+    # for leaf children they hold the first triangle and the number of triangles. unused slots have -1 children
+    # and empty (inf, -inf) bounds that no ray hits. children come after their parents
+    def __init__(self, child_bounds, children, child_counts, triangles, lights, light_ids, light_sampler):
+        self.child_bounds = child_bounds
+        self.set_nodes(children, child_counts, triangles, lights, light_ids, light_sampler)
+
+
+def quantized_bvh_spec(triangle_arrays):
+    return [
+        ('origins', numba.float32[:, ::1]),
+        ('exponents', numba.int8[:, ::1]),
+        ('child_bounds', numba.uint8[:, :, :, ::1]),
+        ('children', numba.int32[:, ::1]),
+        ('child_counts', numba.int32[:, ::1]),
+        ('depth', numba.int64),
+        ('triangles', triangle_arrays.class_type.instance_type),
+        ('lights', numba.int64[::1]),
+        ('light_ids', numba.int64[::1]),
+        ('light_sampler', LightSampler.class_type.instance_type),
+    ]
+
+
+@numba.experimental.jitclass(quantized_bvh_spec(TriangleArrays))
+class QuantizedBVH(WideNodes):
+    # WideBVH with child bounds stored as 8 bit fractions of their node's box, about a quarter of the size.
+    # a node's box starts at origins[node] and is 255 steps of 2 ** exponents[node] long along each axis, and
+    # child_bounds counts the steps to each child's bounds, rounded outwards so decoded boxes only ever grow.
+    # unused slots have a low bound of 255 and a high bound of 0, which decode to empty boxes
+    def __init__(self, origins, exponents, child_bounds, children, child_counts, triangles, lights, light_ids,
+                 light_sampler):
+        self.origins = origins
+        self.exponents = exponents
+        self.child_bounds = child_bounds
+        self.set_nodes(children, child_counts, triangles, lights, light_ids, light_sampler)
+
+
+# the same classes storing geometry and bounds in single precision, which halves their size. they are built by
+# BoundingVolumeHierarchy with precision set to np.float32 and work wherever the double precision ones do
+TriangleArrays32 = numba.experimental.jitclass(triangle_arrays_spec(numba.float32))(TriangleArrays.__bases__[0])
+FlatBVH32 = numba.experimental.jitclass(flat_bvh_spec(numba.float32, TriangleArrays32))(FlatBVH.__bases__[0])
+WideBVH32 = numba.experimental.jitclass(wide_bvh_spec(numba.float32, TriangleArrays32))(WideBVH.__bases__[0])
+QuantizedBVH32 = numba.experimental.jitclass(quantized_bvh_spec(TriangleArrays32))(QuantizedBVH.__bases__[0])
+
+# the geometry classes for each precision
+GEOMETRY_CLASSES = {
+    np.dtype(np.float64): (TriangleArrays, FlatBVH, WideBVH, QuantizedBVH),
+    np.dtype(np.float32): (TriangleArrays32, FlatBVH32, WideBVH32, QuantizedBVH32),
+}
 
 
 @numba.experimental.jitclass([
-    ('head', numba.optional(node_type)),
-    ('size', numba.uint32)
+    ('bounds', numba.float64[:, :, ::1]),
+    ('offsets', numba.int64[::1]),
+    ('counts', numba.int64[::1]),
+    ('axes', numba.int64[::1]),
+    ('depth', numba.int64),
+    ('meshes', numba.types.ListType(FlatBVH.class_type.instance_type)),
+    ('mesh_depth', numba.int64),
+    ('instance_meshes', numba.int64[::1]),
+    ('transforms', numba.float64[:, :, ::1]),
+    ('inverses', numba.float64[:, :, ::1]),
+    ('lights', numba.int64[:, ::1]),
+    ('light_offsets', numba.int64[::1]),
+    ('light_sampler', LightSampler.class_type.instance_type),
 ])
-class BoxStack:
-    def __init__(self):
-        self.head = None
-        self.size = 0
+class InstancedBVH:
+    # two-level BVH. the nodes are laid out like FlatBVH's but leaves hold ranges of instances instead of triangles,
+    # and each instance is a mesh, i.e. a bottom-level FlatBVH in object space, placed by a 3x4 affine transform.
+    # instances are in leaf order, instance_meshes gives each one's mesh and inverses map world space to object space.
+    # lights holds (instance, triangle) pairs for every emitter.
+    # an instance's lights start at light_offsets, in the order of its mesh's, and light_sampler, which is filled in
+    # here, has them all
+    def __init__(self, bounds, offsets, counts, axes, meshes, instance_meshes, transforms, inverses, light_sampler):
+        self.bounds = bounds
+        self.offsets = offsets
+        self.counts = counts
+        self.axes = axes
+        self.meshes = meshes
+        self.instance_meshes = instance_meshes
+        self.transforms = transforms
+        self.inverses = inverses
+        self.depth = tree_depth(offsets, counts)
+        self.mesh_depth = 0
+        for mesh in meshes:
+            self.mesh_depth = max(self.mesh_depth, mesh.depth)
+
+        light_count = 0
+        for instance in range(len(instance_meshes)):
+            light_count += len(meshes[instance_meshes[instance]].lights)
+        self.lights = np.empty((light_count, 2), dtype=np.int64)
+        self.light_offsets = np.empty(len(instance_meshes), dtype=np.int64)
+        v0 = np.empty((light_count, 3), dtype=np.float64)
+        e1 = np.empty((light_count, 3), dtype=np.float64)
+        e2 = np.empty((light_count, 3), dtype=np.float64)
+        normals = np.empty((light_count, 3), dtype=np.float64)
+        colors = np.empty((light_count, 3), dtype=np.float64)
+        k = 0
+        for instance in range(len(instance_meshes)):
+            mesh = meshes[instance_meshes[instance]]
+            self.light_offsets[instance] = k
+            for light in mesh.lights:
+                v0[k] = transform_point(transforms[instance], mesh.triangles.v0[light])
+                e1[k] = transform_vector(transforms[instance], mesh.triangles.e1[light])
+                e2[k] = transform_vector(transforms[instance], mesh.triangles.e2[light])
+                normals[k] = transform_normal(inverses[instance], mesh.triangles.normals[light])
+                colors[k] = mesh.triangles.colors[light]
+                self.lights[k, 0] = instance
+                self.lights[k, 1] = light
+                k += 1
+        self.light_sampler = light_sampler
+        self.light_sampler.update(v0, e1, e2, normals, colors)
+
+    def is_leaf(self, index):
+        return self.counts[index] > 0
+
+    def node_count(self):
+        return len(self.offsets)
+
+    def instance_count(self):
+        return len(self.instance_meshes)
+
+    def stack(self):
+        # room for the top-level traversal followed by room for one bottom-level traversal
+        return np.empty(self.depth + self.mesh_depth + 2, dtype=np.int64)
+
+    def epsilon(self):
+        # the largest of the meshes', which are in object space
+        epsilon = COLLISION_SHIFT
+        for mesh in self.meshes:
+            epsilon = max(epsilon, mesh.epsilon())
+        return epsilon
 
-    def push(self, data):
-        node = BoxStackNode(data)
-        node.next = self.head
-        self.head = node
-        self.size += 1
+    def mesh(self, instance):
+        return self.meshes[self.instance_meshes[instance]]
 
-    def pop(self):
-        old = self.head
-        if old is None:
-            return None
-        self.head = old.next
-        self.size -= 1
-        return old.data
+    def surface(self, instance, hit):
+        # world-space normal, material, color and emitter flag of a triangle of an instance
+        triangles = self.mesh(instance).triangles
+        return (transform_normal(self.inverses[instance], triangles.normals[hit]), triangles.materials[hit],
+                triangles.colors[hit], triangles.emitters[hit])
+
+    def sample_light(self):
+        # same as FlatBVH.sample_light, in world space
+        return self.light_sampler.sample()
+
+    def light_index(self, instance, triangle):
+        return self.light_offsets[instance] + self.mesh(instance).light_ids[triangle]
 
 
 @numba.experimental.jitclass([
@@ -191,6 +773,175 @@ class Path:
         self.direction = direction
 
 
-node_type.define(BoxStackNode.class_type.instance_type)
-box_type.define(Box.class_type.instance_type)
+@numba.experimental.jitclass([
+    ('origins', numba.float64[:, ::1]),
+    ('directions', numba.float64[:, ::1]),
+    ('throughputs', numba.float64[:, ::1]),
+    ('radiance', numba.float64[:, ::1]),
+    ('pixels', numba.int64[::1]),
+    ('bounces', numba.int64[::1]),
+    ('alive', numba.boolean[::1]),
+    ('instances', numba.int64[::1]),
+    ('hits', numba.int64[::1]),
+    ('distances', numba.float64[::1]),
+    ('size', numba.int64),
+])
+class PathArrays:
+    # the state of a batch of camera paths for the wavefront renderer, one array per field rather than a chain of
+    # Rays per path. the first size entries are in flight: each has the ray it is about to trace, the color it has
+    # been filtered by so far, the light it has gathered and the pixel it belongs to. hits, instances and distances
+    # hold the last intersection stage's results. methods on these are in wavefront.py
+    def __init__(self, capacity):
+        self.origins = np.empty((capacity, 3), dtype=np.float64)
+        self.directions = np.empty((capacity, 3), dtype=np.float64)
+        self.throughputs = np.empty((capacity, 3), dtype=np.float64)
+        self.radiance = np.empty((capacity, 3), dtype=np.float64)
+        self.pixels = np.empty(capacity, dtype=np.int64)
+        self.bounces = np.empty(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=np.bool_)
+        self.instances = np.full(capacity, -1, dtype=np.int64)
+        self.hits = np.full(capacity, -1, dtype=np.int64)
+        self.distances = np.empty(capacity, dtype=np.float64)
+        self.size = 0
+
+    def capacity(self):
+        return len(self.pixels)
+
+    def move(self, source, target):
+        # copies path source into slot target
+        self.origins[target] = self.origins[source]
+        self.directions[target] = self.directions[source]
+        self.throughputs[target] = self.throughputs[source]
+        self.radiance[target] = self.radiance[source]
+        self.pixels[target] = self.pixels[source]
+        self.bounces[target] = self.bounces[source]
+        self.alive[target] = self.alive[source]
+
+
+@numba.experimental.jitclass([
+    ('origins', numba.float64[:, ::1]),
+    ('directions', numba.float64[:, ::1]),
+    ('normals', numba.float64[:, ::1]),
+    ('materials', numba.int64[::1]),
+    ('local_colors', numba.float64[:, ::1]),
+    ('incidents', numba.float64[:, ::1]),
+    ('throughputs', numba.float64[:, ::1]),
+    ('lengths', numba.int64[::1]),
+    ('G', numba.float64[::1]),
+    ('pdf_forward', numba.float64[::1]),
+    ('pdf_reverse', numba.float64[::1]),
+    ('dVCM', numba.float64[::1]),
+    ('dVC', numba.float64[::1]),
+    ('light_pdfs', numba.float64[::1]),
+    ('light_ids', numba.int64[::1]),
+    ('hit_light', numba.boolean[::1]),
+    ('size', numba.int64),
+])
+class VertexArrays:
+    # a bidirectional subpath, one array per Ray field, that is allocated once and refilled for every pixel.
+    # vertex 0 is on the lens or the light and the first size entries are in use. incidents point back to the vertex
+    # before and lengths count the vertices up to and including each, which places a vertex in its subpath even
+    # once it has been copied somewhere else, as LightCacheRenderer does. throughputs are the subpath's color over
+    # its probability up to but not including each vertex, G is the geometry term from the vertex before,
+    # pdf_forward the pdf of the direction sampled leaving each vertex and pdf_reverse that of the direction back to
+    # the vertex before, as if the path were traced the other way. dVCM and dVC are the running sums the MIS weights
+    # are built from, see extend_subpath. light_pdfs is the area density of the light vertex having been picked and
+    # light_ids the light in the BVH's light sampler of vertices that hit one. methods on these are in
+    # bidirectional.py
+    def __init__(self, capacity):
+        self.origins = np.zeros((capacity, 3), dtype=np.float64)
+        self.directions = np.zeros((capacity, 3), dtype=np.float64)
+        self.normals = np.zeros((capacity, 3), dtype=np.float64)
+        self.materials = np.zeros(capacity, dtype=np.int64)
+        self.local_colors = np.zeros((capacity, 3), dtype=np.float64)
+        self.incidents = np.zeros((capacity, 3), dtype=np.float64)
+        self.throughputs = np.zeros((capacity, 3), dtype=np.float64)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.G = np.zeros(capacity, dtype=np.float64)
+        self.pdf_forward = np.zeros(capacity, dtype=np.float64)
+        self.pdf_reverse = np.zeros(capacity, dtype=np.float64)
+        self.dVCM = np.zeros(capacity, dtype=np.float64)
+        self.dVC = np.zeros(capacity, dtype=np.float64)
+        self.light_pdfs = np.zeros(capacity, dtype=np.float64)
+        self.light_ids = np.full(capacity, -1, dtype=np.int64)
+        self.hit_light = np.zeros(capacity, dtype=np.bool_)
+        self.size = 0
+
+    def start(self, origin, direction, normal, color, throughput, light_pdf, pdf, dVCM, dVC):
+        # vertex 0, with the defaults a new Ray has for everything else. pdf is that of direction, and dVCM and dVC
+        # are the sums as they are leaving it
+        self.origins[0] = origin
+        self.directions[0] = direction
+        self.normals[0] = normal
+        self.materials[0] = Material.SPECULAR.value
+        self.local_colors[0] = color
+        self.incidents[0] = 0
+        self.throughputs[0] = throughput
+        self.lengths[0] = 1
+        self.G[0] = 1
+        self.pdf_forward[0] = pdf
+        self.pdf_reverse[0] = 1
+        self.dVCM[0] = dVCM
+        self.dVC[0] = dVC
+        self.light_pdfs[0] = light_pdf
+        self.light_ids[0] = -1
+        self.hit_light[0] = False
+        self.size = 1
+
+    def copy(self, source_vertices, source, target):
+        # copies vertex source of source_vertices, which can be these, into slot target
+        self.origins[target] = source_vertices.origins[source]
+        self.directions[target] = source_vertices.directions[source]
+        self.normals[target] = source_vertices.normals[source]
+        self.materials[target] = source_vertices.materials[source]
+        self.local_colors[target] = source_vertices.local_colors[source]
+        self.incidents[target] = source_vertices.incidents[source]
+        self.throughputs[target] = source_vertices.throughputs[source]
+        self.lengths[target] = source_vertices.lengths[source]
+        self.G[target] = source_vertices.G[source]
+        self.pdf_forward[target] = source_vertices.pdf_forward[source]
+        self.pdf_reverse[target] = source_vertices.pdf_reverse[source]
+        self.dVCM[target] = source_vertices.dVCM[source]
+        self.dVC[target] = source_vertices.dVC[source]
+        self.light_pdfs[target] = source_vertices.light_pdfs[source]
+        self.light_ids[target] = source_vertices.light_ids[source]
+        self.hit_light[target] = source_vertices.hit_light[source]
+
+
+@numba.experimental.jitclass([
+    ('origins', numba.float64[:, ::1]),
+    ('targets', numba.float64[:, ::1]),
+    ('colors', numba.float64[:, ::1]),
+    ('light_lengths', numba.int64[::1]),
+    ('camera_lengths', numba.int64[::1]),
+    ('keys', numba.int64[::1]),
+    ('visible', numba.boolean[::1]),
+    ('size', numba.int64),
+])
+class ConnectionArrays:
+    # the connections of one pixel waiting on their shadow rays, so those can be tested in one batch. each joins a
+    # camera vertex at origins to a light vertex at targets and makes a sample of colors in the (s, t) image of
+    # light_lengths and camera_lengths, keys are their slots in the occluder cache. methods on these are in
+    # bidirectional.py
+    def __init__(self, capacity):
+        self.origins = np.zeros((capacity, 3), dtype=np.float64)
+        self.targets = np.zeros((capacity, 3), dtype=np.float64)
+        self.colors = np.zeros((capacity, 3), dtype=np.float64)
+        self.light_lengths = np.zeros(capacity, dtype=np.int64)
+        self.camera_lengths = np.zeros(capacity, dtype=np.int64)
+        self.keys = np.zeros(capacity, dtype=np.int64)
+        self.visible = np.zeros(capacity, dtype=np.bool_)
+        self.size = 0
+
+    def add(self, origin, target, color, s, t):
+        k = self.size
+        self.origins[k] = origin
+        self.targets[k] = target
+        self.colors[k] = color
+        self.light_lengths[k] = s
+        self.camera_lengths[k] = t
+        self.keys[k] = s * (MAX_BOUNCES + 2) + t
+        self.size = k + 1
+
+
 ray_type.define(Ray.class_type.instance_type)
@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from bvh import BoundingVolumeHierarchy, scene_mesh
+from camera import Camera
+from bidirectional import bidirectional_screen_sample, bidirectional_tile_sample
+from unidirectional import unidirectional_screen_sample, unidirectional_tile_sample
+from utils import seed_random, random_seed
+from constants import MAX_BOUNCES
+
+logger = logging.getLogger('rtv3-processes')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# screen sample functions that can be run in processes, by the names workers know them by
+SAMPLE_FUNCTIONS = {
+    bidirectional_screen_sample: 'bidirectional',
+    unidirectional_screen_sample: 'unidirectional',
+}
+
+# what each worker process holds, set up once by init_worker
+worker = {}
+
+
+class SharedArray:
+    # a numpy array in a shared memory block. other processes attach to the same block by name,
+    # and writes from any of them are seen by all
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+            self.array[:] = 0
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    def spec(self):
+        # what another process needs to attach to it
+        return self.shape, self.dtype.str, self.memory.name
+
+    def close(self, unlink=False):
+        self.array = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def camera_spec(camera: Camera):
+    # the arguments that make an identical camera in another process
+    return (camera.center.copy(), camera.direction.copy(), camera.phys_width, camera.phys_height, camera.pixel_width,
+            camera.pixel_height)
+
+
+def init_worker(mesh, bvh_options, camera_args, function, shared_specs):
+    # every worker builds its own BVH and camera, and points the camera's images at the shared ones
+    shared = {name: SharedArray(shape, dtype, memory) for name, (shape, dtype, memory) in shared_specs.items()}
+    camera = Camera(*camera_args)
+    camera.image = shared['image'].array
+    camera.images = shared['images'].array
+    worker.update(shared=shared, camera=camera, function=function,
+                  bvh=BoundingVolumeHierarchy(mesh, **bvh_options).flat)
+
+
+def render_tile(task):
+    # one tile of one pass, seeded so that it doesn't matter which worker gets it
+    tile, seed, samples = task
+    seed_random(seed)
+    if worker['function'] == 'bidirectional':
+        bidirectional_tile_sample(worker['camera'], worker['bvh'], tile, worker['shared']['tile_counts'].array[tile])
+    else:
+        unidirectional_tile_sample(worker['camera'], worker['bvh'], tile, samples)
+
+
+class ProcessRenderer:
+    # renders screen samples for a camera in a pool of processes, for when threads don't scale. the camera's image
+    # and images are moved into shared memory, where workers write their tiles directly, so the parent only has to
+    # add up sample counts. tiles are handed out a pass at a time, so no two workers ever write the same pixel.
+    # use it as a context manager, or call close, to get the camera's images back out of shared memory
+    def __init__(self, camera: Camera, scene, sample_function=bidirectional_screen_sample, processes=None,
+                 **bvh_options):
+        self.camera = camera
+        self.function = SAMPLE_FUNCTIONS[sample_function]
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shared = {
+            'image': SharedArray(camera.image.shape, np.float64),
+            'images': SharedArray(camera.images.shape, np.float64),
+            'tile_counts': SharedArray((camera.tile_count(), MAX_BOUNCES + 2, MAX_BOUNCES + 2), np.int64),
+        }
+        self.shared['image'].array[:] = camera.image
+        self.shared['images'].array[:] = camera.images
+        camera.image = self.shared['image'].array
+        camera.images = self.shared['images'].array
+        shared_specs = {name: shared.spec() for name, shared in self.shared.items()}
+        # workers are spawned rather than forked, a fork of a process whose numba thread pool is running deadlocks
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            self.processes, initializer=init_worker,
+            initargs=(scene_mesh(scene), bvh_options, camera_spec(camera), self.function, shared_specs))
+        logger.info('rendering %s samples in %d processes', self.function, self.processes)
+
+    def sample(self, samples=5):
+        # one pass over the screen, like calling the sample function. samples only applies to unidirectional.
+        # tiles are seeded as the sample function seeds them, so the same seed renders the same image
+        tile_counts = self.shared['tile_counts'].array
+        tile_counts[:] = 0
+        seed = random_seed()
+        tasks = [(tile, seed + tile, samples) for tile in range(self.camera.tile_count())]
+        for _ in self.pool.imap_unordered(render_tile, tasks):
+            pass
+        seed_random(seed + self.camera.tile_count())
+        if self.function == 'bidirectional':
+            self.camera.sample_counts += tile_counts.sum(axis=0)
+            self.camera.samples += 1
+        else:
+            self.camera.sample_counts += samples
+            self.camera.samples += samples
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.camera.image = self.shared['image'].array.copy()
+        self.camera.images = self.shared['images'].array.copy()
+        for shared in self.shared.values():
+            shared.close(unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,16 +1,21 @@
 import numba
 import numpy as np
 from constants import *
-from primitives import Ray, Path, Triangle, Box, BoxStack, unit
+from primitives import Ray, Path, Triangle, FlatBVH, unit
 from utils import timed
-from collision import traverse_bvh
+from collision import closest_surface
 
 
 @numba.njit
-def generate_path(root: Box, ray: Ray, direction, max_bounces=4, rr_chance=0.1, stop_for_light=False):
-    path = Path(ray, direction)
+def generate_path(bvh, ray: Ray, direction, max_bounces=4, rr_chance=0.1, stop_for_light=False):
+    return continue_path(Path(ray, direction), bvh, max_bounces, rr_chance, stop_for_light)
+
+
+@numba.njit
+def continue_path(path: Path, bvh, max_bounces=4, rr_chance=0.1, stop_for_light=False):
+    # generate_path for a path that has been started already, like from a first hit found by packet traversal
     while path.ray.bounces < max_bounces: # or np.random.random() < rr_chance:
-        hit = extend_path(path, root)
+        hit = extend_path(path, bvh)
         if not hit:
             break
         if path.ray.prev.bounces >= max_bounces:
@@ -21,26 +26,31 @@ def generate_path(root: Box, ray: Ray, direction, max_bounces=4, rr_chance=0.1,
 
 
 @numba.njit
-def extend_path(path: Path, root: Box):
-    triangle, t = traverse_bvh(root, path.ray)
-    if triangle is not None:
-        # generate new ray
-        new_origin = path.ray.origin + path.ray.direction * t
-        new_direction = BRDF_sample(triangle.material, -1 * path.ray.direction, triangle.normal, path.direction)
-        new_ray = Ray(new_origin, new_direction)
-        new_ray.normal = triangle.normal
-        new_ray.material = triangle.material
-        new_ray.local_color = triangle.color
-        if triangle.emitter:
-            path.hit_light = True
-
-        path_push(path, new_ray)
+def extend_path(path: Path, bvh):
+    hit, t, normal, material, color, emitter = closest_surface(bvh, path.ray)
+    if hit:
+        push_hit(path, t, normal, material, color, emitter)
         # if path_health_check(path):
         return True
     else:
         return False
 
 
+@numba.njit
+def push_hit(path: Path, t, normal, material, color, emitter):
+    # the bounce off a surface the path's ray hits at distance t
+    new_origin = path.ray.origin + path.ray.direction * t
+    new_direction = BRDF_sample(material, -1 * path.ray.direction, normal, path.direction)
+    new_ray = Ray(new_origin, new_direction)
+    new_ray.normal = normal
+    new_ray.material = material
+    new_ray.local_color = color
+    if emitter:
+        path.hit_light = True
+
+    path_push(path, new_ray)
+
+
 def path_health_check(path: Path):
     ray = path.ray
     after = None
@@ -187,31 +197,48 @@ def BRDF_pdf(material, incident_direction, incident_normal, exitant_direction, p
 def geometry_term(a: Ray, b: Ray):
     # quantifies the probability of connecting two specific vertices.
     # used when joining paths in bidirectional
-    delta = b.origin - a.origin
+    return geometry(a.origin, a.normal, b.origin, b.normal)
+
+
+@numba.njit
+def geometry(a_origin, a_normal, b_origin, b_normal):
+    # geometry_term of two vertices given as arrays
+    delta = b_origin - a_origin
     t = np.linalg.norm(delta)
     direction = delta / t
 
-    camera_cos = np.dot(a.normal, direction)
-    light_cos = np.dot(b.normal, -1 * direction)
+    camera_cos = np.dot(a_normal, direction)
+    light_cos = np.dot(b_normal, -1 * direction)
 
     return np.abs(camera_cos * light_cos) / (t * t)
 
 
 @numba.njit
-def generate_light_ray(box: Box):
-    light_index = np.random.randint(0, len(box.lights))
-    light = box.lights[light_index]
-    light_origin = light.sample_surface()
-    x, y, z = local_orthonormal_system(light.normal)
-    light_direction = random_hemisphere_uniform_weighted(x, y, z)
+def generate_light_ray(bvh):
+    light_origin, light_direction, normal, color, light_pdf, direction_pdf = sample_light_ray(bvh)
     ray = Ray(light_origin, light_direction)
-    ray.color = light.color
-    ray.local_color = light.color
-    ray.normal = light.normal
-    ray.p = 1 / (2 * np.pi * light.surface_area)
+    ray.color = color
+    ray.local_color = color
+    ray.normal = normal
+    ray.p = light_pdf * direction_pdf
     return ray
 
 
+@numba.njit
+def sample_light_ray(bvh):
+    # origin, direction, normal and color of a ray leaving a random point on a light, with the area density of the
+    # point and the solid angle density of the direction
+    light_origin, normal, color, light_pdf = bvh.sample_light()
+    return light_origin, emission_direction(normal), normal, color, light_pdf, EMISSION_PDF
+
+
+@numba.njit
+def emission_direction(normal):
+    # a direction leaving a light with this normal, with density EMISSION_PDF
+    x, y, z = local_orthonormal_system(normal)
+    return random_hemisphere_uniform_weighted(x, y, z)
+
+
 if __name__ == '__main__':
     while True:
         x, y, z, = UNIT_X, UNIT_Y, UNIT_Z
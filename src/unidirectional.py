@@ -1,23 +1,46 @@
 from camera import Camera
-from primitives import Box, Path
-from routines import generate_path
+from primitives import FlatBVH, Path, Ray
+from routines import continue_path, push_hit
+from collision import closest_indices, surface_at
 from constants import *
 import numba
+import numpy as np
 from utils import timed
 
 
 @timed
-@numba.njit
-def unidirectional_screen_sample(camera: Camera, root: Box, samples=5):
-    for _ in range(samples):
-        for i in range(camera.pixel_height):
-            for j in range(camera.pixel_width):
-                camera_path = generate_path(root, camera.make_ray(i, j), Direction.FROM_CAMERA.value, stop_for_light=True)
-                camera.image[i][j] += unidirectional_sample(camera_path)
+@numba.njit(parallel=True)
+def unidirectional_screen_sample(camera: Camera, bvh, samples=5):
+    # tiles are rendered in parallel, see bidirectional_screen_sample
+    seed = np.random.randint(0, 2 ** 30)
+    for tile in numba.prange(camera.tile_count()):
+        np.random.seed(seed + tile)
+        unidirectional_tile_sample(camera, bvh, tile, samples)
+    np.random.seed(seed + camera.tile_count())
     camera.sample_counts += samples
     camera.samples += samples
 
 
+@numba.njit(nogil=True)
+def unidirectional_tile_sample(camera: Camera, bvh, tile, samples):
+    # a tile's primary rays are coherent, so their first hits are found together, in packets where the BVH allows
+    i_start, i_end, j_start, j_end = camera.tile(tile)
+    for _ in range(samples):
+        origins, directions = camera.make_rays(i_start, i_end, j_start, j_end)
+        instances, hits, ts = closest_indices(bvh, origins, directions)
+        k = 0
+        for i in range(i_start, i_end):
+            for j in range(j_start, j_end):
+                camera_path = Path(Ray(origins[k], directions[k]), Direction.FROM_CAMERA.value)
+                if hits[k] >= 0:
+                    normal, material, color, emitter = surface_at(bvh, instances[k], hits[k])
+                    push_hit(camera_path, ts[k], normal, material, color, emitter)
+                    if not camera_path.hit_light:
+                        continue_path(camera_path, bvh, stop_for_light=True)
+                camera.image[i][j] += unidirectional_sample(camera_path)
+                k += 1
+
+
 @numba.njit
 def unidirectional_sample(camera_path: Path):
     if not camera_path.hit_light:
@@ -18,6 +18,18 @@ def timed(func):
     return decorated
 
 
+@numba.njit
+def seed_random(seed):
+    # numba keeps its own random state, np.random.seed outside of jitted code doesn't touch it
+    np.random.seed(seed)
+
+
+@numba.njit
+def random_seed():
+    # a seed for a pass's tiles drawn from numba's random state, as the screen sample functions draw theirs
+    return np.random.randint(0, 2 ** 30)
+
+
 @numba.njit
 def dir_to_color(direction):
     return .5 + unit(direction) / 2
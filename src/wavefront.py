@@ -0,0 +1,136 @@
+from camera import Camera
+from primitives import PathArrays
+from routines import BRDF_sample, BRDF_function, BRDF_pdf
+from collision import closest_index, surface_at
+from constants import *
+import numba
+import numpy as np
+from utils import timed
+
+
+@numba.njit
+def chunk_count(n):
+    return -(-n // WAVEFRONT_CHUNK)
+
+
+@numba.njit(parallel=True)
+def generate_paths(camera: Camera, paths: PathArrays, first_sample, end_sample):
+    # starts camera paths in the free slots after paths.size for samples first_sample onwards, as many as fit.
+    # sample s is of pixel s % pixel count, so each pass over the screen goes row by row and neighbouring slots
+    # hold neighbouring pixels. returns how many were started. chunks seed their random numbers like tiles do in
+    # bidirectional_screen_sample
+    count = min(paths.capacity() - paths.size, end_sample - first_sample)
+    pixel_count = camera.pixel_width * camera.pixel_height
+    seed = np.random.randint(0, 2 ** 30)
+    for chunk in numba.prange(chunk_count(count)):
+        np.random.seed(seed + chunk)
+        for k in range(chunk * WAVEFRONT_CHUNK, min((chunk + 1) * WAVEFRONT_CHUNK, count)):
+            slot = paths.size + k
+            pixel = (first_sample + k) % pixel_count
+            i = pixel // camera.pixel_width
+            j = pixel % camera.pixel_width
+            origin, direction = camera.sample_pixel(i, j)
+            paths.origins[slot] = origin
+            paths.directions[slot] = direction
+            paths.throughputs[slot] = 1.
+            paths.radiance[slot] = 0.
+            paths.pixels[slot] = pixel
+            paths.bounces[slot] = 0
+            paths.alive[slot] = True
+    np.random.seed(seed + chunk_count(count))
+    paths.size += count
+    return count
+
+
+@numba.njit(parallel=True)
+def intersect_paths(bvh, paths: PathArrays):
+    # closest hit of every path in flight
+    for chunk in numba.prange(chunk_count(paths.size)):
+        stack = bvh.stack()
+        for k in range(chunk * WAVEFRONT_CHUNK, min((chunk + 1) * WAVEFRONT_CHUNK, paths.size)):
+            instance, hit, t = closest_index(bvh, paths.origins[k], paths.directions[k], stack)
+            paths.instances[k] = instance
+            paths.hits[k] = hit
+            paths.distances[k] = t
+
+
+@numba.njit(parallel=True)
+def shade_paths(bvh, paths: PathArrays, max_bounces):
+    # one bounce of every path in flight, the same as extend_path and unidirectional_sample but in throughput
+    # form: the geometry terms in a path's color and probability cancel, so only each bounce's brdf over its pdf is
+    # kept. paths that miss, reach a light or run out of bounces are marked dead for compact_paths
+    seed = np.random.randint(0, 2 ** 30)
+    for chunk in numba.prange(chunk_count(paths.size)):
+        np.random.seed(seed + chunk)
+        for k in range(chunk * WAVEFRONT_CHUNK, min((chunk + 1) * WAVEFRONT_CHUNK, paths.size)):
+            if paths.hits[k] < 0:
+                paths.alive[k] = False
+                continue
+            normal, material, color, emitter = surface_at(bvh, paths.instances[k], paths.hits[k])
+            if emitter:
+                paths.radiance[k] += paths.throughputs[k]
+                paths.alive[k] = False
+                continue
+            paths.bounces[k] += 1
+            if paths.bounces[k] >= max_bounces:
+                paths.alive[k] = False
+                continue
+
+            incident = -1 * paths.directions[k]
+            direction = BRDF_sample(material, incident, normal, Direction.FROM_CAMERA.value)
+            pdf = BRDF_pdf(material, incident, normal, direction, Direction.FROM_CAMERA.value)
+            if not pdf > 0:
+                paths.alive[k] = False
+                continue
+            brdf = BRDF_function(material, incident, normal, direction, Direction.FROM_CAMERA.value)
+            paths.throughputs[k] *= color * brdf / pdf
+            paths.origins[k] += paths.directions[k] * paths.distances[k]
+            paths.directions[k] = direction
+    np.random.seed(seed + chunk_count(paths.size))
+
+
+@numba.njit(nogil=True)
+def compact_paths(paths: PathArrays, image):
+    # adds the light of every dead path to its pixel and moves the live ones, in order, to the front.
+    # returns how many paths are still in flight
+    width = image.shape[1]
+    size = 0
+    for k in range(paths.size):
+        if paths.alive[k]:
+            if k != size:
+                paths.move(k, size)
+            size += 1
+        else:
+            image[paths.pixels[k] // width, paths.pixels[k] % width] += paths.radiance[k]
+    paths.size = size
+    return size
+
+
+class WavefrontRenderer:
+    # unidirectional screen samples rendered a stage at a time over a batch of paths rather than a path at a time.
+    # the batch lives in preallocated arrays: each iteration starts new camera paths in the free slots, intersects
+    # every path, shades every hit, then retires the dead paths and packs the rest together for the next one.
+    # each stage loops over plain arrays doing one kind of work, and no Rays are allocated along the way
+    def __init__(self, camera: Camera, bvh, size=WAVEFRONT_SIZE, max_bounces=4):
+        self.camera = camera
+        self.bvh = bvh
+        self.max_bounces = max_bounces
+        self.paths = PathArrays(size)
+
+    def sample(self, samples=5):
+        # the same as unidirectional_screen_sample
+        total = samples * self.camera.pixel_width * self.camera.pixel_height
+        started = 0
+        while started < total or self.paths.size:
+            started += generate_paths(self.camera, self.paths, started, total)
+            intersect_paths(self.bvh, self.paths)
+            shade_paths(self.bvh, self.paths, self.max_bounces)
+            compact_paths(self.paths, self.camera.image)
+        self.camera.sample_counts += samples
+        self.camera.samples += samples
+
+
+@timed
+def wavefront_screen_sample(camera: Camera, bvh, samples=5):
+    # drop-in for unidirectional_screen_sample, use a WavefrontRenderer to keep its buffers between passes
+    WavefrontRenderer(camera, bvh).sample(samples)
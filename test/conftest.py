@@ -1,6 +1,8 @@
 import pytest
+import numpy as np
 from primitives import Ray, Triangle, Box, point
 from constants import UNIT_X, UNIT_Y, UNIT_Z, ZEROS, ONES
+from bvh import triangles_for_box
 
 
 def pytest_configure(config):
@@ -66,3 +68,16 @@ def ray_that_misses():
     return Ray(ONES * 5, UNIT_Y)
 
 
+@pytest.fixture
+def box_triangles():
+    return triangles_for_box(Box(point(-10, -3, -10), point(10, 17, 10)))
+
+
+@pytest.fixture
+def random_triangles():
+    rng = np.random.RandomState(0)
+    triangles = []
+    for _ in range(200):
+        v0 = rng.uniform(-5, 5, 3)
+        triangles.append(Triangle(v0, v0 + rng.uniform(-1, 1, 3), v0 + rng.uniform(-1, 1, 3)))
+    return triangles
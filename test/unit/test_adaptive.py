@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+from adaptive import AdaptiveSampler
+from bvh import BoundingVolumeHierarchy
+from camera import Camera
+from primitives import point
+from utils import seed_random
+from constants import LUMINANCE
+
+
+def small_camera(width=24, height=16):
+    return Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=width, pixel_height=height,
+                  phys_width=width / height)
+
+
+def sampled(sampler, pixel, values):
+    # as if the pixel had been sampled with these luminances
+    values = np.asarray(values, dtype=np.float64)
+    sampler.counts[pixel] = len(values)
+    sampler.sums[pixel] = values.sum() * LUMINANCE / LUMINANCE.dot(LUMINANCE)
+    sampler.squares[pixel] = (values ** 2).sum()
+
+
+@pytest.mark.unittest
+def test_schedule():
+    sampler = AdaptiveSampler(small_camera(2, 1), None, target_noise=.1, min_samples=4, pass_samples=100)
+    assert (sampler.schedule() == 4).all()
+    assert np.isinf(sampler.error()).all()
+
+    sampled(sampler, (0, 0), [1, 1, 1, 1])
+    sampled(sampler, (0, 1), [0, 2, 0, 2])
+    # the flat pixel is done, the noisy one's standard error is .577 of its mean, so it needs about 33 times the
+    # samples but only gets to double them this pass
+    assert sampler.variance()[0, 0] == 0 and np.isclose(sampler.variance()[0, 1], 4 / 3)
+    assert np.isclose(sampler.error()[0, 1], np.sqrt(1 / 3))
+    assert sampler.schedule().tolist() == [[0, 4]]
+
+    # with less to go around, samples are shared out in proportion to what's needed
+    sampler.pass_samples = 1
+    assert sampler.schedule().tolist() == [[0, 2]]
+
+
+@pytest.mark.unittest
+def test_adaptive_sampler(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    seed_random(5)
+    camera = small_camera()
+    sampler = AdaptiveSampler(camera, bvh, target_noise=.3, min_samples=8, max_samples=256)
+    sampler.render()
+
+    assert sampler.converged
+    assert ((sampler.error() <= .3) | (sampler.counts == 256)).all()
+    # the walls converge at the minimum while the noisy pixels keep going
+    assert sampler.counts.min() == 8 and sampler.counts.max() > 8
+    assert np.allclose(camera.image, sampler.mean())
+
+
+@pytest.mark.unittest
+def test_adaptive_time_budget(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    sampler = AdaptiveSampler(small_camera(), bvh, bidirectional=True, target_noise=1e-6, time_budget=0)
+    passes = []
+    sampler.render(lambda s: passes.append(s.passes))
+
+    assert passes == [1] and not sampler.converged
+    assert (sampler.counts == sampler.min_samples).all()
+    assert sampler.camera.sample_counts.sum() > 0
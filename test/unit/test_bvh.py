@@ -0,0 +1,693 @@
+import pytest
+import numpy as np
+import bvh
+from bvh import BoundingVolumeHierarchy, InstanceHierarchy
+from collision import traverse_bvh, traverse_bvh_packet, traverse_instances, traverse_wide, visibility_test, \
+    occlusion_test_batch, ray_triangle_intersect, closest_surface, closest_index, closest_indices
+from primitives import Ray, Triangle, unit, point, alias_table
+from routines import generate_light_ray
+from camera import Camera
+from constants import UNIT_X, UNIT_Z, LUMINANCE, BVH_MAX_DEPTH, BVH_MAX_MEMBERS, COLLISION_SHIFT
+
+NUM_RAYS = 50
+
+
+def brute_force(triangles, ray):
+    least_t = np.inf
+    least_hit = -1
+    for index, triangle in enumerate(triangles):
+        t = ray_triangle_intersect(ray, triangle)
+        if t is not None and t < least_t:
+            least_t = t
+            least_hit = index
+    return least_hit, least_t
+
+
+def random_rays(n, seed=1):
+    rng = np.random.RandomState(seed)
+    return [Ray(rng.uniform(-6, 6, 3), unit(rng.normal(size=3))) for _ in range(n)]
+
+
+def axis_rays(n, seed=1):
+    # rays along the axes, whose inverse directions have infinite components
+    rng = np.random.RandomState(seed)
+    axes = np.vstack([np.eye(3), -np.eye(3)])
+    return [Ray(rng.uniform(-6, 6, 3), axes[rng.randint(6)].copy()) for _ in range(n)]
+
+
+@pytest.mark.unittest
+def test_flat_layout(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    flat = hierarchy.flat
+    triangles = flat.triangles
+
+    assert flat.node_count() > 1
+    assert triangles.count() == len(random_triangles)
+    assert not flat.is_leaf(0)
+
+    covered = np.zeros(len(random_triangles), dtype=np.int64)
+    for index in range(flat.node_count()):
+        if flat.is_leaf(index):
+            first = flat.offsets[index]
+            covered[first:first + flat.counts[index]] += 1
+            for k in range(first, first + flat.counts[index]):
+                assert (triangles.v0[k] == random_triangles[hierarchy.order[k]].v0).all()
+                for vertex in (triangles.v0[k], triangles.v0[k] + triangles.e1[k], triangles.v0[k] + triangles.e2[k]):
+                    assert (vertex >= flat.bounds[index][0]).all()
+                    assert (vertex <= flat.bounds[index][1]).all()
+        else:
+            # depth-first: left child follows its parent, right child comes later
+            for child in (index + 1, flat.offsets[index]):
+                assert child > index
+                assert (flat.bounds[child][0] >= flat.bounds[index][0]).all()
+                assert (flat.bounds[child][1] <= flat.bounds[index][1]).all()
+    # every triangle belongs to exactly one leaf
+    assert (covered == 1).all()
+    assert 0 < flat.depth <= BVH_MAX_DEPTH
+    assert ((flat.axes >= 0) & (flat.axes < 3)).all()
+
+
+@pytest.mark.unittest
+def test_single_leaf(box_triangles):
+    flat = BoundingVolumeHierarchy(box_triangles, max_depth=0).flat
+
+    assert flat.node_count() == 1
+    assert flat.depth == 0
+    assert len(flat.stack()) == 1
+
+
+@pytest.mark.unittest
+def test_traversal_matches_brute_force(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    hits = 0
+    for ray in random_rays(NUM_RAYS):
+        expected, expected_t = brute_force(random_triangles, ray)
+        hit, t = traverse_bvh(hierarchy.flat, ray)
+        if expected < 0:
+            assert hit == -1
+        else:
+            hits += 1
+            assert hierarchy.order[hit] == expected
+            assert np.isclose(t, expected_t)
+    assert hits > 0
+
+
+@pytest.mark.unittest
+def test_lights(box_triangles):
+    flat = BoundingVolumeHierarchy(box_triangles).flat
+
+    assert len(flat.lights) == 2
+    assert flat.triangles.emitters[flat.lights].all()
+    assert np.isclose(flat.light_sampler.area, sum(t.surface_area for t in box_triangles if t.emitter))
+    # the light is a 10 x 10 square
+    assert np.isclose(flat.light_sampler.area, 100)
+
+
+@pytest.mark.unittest
+def test_visibility(box_triangles):
+    flat = BoundingVolumeHierarchy(box_triangles).flat
+    # floor and ceiling of the box face each other
+    floor = Ray(np.array([8., -3., 8.]), np.array([0., 1., 0.]))
+    ceiling = Ray(np.array([8., 17., 8.]), np.array([0., -1., 0.]))
+    floor.normal = np.array([0., 1., 0.])
+    ceiling.normal = np.array([0., -1., 0.])
+    assert visibility_test(flat, floor, ceiling)
+
+    # the light hangs just below the middle of the ceiling
+    light_side = Ray(np.array([0., 17., 0.]), np.array([0., -1., 0.]))
+    light_side.normal = np.array([0., -1., 0.])
+    assert not visibility_test(flat, floor, light_side)
+
+    # facing away from each other
+    ceiling.normal = np.array([0., 1., 0.])
+    assert not visibility_test(flat, floor, ceiling)
+
+
+@pytest.mark.unittest
+def test_leaf_size_limit(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles, max_members=4).flat
+
+    for index in range(flat.node_count()):
+        assert flat.counts[index] <= 4
+
+
+@pytest.mark.unittest
+def test_sah_separates_clusters(random_triangles):
+    # two copies of the same soup far apart along x should be split at the root
+    shifted = [Triangle(t.v0 + UNIT_X * 100, t.v1 + UNIT_X * 100, t.v2 + UNIT_X * 100) for t in random_triangles]
+    flat = BoundingVolumeHierarchy(random_triangles + shifted).flat
+    left, right = flat.bounds[1], flat.bounds[flat.offsets[0]]
+
+    assert left[1][0] < 10 or right[1][0] < 10
+    assert left[0][0] > 90 or right[0][0] > 90
+
+
+@pytest.mark.unittest
+def test_cache(random_triangles, tmp_path, monkeypatch):
+    built = BoundingVolumeHierarchy(random_triangles, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    def fail(*args):
+        raise AssertionError('BVH should have been loaded from the cache')
+    monkeypatch.setattr(bvh, 'build_nodes', fail)
+    cached = BoundingVolumeHierarchy(random_triangles, cache_dir=str(tmp_path))
+
+    assert (cached.order == built.order).all()
+    assert (cached.flat.bounds == built.flat.bounds).all()
+    assert (cached.flat.offsets == built.flat.offsets).all()
+    assert (cached.flat.counts == built.flat.counts).all()
+    for ray in random_rays(NUM_RAYS):
+        assert traverse_bvh(cached.flat, ray)[1] == traverse_bvh(built.flat, ray)[1]
+
+    # different geometry or build parameters miss the cache
+    monkeypatch.undo()
+    BoundingVolumeHierarchy(random_triangles, cache_dir=str(tmp_path), max_members=4)
+    BoundingVolumeHierarchy(random_triangles[1:], cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+@pytest.mark.unittest
+def test_packet_matches_single_rays(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles).flat
+    rays = random_rays(3 * NUM_RAYS)
+    origins = np.array([ray.origin for ray in rays])
+    directions = np.array([ray.direction for ray in rays])
+
+    hits, ts = traverse_bvh_packet(flat, origins, directions)
+
+    assert (hits >= 0).any()
+    for ray, hit, t in zip(rays, hits, ts):
+        expected, expected_t = traverse_bvh(flat, ray)
+        assert hit == expected
+        assert t == expected_t
+
+
+@pytest.mark.unittest
+def test_packet_max_t(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles).flat
+    rays = random_rays(NUM_RAYS)
+    origins = np.array([ray.origin for ray in rays])
+    directions = np.array([ray.direction for ray in rays])
+    hits, ts = traverse_bvh_packet(flat, origins, directions)
+
+    max_t = np.where(hits >= 0, ts / 2, 1.)
+    short_hits, short_ts = traverse_bvh_packet(flat, origins, directions, max_t)
+    for hit, t, short_hit, short_t, limit in zip(hits, ts, short_hits, short_ts, max_t):
+        assert short_t <= limit
+        if short_hit >= 0:
+            assert short_t < t
+
+
+@pytest.mark.unittest
+def test_camera_tile_packet(box_triangles):
+    flat = BoundingVolumeHierarchy(box_triangles).flat
+    camera = Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=16, pixel_height=9, phys_width=16 / 9)
+    origins, directions = camera.make_rays(2, 6, 4, 12)
+    hits, ts = traverse_bvh_packet(flat, origins, directions)
+
+    assert origins.shape == (32, 3)
+    assert np.allclose(np.linalg.norm(directions, axis=1), 1)
+    # the camera is inside the box, so every primary ray hits a wall
+    assert (hits >= 0).all()
+    assert np.isfinite(ts).all()
+
+
+@pytest.mark.unittest
+def test_closest_indices(random_triangles):
+    # packets for binary BVHs and single rays for the rest, with the same answers as closest_index
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    scene = InstanceHierarchy([random_triangles], [(0, np.eye(4))]).flat
+    rays = random_rays(NUM_RAYS)
+    origins = np.array([ray.origin for ray in rays])
+    directions = np.array([ray.direction for ray in rays])
+    for bvh in (hierarchy.flat, hierarchy.wide(), hierarchy.quantized(), scene):
+        instances, hits, ts = closest_indices(bvh, origins, directions)
+        assert (hits >= 0).any()
+        for k in range(NUM_RAYS):
+            assert (instances[k], hits[k], ts[k]) == closest_index(bvh, origins[k], directions[k], bvh.stack())
+
+
+@pytest.mark.unittest
+def test_occlusion_batch(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles).flat
+    rng = np.random.RandomState(2)
+    origins = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    targets = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    keys = np.arange(NUM_RAYS) % 4
+    occluders = np.full(4, -1, dtype=np.int64)
+
+    visible = occlusion_test_batch(flat, origins, targets, occluders, keys)
+
+    assert visible.any() and not visible.all()
+    assert (occluders >= 0).any()
+    for origin, target, result in zip(origins, targets, visible):
+        distance = np.linalg.norm(target - origin)
+        hit, t = traverse_bvh(flat, Ray(origin, (target - origin) / distance))
+        assert result == (hit == -1 or t >= distance - COLLISION_SHIFT)
+
+    # a cached occluder that doesn't block a segment must not change the answer
+    assert (occlusion_test_batch(flat, origins, targets, occluders, keys) == visible).all()
+    assert (occlusion_test_batch(flat, origins, targets, np.zeros(4, dtype=np.int64), keys) == visible).all()
+    # or writing into buffers that are reused, as renderers do
+    buffer = np.ones(NUM_RAYS + 5, dtype=np.bool_)
+    occlusion_test_batch(flat, origins, targets, occluders, keys, buffer[:NUM_RAYS], flat.stack())
+    assert (buffer[:NUM_RAYS] == visible).all() and buffer[NUM_RAYS:].all()
+
+
+@pytest.mark.unittest
+def test_refit_rigid_motion(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    flat = hierarchy.flat
+    bounds = flat.bounds.copy()
+    offset = np.array([1., -2., .5])
+
+    assert not hierarchy.refit(hierarchy.vertices + offset)
+
+    # same tree, just moved
+    assert hierarchy.flat is flat
+    assert np.allclose(flat.bounds, bounds + offset)
+    assert np.isclose(bvh.sah_cost(flat), hierarchy.cost)
+    moved = [Triangle(t.v0 + offset, t.v1 + offset, t.v2 + offset) for t in random_triangles]
+    for ray in random_rays(NUM_RAYS):
+        expected, expected_t = brute_force(moved, ray)
+        hit, t = traverse_bvh(flat, ray)
+        assert (hit == -1 and expected == -1) or hierarchy.order[hit] == expected
+
+
+@pytest.mark.unittest
+def test_refit_single_precision(random_triangles):
+    # refitted single precision boxes are padded and rounded outwards like built ones, so they still hold every
+    # triangle as the leaf test sees it
+    hierarchy = BoundingVolumeHierarchy(random_triangles, precision=np.float32)
+    flat = hierarchy.flat
+    offset = np.array([1.1, -2.3, .7])
+
+    assert not hierarchy.refit(hierarchy.vertices + offset)
+    assert flat.bounds.dtype == np.float32
+    triangles = flat.triangles
+    v0 = triangles.v0.astype(np.float64)
+    corners = np.stack([v0, v0 + triangles.e1, v0 + triangles.e2], axis=1)
+    for index in range(flat.node_count()):
+        if flat.is_leaf(index):
+            leaf = corners[flat.offsets[index]:flat.offsets[index] + flat.counts[index]].reshape(-1, 3)
+            assert (flat.bounds[index, 0] <= leaf.min(axis=0) - triangles.epsilon).all()
+            assert (flat.bounds[index, 1] >= leaf.max(axis=0) + triangles.epsilon).all()
+    moved = [Triangle(t.v0 + offset, t.v1 + offset, t.v2 + offset) for t in random_triangles]
+    for ray in random_rays(NUM_RAYS):
+        expected, expected_t = brute_force(moved, ray)
+        hit, t = traverse_bvh(flat, ray)
+        assert (hit == -1 and expected == -1) or hierarchy.order[hit] == expected
+
+
+@pytest.mark.unittest
+def test_refit_rebuilds_degraded_tree(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    cost = hierarchy.cost
+    # shuffling the triangles around scrambles every node's contents
+    rng = np.random.RandomState(3)
+    vertices = hierarchy.vertices[rng.permutation(len(random_triangles))]
+
+    assert hierarchy.refit(vertices)
+
+    assert hierarchy.cost < 1.5 * cost
+    shuffled = [Triangle(*v) for v in vertices]
+    for ray in random_rays(NUM_RAYS):
+        expected, expected_t = brute_force(shuffled, ray)
+        hit, t = traverse_bvh(hierarchy.flat, ray)
+        assert (hit == -1 and expected == -1) or hierarchy.order[hit] == expected
+
+
+def instance_transforms(n, seed=4):
+    # rotations about y with non-uniform scales, spread out along x and z
+    rng = np.random.RandomState(seed)
+    transforms = []
+    for _ in range(n):
+        angle = rng.uniform(0, 2 * np.pi)
+        c, s = np.cos(angle), np.sin(angle)
+        rotation = np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+        scale = np.diag(rng.uniform(.2, .6, 3))
+        transforms.append(np.hstack([rotation @ scale, rng.uniform(-6, 6, (3, 1))]))
+    return transforms
+
+
+def transformed(triangles, transform):
+    return [Triangle(*(transform[:, :3] @ v + transform[:, 3] for v in (t.v0, t.v1, t.v2)),
+                     color=t.color, emitter=t.emitter) for t in triangles]
+
+
+@pytest.mark.unittest
+def test_instances_match_flattened_scene(random_triangles, box_triangles):
+    meshes = [random_triangles, box_triangles[:12]]
+    instances = [(k % 2, transform) for k, transform in enumerate(instance_transforms(10))]
+    scene = InstanceHierarchy(meshes, instances).flat
+    # the same scene with every instance's triangles copied out into world space
+    world = BoundingVolumeHierarchy([t for mesh, transform in instances for t in transformed(meshes[mesh], transform)])
+
+    assert scene.instance_count() == 10
+    assert len(scene.meshes) == 2
+    hits = 0
+    for ray in random_rays(3 * NUM_RAYS):
+        instance, hit, t = traverse_instances(scene, ray)
+        expected, expected_t = traverse_bvh(world.flat, ray)
+        assert (hit == -1) == (expected == -1)
+        if hit >= 0:
+            hits += 1
+            assert np.isclose(t, expected_t)
+            found, surface_t, normal, material, color, emitter = closest_surface(scene, ray)
+            assert found and surface_t == t
+            assert np.allclose(normal, world.flat.triangles.normals[expected])
+    assert hits > 0
+
+
+@pytest.mark.unittest
+def test_instance_lights(box_triangles):
+    transform = np.array([[2., 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 5]])
+    scene = InstanceHierarchy([box_triangles], [(0, np.eye(4)), (0, transform)]).flat
+
+    assert len(scene.lights) == 4
+    # the second copy of the 10 x 10 light is stretched to twice the width
+    assert np.isclose(scene.light_sampler.area, 100 + 200)
+    for _ in range(10):
+        ray = generate_light_ray(scene)
+        assert np.isclose(ray.origin[1], 17 * .95)
+        assert np.allclose(ray.normal, [0, -1, 0])
+
+
+def scattered_lights(rng, count):
+    # small lights of random sizes and colors spread over a 100 unit square
+    lights = []
+    for _ in range(count):
+        v0 = point(*rng.uniform(-50, 50, 3))
+        size = rng.uniform(.1, 2)
+        lights.append(Triangle(v0, v0 + UNIT_X * size, v0 + UNIT_Z * size, rng.uniform(0, 1, 3), emitter=True))
+    return lights
+
+
+@pytest.mark.unittest
+def test_alias_table():
+    weights = np.array([1., 0, 3, 4, 2, 0])
+    probabilities, thresholds, aliases = alias_table(weights)
+
+    assert np.allclose(probabilities, weights / weights.sum())
+    assert ((thresholds >= 0) & (thresholds <= 1 + 1e-12)).all()
+    # a uniform pick keeps k with its threshold and otherwise takes its alias, which adds up to the weights exactly
+    picked = thresholds.copy()
+    for k, alias in enumerate(aliases):
+        picked[alias] += 1 - thresholds[k]
+    assert np.allclose(picked / len(weights), probabilities)
+    # nothing to go by, so all are as likely
+    probabilities, thresholds, aliases = alias_table(np.zeros(4))
+    assert np.allclose(probabilities, .25) and (thresholds == 1).all()
+
+
+@pytest.mark.unittest
+def test_light_sampler():
+    rng = np.random.RandomState(3)
+    lights = scattered_lights(rng, 20)
+    sampler = BoundingVolumeHierarchy(lights).flat.light_sampler
+    # lights are kept in the order the BVH put their triangles in
+    lights = [min(lights, key=lambda t: np.abs(t.v0 - v0).sum()) for v0 in sampler.v0]
+    powers = np.array([t.surface_area * t.color.dot(LUMINANCE) for t in lights])
+
+    assert sampler.count() == 20
+    assert np.allclose(sampler.areas, [t.surface_area for t in lights])
+    assert np.allclose(sampler.probabilities, powers / powers.sum())
+    # pdfs are over area, the brighter and bigger a light the likelier a point on it is picked
+    for k in range(20):
+        assert np.isclose(sampler.pdf(k), sampler.probabilities[k] / sampler.areas[k])
+    picks = np.bincount([sampler.pick() for _ in range(20000)], minlength=20) / 20000
+    assert np.allclose(picks, sampler.probabilities, atol=.015)
+
+
+@pytest.mark.unittest
+def test_light_tree():
+    rng = np.random.RandomState(4)
+    sampler = BoundingVolumeHierarchy(scattered_lights(rng, 30), light_tree=True).flat.light_sampler
+    n = sampler.count()
+
+    # a binary tree with a leaf for each light, children after their parents
+    assert len(sampler.node_powers) == 2 * n - 1 and (sampler.node_counts == 1).sum() == n
+    assert (sampler.parents[1:] < np.arange(1, 2 * n - 1)).all() and sampler.parents[0] == -1
+    assert sorted(sampler.node_offsets[sampler.leaves]) == list(range(n))
+    assert np.isclose(sampler.node_powers[0], sampler.node_powers[sampler.leaves].sum())
+    for point_ in (point(0, 0, 0), point(40, 10, -40)):
+        # the chances of picking each light from any point add up to one
+        chances = np.array([sampler.pdf_near(point_, k) * sampler.areas[k] for k in range(n)])
+        assert np.isclose(chances.sum(), 1) and (chances > 0).all()
+        nearest = np.argmin(np.linalg.norm(sampler.v0 - point_, axis=1))
+        assert chances[nearest] > sampler.probabilities[nearest]
+        # and sample_near picks them with those chances
+        counts = np.zeros(n)
+        for _ in range(5000):
+            origin, normal, color, pdf = sampler.sample_near(point_)
+            light = np.argmin(np.abs(sampler.colors - color).sum(axis=1))
+            assert np.isclose(pdf, sampler.pdf_near(point_, light))
+            counts[light] += 1
+        assert np.allclose(counts / 5000, chances, atol=.03)
+    # without the tree, points don't matter
+    sampler.use_tree = False
+    assert sampler.pdf_near(point(0, 0, 0), 0) == sampler.pdf(0)
+
+
+@pytest.mark.unittest
+def test_instance_occlusion_batch(random_triangles):
+    instances = [(0, transform) for transform in instance_transforms(10)]
+    scene = InstanceHierarchy([random_triangles], instances).flat
+    world = BoundingVolumeHierarchy([t for _, transform in instances for t in transformed(random_triangles, transform)])
+    rng = np.random.RandomState(2)
+    origins = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    targets = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    keys = np.arange(NUM_RAYS) % 4
+
+    occluders = np.full(4, -1, dtype=np.int64)
+    visible = occlusion_test_batch(scene, origins, targets, occluders, keys)
+
+    assert visible.any() and not visible.all()
+    assert ((occluders >= -1) & (occluders < 10)).all()
+    assert (visible == occlusion_test_batch(world.flat, origins, targets, np.full(4, -1, dtype=np.int64), keys)).all()
+    assert (occlusion_test_batch(scene, origins, targets, np.zeros(4, dtype=np.int64), keys) == visible).all()
+
+
+@pytest.mark.unittest
+def test_spatial_splits(random_triangles, box_triangles):
+    # small triangles inside a box whose walls overlap everything
+    triangles = random_triangles + box_triangles
+    binned = BoundingVolumeHierarchy(triangles)
+    spatial = BoundingVolumeHierarchy(triangles, spatial_budget=.3)
+    flat = spatial.flat
+
+    assert len(triangles) < len(spatial.order) <= 1.3 * len(triangles)
+    assert set(spatial.order) == set(range(len(triangles)))
+    assert spatial.cost < binned.cost
+    # duplicated lights are only counted once
+    assert len(flat.lights) == 2
+    assert np.isclose(flat.light_sampler.area, 100)
+    for index in range(flat.node_count()):
+        if flat.is_leaf(index):
+            assert flat.counts[index] <= BVH_MAX_MEMBERS
+    for ray in random_rays(2 * NUM_RAYS):
+        expected, expected_t = brute_force(triangles, ray)
+        hit, t = traverse_bvh(flat, ray)
+        if expected < 0:
+            assert hit == -1
+        else:
+            assert spatial.order[hit] == expected
+            assert np.isclose(t, expected_t)
+
+
+@pytest.mark.unittest
+def test_spatial_split_lights(random_triangles, box_triangles):
+    # a long light across the small triangles ends up in many leaves, every one of which has to know which light it is
+    light = Triangle(point(-6, 0, -.1), point(6, 0, -.1), point(6, 0, .1), emitter=True)
+    triangles = random_triangles + box_triangles + [light]
+    hierarchy = BoundingVolumeHierarchy(triangles, spatial_budget=1.)
+    flat = hierarchy.flat
+    emitters = flat.triangles.emitters
+
+    assert (hierarchy.order == len(triangles) - 1).sum() > 1
+    assert len(flat.lights) == 3
+    assert (flat.light_ids[emitters] >= 0).all() and (flat.light_ids[~emitters] == -1).all()
+    # each slot maps to the light of the triangle in it
+    assert (hierarchy.order[flat.lights[flat.light_ids[emitters]]] == hierarchy.order[emitters]).all()
+    assert (hierarchy.wide().light_ids == flat.light_ids).all()
+
+
+@pytest.mark.unittest
+def test_spatial_budget(box_triangles):
+    # with no room for duplicates spatial splits can't happen at all
+    spatial = BoundingVolumeHierarchy(box_triangles, spatial_budget=1e-9)
+    assert len(spatial.order) == len(box_triangles)
+
+
+@pytest.mark.unittest
+@pytest.mark.parametrize('workers', [1, 3, 8])
+def test_parallel_build_matches_sequential(random_triangles, box_triangles, workers):
+    vertices = bvh.triangle_arrays(random_triangles + box_triangles)[0]
+    mins, maxes = vertices.min(axis=1), vertices.max(axis=1)
+    sequential = bvh.build_nodes(mins, maxes, 4, BVH_MAX_DEPTH, 16)
+    parallel = bvh.parallel_build_nodes(mins, maxes, 4, BVH_MAX_DEPTH, 16, workers)
+
+    for expected, result in zip(sequential, parallel):
+        assert np.array_equal(expected, result)
+
+
+@pytest.mark.unittest
+def test_parallel_build_depth_limit(random_triangles):
+    # subtrees start part way down, so they must stop at the same depth the sequential build does
+    vertices = bvh.triangle_arrays(random_triangles)[0]
+    mins, maxes = vertices.min(axis=1), vertices.max(axis=1)
+    sequential = bvh.build_nodes(mins, maxes, 1, 4, 16)
+    parallel = bvh.parallel_build_nodes(mins, maxes, 1, 4, 16, 4)
+
+    for expected, result in zip(sequential, parallel):
+        assert np.array_equal(expected, result)
+
+
+@pytest.mark.unittest
+@pytest.mark.parametrize('width', [4, 8])
+def test_wide_layout(random_triangles, width):
+    hierarchy = BoundingVolumeHierarchy(random_triangles, max_members=4)
+    wide = hierarchy.wide(width)
+
+    assert wide.width() == width
+    assert wide.node_count() < hierarchy.flat.node_count()
+    assert wide.depth < hierarchy.flat.depth
+    covered = np.zeros(len(random_triangles), dtype=np.int64)
+    for index in range(wide.node_count()):
+        for lane in range(width):
+            child = wide.children[index, lane]
+            if child < 0:
+                # empty slots can't be hit
+                assert (wide.child_bounds[index, 0, :, lane] > wide.child_bounds[index, 1, :, lane]).all()
+            elif wide.is_inner(index, lane):
+                assert child > index
+                # the child's own children lie within the bounds its parent keeps for it
+                assert (wide.child_bounds[child, 0].min(axis=1) >= wide.child_bounds[index, 0, :, lane]).all()
+            else:
+                covered[child:child + wide.child_counts[index, lane]] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.unittest
+def test_wide_matches_binary(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    wide = hierarchy.wide()
+    hits = 0
+    for ray in random_rays(3 * NUM_RAYS):
+        hit, t = traverse_wide(wide, ray)
+        assert (hit, t) == traverse_bvh(hierarchy.flat, ray)
+        assert closest_surface(wide, ray)[:2] == (hit >= 0, t)
+        hits += hit >= 0
+    assert hits > 0
+
+    rng = np.random.RandomState(2)
+    origins = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    targets = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    keys = np.arange(NUM_RAYS) % 4
+    expected = occlusion_test_batch(hierarchy.flat, origins, targets, np.full(4, -1, dtype=np.int64), keys)
+    assert (occlusion_test_batch(wide, origins, targets, np.full(4, -1, dtype=np.int64), keys) == expected).all()
+
+
+@pytest.mark.unittest
+def test_wide_single_leaf(box_triangles):
+    hierarchy = BoundingVolumeHierarchy(box_triangles, max_depth=0)
+    wide = hierarchy.wide()
+
+    assert wide.node_count() == 1 and wide.depth == 0
+    assert wide.child_counts[0, 0] == len(box_triangles)
+    assert np.isclose(wide.light_sampler.area, 100)
+    ray = Ray(point(0, 2, 6), point(0, 0, -1))
+    assert traverse_wide(wide, ray) == traverse_bvh(hierarchy.flat, ray)
+
+
+@pytest.mark.unittest
+def test_quantized_bounds_contain_wide(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles, max_members=4)
+    wide, quantized = hierarchy.wide(), hierarchy.quantized()
+
+    assert (quantized.children == wide.children).all()
+    assert (quantized.child_counts == wide.child_counts).all()
+    steps = 2. ** quantized.exponents[:, None, :, None]
+    decoded = quantized.origins[:, None, :, None] + quantized.child_bounds * steps
+    used = wide.children >= 0
+    for axis in range(3):
+        assert (decoded[:, 0, axis][used] <= wide.child_bounds[:, 0, axis][used]).all()
+        assert (decoded[:, 1, axis][used] >= wide.child_bounds[:, 1, axis][used]).all()
+        # unused slots decode to empty boxes
+        assert (decoded[:, 0, axis][~used] > decoded[:, 1, axis][~used]).all()
+
+
+@pytest.mark.unittest
+def test_quantized_matches_binary(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    quantized = hierarchy.quantized()
+    for rays in (random_rays(3 * NUM_RAYS), axis_rays(20 * NUM_RAYS)):
+        hits = 0
+        for ray in rays:
+            hit, t = traverse_wide(quantized, ray)
+            assert (hit, t) == traverse_bvh(hierarchy.flat, ray)
+            assert closest_surface(quantized, ray)[:2] == (hit >= 0, t)
+            hits += hit >= 0
+        assert hits > 0
+
+    rng = np.random.RandomState(2)
+    origins = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    targets = rng.uniform(-6, 6, (NUM_RAYS, 3))
+    keys = np.arange(NUM_RAYS) % 4
+    expected = occlusion_test_batch(hierarchy.flat, origins, targets, np.full(4, -1, dtype=np.int64), keys)
+    assert (occlusion_test_batch(quantized, origins, targets, np.full(4, -1, dtype=np.int64), keys) == expected).all()
+
+
+@pytest.mark.unittest
+def test_single_precision(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    single = BoundingVolumeHierarchy(random_triangles, precision=np.float32)
+    flat = single.flat
+
+    assert flat.bounds.dtype == flat.triangles.v0.dtype == flat.triangles.normals.dtype == np.float32
+    # the same tree, with everything it stores about half the size
+    assert (flat.offsets == hierarchy.flat.offsets).all() and (single.order == hierarchy.order).all()
+    assert flat.bounds.nbytes * 2 == hierarchy.flat.bounds.nbytes
+    assert flat.triangles.epsilon > hierarchy.flat.triangles.epsilon == COLLISION_SHIFT
+    # rounded bounds still contain their triangles
+    for index in range(flat.node_count()):
+        if flat.is_leaf(index):
+            first = flat.offsets[index]
+            for k in range(first, first + flat.counts[index]):
+                v0 = flat.triangles.v0[k].astype(np.float64)
+                for vertex in (v0, v0 + flat.triangles.e1[k], v0 + flat.triangles.e2[k]):
+                    assert (flat.bounds[index, 0] <= vertex).all() and (vertex <= flat.bounds[index, 1]).all()
+
+    for bvh, expected in [(flat, hierarchy.flat), (single.wide(), hierarchy.wide()),
+                          (single.quantized(), hierarchy.quantized())]:
+        for ray in random_rays(NUM_RAYS):
+            found, t, normal = closest_surface(bvh, ray)[:3]
+            expected_found, expected_t, expected_normal = closest_surface(expected, ray)[:3]
+            assert found == expected_found
+            assert np.isclose(t, expected_t, atol=1e-4)
+            assert normal.dtype == np.float64 and np.allclose(normal, expected_normal, atol=1e-6)
+
+        rng = np.random.RandomState(2)
+        origins = rng.uniform(-6, 6, (NUM_RAYS, 3))
+        targets = rng.uniform(-6, 6, (NUM_RAYS, 3))
+        keys = np.arange(NUM_RAYS) % 4
+        assert (occlusion_test_batch(bvh, origins, targets, np.full(4, -1, dtype=np.int64), keys) ==
+                occlusion_test_batch(expected, origins, targets, np.full(4, -1, dtype=np.int64), keys)).all()
+
+
+@pytest.mark.unittest
+def test_single_precision_epsilon(box_triangles):
+    # far from the origin single precision can't place a hit within COLLISION_SHIFT, so rays leaving a wall
+    # need a wider margin not to hit it again
+    far = [Triangle(t.v0 + 1e4, t.v1 + 1e4, t.v2 + 1e4, t.color, t.emitter, t.material) for t in box_triangles]
+    near = BoundingVolumeHierarchy(box_triangles, precision=np.float32).flat
+    single = BoundingVolumeHierarchy(far, precision=np.float32).flat
+
+    assert single.triangles.epsilon > 1e4 * np.finfo(np.float32).eps
+    assert near.triangles.epsilon < single.triangles.epsilon / 100
+    assert BoundingVolumeHierarchy(far).flat.triangles.epsilon == COLLISION_SHIFT
+    # light rays leave the ceiling in double precision and cross the box without hitting it again
+    ray = generate_light_ray(single)
+    assert ray.origin.dtype == ray.normal.dtype == np.float64
+    hit, t = traverse_bvh(single, ray)
+    assert hit >= 0 and t > 1
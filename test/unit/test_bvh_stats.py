@@ -0,0 +1,94 @@
+import pytest
+import numpy as np
+from bvh import BoundingVolumeHierarchy
+from bvh_stats import bvh_report, format_report, sibling_overlaps, traversal_counts, camera_traversal_counts, \
+    heatmap_image, memory_report
+from collision import traverse_bvh
+from camera import Camera
+from primitives import Ray, Triangle, point
+
+
+@pytest.mark.unittest
+def test_report(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles, max_members=4).flat
+    report = bvh_report(flat)
+
+    assert report['nodes'] == flat.node_count()
+    assert report['leaves'] == report['leaf_depths'].sum() == report['leaf_sizes'].sum()
+    assert (report['leaf_sizes'] * np.arange(len(report['leaf_sizes']))).sum() == report['references'] == 200
+    assert len(report['leaf_sizes']) <= 5
+    assert len(report['leaf_depths']) == flat.depth + 1
+    assert report['sah_cost'] > 0
+    # random triangles overlap a lot
+    assert 0 < report['mean_overlap'] < 1
+    assert 'SAH cost' in format_report(report)
+
+
+@pytest.mark.unittest
+def test_sibling_overlap():
+    # two triangles far apart don't overlap at all
+    a = Triangle(point(0, 0, 0), point(1, 0, 0), point(0, 1, 0))
+    b = Triangle(point(5, 0, 0), point(6, 0, 0), point(5, 1, 0))
+    flat = BoundingVolumeHierarchy([a, b], max_members=1).flat
+
+    assert flat.node_count() == 3
+    assert (sibling_overlaps(flat) == 0).all()
+    assert bvh_report(flat)['total_overlap'] == 0
+
+
+@pytest.mark.unittest
+def test_traversal_counts(random_triangles):
+    flat = BoundingVolumeHierarchy(random_triangles).flat
+    rng = np.random.RandomState(1)
+    origins = rng.uniform(-6, 6, (50, 3))
+    directions = rng.normal(size=(50, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+
+    hits, nodes, tests = traversal_counts(flat, origins, directions)
+
+    for origin, direction, hit, visited, tested in zip(origins, directions, hits, nodes, tests):
+        assert hit == traverse_bvh(flat, Ray(origin, direction))[0]
+        assert 1 <= visited <= flat.node_count()
+        assert 0 <= tested <= len(random_triangles)
+        if hit >= 0:
+            assert tested > 0
+
+
+@pytest.mark.unittest
+def test_heatmap(box_triangles):
+    flat = BoundingVolumeHierarchy(box_triangles, max_members=1).flat
+    camera = Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=16, pixel_height=9, phys_width=16 / 9)
+    nodes, tests = camera_traversal_counts(camera, flat)
+
+    assert nodes.shape == tests.shape == (9, 16)
+    assert (nodes > 0).all() and (tests > 0).all()
+    image = heatmap_image(nodes)
+    assert image.shape == (9, 16, 3) and image.dtype == np.uint8
+    # a fixed scale saturates instead of rescaling
+    assert (heatmap_image(nodes, 1) == heatmap_image(nodes + 5, 1)).all()
+
+
+@pytest.mark.unittest
+def test_wide_traversal_counts(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    rng = np.random.RandomState(1)
+    origins = rng.uniform(-6, 6, (50, 3))
+    directions = rng.normal(size=(50, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+
+    hits, nodes, tests = traversal_counts(hierarchy.flat, origins, directions)
+    wide_hits, wide_nodes, wide_tests = traversal_counts(hierarchy.wide(), origins, directions)
+
+    assert (hits == wide_hits).all()
+    assert wide_nodes.sum() < nodes.sum() / 2
+
+
+@pytest.mark.unittest
+def test_memory_report(random_triangles):
+    hierarchy = BoundingVolumeHierarchy(random_triangles)
+    flat, wide, quantized = [memory_report(bvh) for bvh in (hierarchy.flat, hierarchy.wide(), hierarchy.quantized())]
+
+    assert flat['bytes_per_node'] == 72
+    assert flat['node_bytes'] == 72 * hierarchy.flat.node_count()
+    assert quantized['bytes_per_node'] < wide['bytes_per_node'] / 3
+    assert quantized['node_bytes'] < flat['node_bytes'] / 2
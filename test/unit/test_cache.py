@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+from cache import content_hash, save_arrays, load_arrays
+
+
+@pytest.mark.unittest
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'arrays.bin')
+    arrays = {
+        'floats': np.arange(12, dtype=np.float64).reshape(2, 2, 3),
+        'ints': np.array([3, 1, 2], dtype=np.int64),
+        'empty': np.zeros((0, 3), dtype=np.float32),
+        'flags': np.array([True, False]),
+    }
+    save_arrays(path, arrays, answer=42)
+    loaded, meta = load_arrays(path)
+
+    assert meta == {'answer': 42}
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        assert loaded[name].shape == array.shape
+        assert (loaded[name] == array).all()
+
+
+@pytest.mark.unittest
+def test_copy_on_write(tmp_path):
+    path = str(tmp_path / 'arrays.bin')
+    save_arrays(path, {'ints': np.arange(4)})
+    loaded, _ = load_arrays(path)
+    loaded['ints'][0] = 100
+
+    reloaded, _ = load_arrays(path)
+    assert reloaded['ints'][0] == 0
+
+
+@pytest.mark.unittest
+def test_bad_file(tmp_path):
+    path = tmp_path / 'arrays.bin'
+    path.write_bytes(b'definitely not a cache file')
+
+    with pytest.raises(ValueError):
+        load_arrays(str(path))
+
+
+@pytest.mark.unittest
+def test_content_hash():
+    a = np.arange(6, dtype=np.float64)
+
+    assert content_hash([a], n=1) == content_hash([a.copy()], n=1)
+    assert content_hash([a], n=1) != content_hash([a], n=2)
+    assert content_hash([a], n=1) != content_hash([a.reshape(2, 3)], n=1)
+    assert content_hash([a], n=1) != content_hash([a + 1], n=1)
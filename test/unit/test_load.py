@@ -0,0 +1,129 @@
+import os
+import pytest
+import numpy as np
+from bvh import BoundingVolumeHierarchy, triangles_for_box
+from load import load_obj, read_obj, load_mesh
+from primitives import Triangle, Box, point
+from constants import Material, RED
+
+OBJ = '''# a square and a pentagon
+o shapes
+v 0 0 0
+v 1 0 0
+v 1 1 0 1.0
+v 0 1 0
+vt 0 0
+vn 0 0 1
+f 1/1/1 2/1/1 3/1/1 4/1/1
+v 0 0 1 0.5 0.5 0.5
+v 1 0 1
+v 2 .5 1
+v 1 1 1
+v 0 1 1
+usemtl something
+f -5 -4 -3 -2 -1
+f 1//1 3//1 4//1
+'''
+
+
+@pytest.fixture
+def obj_path(tmp_path):
+    path = tmp_path / 'shapes.obj'
+    path.write_text(OBJ)
+    return str(path)
+
+
+@pytest.mark.unittest
+def test_read_obj(obj_path):
+    vertices, faces = read_obj(obj_path)
+
+    assert vertices.shape == (9, 3)
+    assert (vertices[2] == [1, 1, 0]).all() and (vertices[4] == [0, 0, 1]).all()
+    # polygons are fanned out from their first corner, negative indices count back from the last vertex so far
+    assert faces.tolist() == [[0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7], [4, 7, 8], [0, 2, 3]]
+
+
+@pytest.mark.unittest
+def test_read_obj_chunks(obj_path):
+    vertices, faces = read_obj(obj_path)
+    for chunk_bytes in (1, 20, 100):
+        chunk_vertices, chunk_faces = read_obj(obj_path, chunk_bytes)
+        assert (chunk_vertices == vertices).all() and (chunk_faces == faces).all()
+
+
+@pytest.mark.unittest
+def test_read_obj_bad_index(tmp_path):
+    path = tmp_path / 'bad.obj'
+    path.write_text('v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 4\n')
+    with pytest.raises(ValueError):
+        read_obj(str(path))
+
+
+@pytest.mark.unittest
+def test_load_obj(obj_path, tmp_path, monkeypatch):
+    # nothing is cached unless asked for
+    monkeypatch.chdir(tmp_path)
+    mesh = load_obj(obj_path, material=Material.SPECULAR.value, color=RED)
+
+    assert os.listdir(str(tmp_path)) == ['shapes.obj']
+    assert not isinstance(load_obj(obj_path, material=Material.SPECULAR.value, color=RED).vertices.base, np.memmap)
+    assert len(mesh) == 6
+    assert mesh.triangle_vertices().shape == (6, 3, 3)
+    assert np.allclose(mesh.colors, RED) and (mesh.materials == Material.SPECULAR.value).all()
+    assert not mesh.emitters.any()
+
+
+@pytest.mark.unittest
+def test_mesh_in_scene(obj_path):
+    # a mesh mixed into a list of triangles gives the same tree as the same triangles made one by one
+    mesh = load_obj(obj_path)
+    box = triangles_for_box(Box(point(-10, -3, -10), point(10, 17, 10)))
+    triangles = [Triangle(*vertices) for vertices in mesh.triangle_vertices()]
+
+    expected = BoundingVolumeHierarchy(box + triangles, max_members=2)
+    hierarchy = BoundingVolumeHierarchy(box + [mesh], max_members=2)
+    assert (hierarchy.vertices == expected.vertices).all()
+    assert (hierarchy.emitters == expected.emitters).all()
+    assert (hierarchy.flat.bounds == expected.flat.bounds).all()
+    assert hierarchy.flat.light_sampler.area == expected.flat.light_sampler.area
+    assert BoundingVolumeHierarchy(mesh).flat.triangles.count() == 6
+
+
+@pytest.mark.unittest
+def test_mesh_cache(obj_path, tmp_path):
+    cache_dir = str(tmp_path / 'meshes')
+    mesh = load_obj(obj_path, color=RED, cache_dir=cache_dir)
+    files = os.listdir(cache_dir)
+    assert len(files) == 1
+
+    cached = load_obj(obj_path, color=RED, cache_dir=cache_dir)
+    assert isinstance(cached.vertices.base, np.memmap)
+    for name in ('vertices', 'faces', 'colors', 'materials', 'emitters'):
+        assert (getattr(cached, name) == getattr(mesh, name)).all()
+    _, meta = load_mesh(os.path.join(cache_dir, files[0]))
+    assert meta['bounds'] == [[0, 0, 0], [2, 1, 1]]
+    assert meta['content_hash']
+
+    # other loading parameters get their own file
+    load_obj(obj_path, color=RED, emitter=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+@pytest.mark.unittest
+def test_mesh_cache_stale(obj_path, tmp_path):
+    cache_dir = str(tmp_path / 'meshes')
+    load_obj(obj_path, cache_dir=cache_dir)
+    # touching the model without changing it keeps the cache
+    os.utime(obj_path, ns=(0, 0))
+    assert isinstance(load_obj(obj_path, cache_dir=cache_dir).vertices.base, np.memmap)
+
+    with open(obj_path, 'a') as f:
+        f.write('f 1 2 5\n')
+    mesh = load_obj(obj_path, cache_dir=cache_dir)
+    assert len(mesh) == 7 and not isinstance(mesh.vertices.base, np.memmap)
+    assert len(load_obj(obj_path, cache_dir=cache_dir)) == 7
+
+    path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(path, 'wb') as f:
+        f.write(b'garbage')
+    assert len(load_obj(obj_path, cache_dir=cache_dir)) == 7
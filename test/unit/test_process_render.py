@@ -0,0 +1,60 @@
+import pytest
+import numpy as np
+from bvh import BoundingVolumeHierarchy
+from camera import Camera
+from bidirectional import bidirectional_screen_sample
+from process_render import ProcessRenderer, SharedArray
+from unidirectional import unidirectional_screen_sample
+from primitives import point
+from utils import seed_random
+
+
+def small_camera(width=40, height=23):
+    return Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=width, pixel_height=height,
+                  phys_width=width / height)
+
+
+@pytest.mark.unittest
+def test_shared_array():
+    shared = SharedArray((2, 3), np.int64)
+    attached = SharedArray(*shared.spec())
+    attached.array[1, 2] = 5
+
+    assert shared.array[1, 2] == 5 and shared.array.sum() == 5
+    attached.close()
+    shared.close(unlink=True)
+
+
+@pytest.mark.unittest
+def test_process_renderer(box_triangles):
+    # rendering with threads first starts numba's thread pool, which forked workers would deadlock on
+    expected = small_camera()
+    seed_random(3)
+    bidirectional_screen_sample(expected, BoundingVolumeHierarchy(box_triangles).flat)
+    bidirectional_screen_sample(expected, BoundingVolumeHierarchy(box_triangles).flat)
+
+    camera = small_camera()
+    seed_random(3)
+    with ProcessRenderer(camera, box_triangles, processes=2) as renderer:
+        renderer.sample()
+        renderer.sample()
+        assert np.shares_memory(camera.image, renderer.shared['image'].array)
+
+    # tiles are seeded the same wherever they are rendered, so splitting them between workers changes nothing
+    assert camera.samples == 2
+    assert (camera.sample_counts == expected.sample_counts).all() and camera.sample_counts.sum() > 0
+    assert np.allclose(camera.image, expected.image, equal_nan=True)
+    assert np.allclose(camera.images, expected.images, equal_nan=True)
+    assert (np.nan_to_num(camera.image) > 0).any()
+    # the images outlive the shared memory
+    camera.image += 1
+
+
+@pytest.mark.unittest
+def test_process_renderer_unidirectional(box_triangles):
+    camera = small_camera(20, 10)
+    with ProcessRenderer(camera, box_triangles, unidirectional_screen_sample, processes=1) as renderer:
+        renderer.sample(3)
+
+    assert camera.samples == 3 and (camera.sample_counts == 3).all()
+    assert camera.image.sum() > 0
@@ -0,0 +1,177 @@
+import pytest
+import numpy as np
+from bvh import BoundingVolumeHierarchy
+from camera import Camera
+from bidirectional import bidirectional_screen_sample, bidirectional_buffers, extend_subpath, start_camera_subpath, \
+    start_light_subpath, connection_sample, trace_light_cache, LightCacheRenderer
+from primitives import VertexArrays
+from unidirectional import unidirectional_screen_sample
+from primitives import point
+from routines import geometry
+from utils import seed_random
+from constants import TILE_SIZE, MAX_BOUNCES, Direction, Material
+
+
+def small_camera(width=40, height=23):
+    return Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=width, pixel_height=height,
+                  phys_width=width / height)
+
+
+@pytest.mark.unittest
+def test_tiles_cover_screen():
+    camera = small_camera()
+    covered = np.zeros((camera.pixel_height, camera.pixel_width), dtype=np.int64)
+    for tile in range(camera.tile_count()):
+        i_start, i_end, j_start, j_end = camera.tile(tile)
+        assert 0 < i_end - i_start <= TILE_SIZE and 0 < j_end - j_start <= TILE_SIZE
+        covered[i_start:i_end, j_start:j_end] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.unittest
+def test_bidirectional_screen_sample(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    images = []
+    for _ in range(2):
+        seed_random(3)
+        camera = small_camera()
+        bidirectional_screen_sample(camera, bvh)
+        images.append(np.nan_to_num(camera.image))
+        assert camera.samples == 1
+        # each pixel adds at most one sample to each (s, t) image, so the counts gathered from the tiles add up
+        for s in range(len(camera.images)):
+            for t in range(len(camera.images[s])):
+                assert (camera.images[s][t] > 0).any(axis=-1).sum() == camera.sample_counts[s][t]
+    assert camera.sample_counts.sum() > 0
+    # tiles seed their own random numbers, so a seeded render is repeatable
+    assert (images[0] == images[1]).all()
+    # the image gets exactly the samples that went into the (s, t) images
+    assert np.allclose(camera.image, camera.images.sum(axis=(0, 1)))
+
+
+@pytest.mark.unittest
+def test_extend_subpath(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    camera = small_camera()
+    vertices, _, _, _, stack = bidirectional_buffers(bvh)
+    seed_random(4)
+    for _ in range(20):
+        start_camera_subpath(vertices, camera, 10, 10)
+        extend_subpath(vertices, bvh, Direction.FROM_CAMERA.value, MAX_BOUNCES, stack)
+
+        # the box is closed, so every bounce hits one of its walls or the light, which ends the subpath
+        assert vertices.size == MAX_BOUNCES + 1 or vertices.hit_light[vertices.size - 1]
+        assert not vertices.hit_light[:vertices.size - 1].any()
+        for k in range(1, vertices.size):
+            on_wall = np.isclose(np.abs(vertices.origins[k] - [0, 7, 0]), 10).any()
+            assert on_wall or np.isclose(vertices.origins[k][1], 17 * .95)
+            assert vertices.materials[k] == Material.DIFFUSE.value
+            G = geometry(vertices.origins[k - 1], vertices.normals[k - 1], vertices.origins[k], vertices.normals[k])
+            assert np.isclose(vertices.G[k], G)
+            # the two halves of the light are as bright and as big, so they're as likely to be picked
+            if vertices.hit_light[k]:
+                assert 0 <= vertices.light_ids[k] < len(bvh.lights)
+                assert np.isclose(bvh.light_sampler.pdf(vertices.light_ids[k]), 1 / (len(bvh.lights) * 50))
+        # nothing weighs against the first hit, since there are no connections to the lens
+        assert vertices.dVCM[1] == 0 and vertices.dVC[1] == 0
+        # a diffuse bounce from the camera is cosine weighted, going back towards the camera it would be uniform,
+        # and cosine weighting leaves only the surface's color in the throughput
+        for k in range(1, vertices.size - 1):
+            cos = np.dot(vertices.directions[k], vertices.normals[k])
+            assert np.isclose(vertices.pdf_forward[k], cos / np.pi)
+            assert np.isclose(vertices.pdf_reverse[k], 1 / (2 * np.pi))
+            assert np.allclose(vertices.throughputs[k + 1], vertices.throughputs[k] * vertices.local_colors[k])
+            # the sums only depend on the vertex before
+            distance = np.linalg.norm(vertices.origins[k + 1] - vertices.origins[k])
+            cos_in = np.abs(np.dot(vertices.normals[k + 1], vertices.directions[k]))
+            assert np.isclose(vertices.dVCM[k + 1], distance ** 2 / (vertices.pdf_forward[k] * cos_in))
+            dVC = cos * (vertices.dVC[k] * vertices.pdf_reverse[k] + vertices.dVCM[k]) / vertices.pdf_forward[k]
+            assert np.isclose(vertices.dVC[k + 1], dVC / cos_in)
+
+
+@pytest.mark.unittest
+def test_no_connections_to_lights(box_triangles):
+    # lights absorb, so a light subpath that lands on one ends there and is never joined to the camera
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    camera = small_camera()
+    camera_vertices, light_vertices, sample, _, stack = bidirectional_buffers(bvh)
+    seed_random(5)
+    start_camera_subpath(camera_vertices, camera, 20, 10)
+    extend_subpath(camera_vertices, bvh, Direction.FROM_CAMERA.value, 2, stack)
+    assert camera_vertices.size == 3 and not camera_vertices.hit_light.any()
+    landed = 0
+    for _ in range(200):
+        start_light_subpath(light_vertices, *bvh.light_sampler.sample())
+        extend_subpath(light_vertices, bvh, Direction.FROM_EMITTER.value, MAX_BOUNCES - 2, stack)
+        for l in np.nonzero(light_vertices.hit_light[:light_vertices.size])[0]:
+            landed += 1
+            assert not any(connection_sample(camera_vertices, c, light_vertices, l, sample) for c in (1, 2))
+    assert landed > 0
+
+
+@pytest.mark.unittest
+@pytest.mark.parametrize('light_tree', [False, True])
+def test_bidirectional_matches_unidirectional(box_triangles, light_tree):
+    # with MIS weights the strategies share each path between them, so the sum of the (s, t) images is an unbiased
+    # estimate of the same image unidirectional renders, whichever way lights are picked
+    bvh = BoundingVolumeHierarchy(box_triangles, light_tree=light_tree).flat
+    seed_random(6)
+    expected = small_camera(24, 16)
+    unidirectional_screen_sample(expected, bvh, 256)
+    camera = small_camera(24, 16)
+    for _ in range(64):
+        bidirectional_screen_sample(camera, bvh)
+    assert np.allclose(camera.image.mean(axis=(0, 1)) / camera.samples,
+                       expected.image.mean(axis=(0, 1)) / expected.samples, rtol=.1)
+    # light bounced off the walls reaches the camera by every strategy
+    assert (camera.images.sum(axis=(2, 3, 4)) > 0).sum() > 6
+
+
+@pytest.mark.unittest
+def test_trace_light_cache(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    cache = VertexArrays(100 * (MAX_BOUNCES - 1))
+    seed_random(7)
+    trace_light_cache(cache, bvh, 100)
+
+    # the vertices of each subpath are packed together in order, each starting on the light
+    lengths = cache.lengths[:cache.size]
+    assert (lengths[0] == 1) and ((lengths[1:] == 1) | (lengths[1:] == lengths[:-1] + 1)).all()
+    assert (lengths == 1).sum() == 100
+    assert np.isclose(cache.origins[:cache.size][lengths == 1][:, 1], 17 * .95).all()
+    assert (lengths <= MAX_BOUNCES - 1).all()
+    # subpaths that landed on a light keep the vertices before it
+    assert not cache.hit_light[:cache.size].any()
+    # a vertex's incident direction points back along the subpath
+    for k in np.nonzero(lengths > 1)[0]:
+        assert np.allclose(cache.incidents[k], -cache.directions[k - 1])
+        assert np.allclose(cache.origins[k - 1], cache.origins[k] + cache.incidents[k] * np.linalg.norm(
+            cache.origins[k - 1] - cache.origins[k]))
+
+
+@pytest.mark.unittest
+def test_light_cache_renderer(box_triangles):
+    # picking the light vertices from a cache changes how the strategies are sampled, not what they estimate
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    seed_random(6)
+    expected = small_camera(24, 16)
+    unidirectional_screen_sample(expected, bvh, 256)
+    camera = small_camera(24, 16)
+    renderer = LightCacheRenderer(camera, bvh, connections=2)
+    for _ in range(64):
+        renderer.sample()
+    assert renderer.paths == 24 * 16 and camera.samples == 64
+    assert np.allclose(camera.image.mean(axis=(0, 1)) / camera.samples,
+                       expected.image.mean(axis=(0, 1)) / expected.samples, rtol=.1)
+    assert np.allclose(camera.image, camera.images.sum(axis=(0, 1)))
+
+
+@pytest.mark.unittest
+def test_unidirectional_screen_sample(box_triangles):
+    bvh = BoundingVolumeHierarchy(box_triangles).flat
+    camera = small_camera()
+    unidirectional_screen_sample(camera, bvh, 2)
+
+    assert camera.samples == 2 and (camera.sample_counts == 2).all()
+    # the camera is inside a closed box, so every pixel sees something and some of them reach the light
+    assert (camera.image >= 0).all() and camera.image.sum() > 0
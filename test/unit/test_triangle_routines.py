@@ -1,5 +1,6 @@
 from routines import unit
-from collision import ray_triangle_intersect
+from collision import ray_triangle_intersect, intersect_leaf
+from primitives import TriangleArrays
 import pytest
 import numpy as np
 
@@ -64,3 +65,45 @@ def test_sample_surface(basic_triangle):
     angle_sum += np.arccos(np.dot(pv2, pv0))
     
     assert np.isclose(angle_sum, 2 * np.pi)
+
+
+@pytest.mark.unittest
+def test_triangle_arrays(basic_triangle, wrong_handed_triangle, big_triangle):
+    triangles = [basic_triangle, wrong_handed_triangle, big_triangle]
+    arrays = TriangleArrays(np.array([(t.v0, t.v1, t.v2) for t in triangles]), np.array([t.color for t in triangles]),
+                            np.array([t.material for t in triangles]), np.array([t.emitter for t in triangles]))
+
+    assert arrays.count() == 3
+    for k, triangle in enumerate(triangles):
+        assert (arrays.normals[k] == triangle.normal).all()
+        assert (arrays.e1[k] == triangle.e1).all()
+        assert (arrays.e2[k] == triangle.e2).all()
+        assert np.isclose(arrays.surface_areas[k], triangle.surface_area)
+    assert np.isclose(arrays.surface_areas[0], .5)
+    assert np.isclose(arrays.surface_areas[2], 12.5)
+
+    p = arrays.sample_surface(2)
+    assert p[0] >= 0 and p[1] >= 0 and p[0] + p[1] <= 5
+    assert p[2] == 0
+
+
+@pytest.mark.unittest
+def test_leaf_kernel(basic_triangle, wrong_handed_triangle, big_triangle, ray_that_hits, ray_that_misses):
+    triangles = [wrong_handed_triangle, big_triangle, basic_triangle]
+    arrays = TriangleArrays(np.array([(t.v0, t.v1, t.v2) for t in triangles]), np.array([t.color for t in triangles]),
+                            np.array([t.material for t in triangles]), np.array([t.emitter for t in triangles]))
+
+    hit, t = intersect_leaf(arrays, 0, 3, ray_that_hits.origin, ray_that_hits.direction, np.inf, False)
+    # both front-facing triangles are at the same distance, the first one found wins
+    assert hit == 1
+    assert t == 5.0
+
+    hit, t = intersect_leaf(arrays, 0, 1, ray_that_hits.origin, ray_that_hits.direction, np.inf, False)
+    assert hit == -1
+
+    hit, t = intersect_leaf(arrays, 0, 3, ray_that_hits.origin, ray_that_hits.direction, 4., False)
+    assert hit == -1
+    assert t == 4.
+
+    hit, t = intersect_leaf(arrays, 0, 3, ray_that_misses.origin, ray_that_misses.direction, np.inf, True)
+    assert hit == -1
@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+from bvh import BoundingVolumeHierarchy
+from camera import Camera
+from primitives import PathArrays, point
+from unidirectional import unidirectional_screen_sample
+from wavefront import WavefrontRenderer, compact_paths
+from utils import seed_random
+
+
+def small_camera(width=24, height=16):
+    return Camera(point(0, 2, 6), point(0, 0, -1), pixel_width=width, pixel_height=height,
+                  phys_width=width / height)
+
+
+@pytest.mark.unittest
+def test_compact_paths():
+    paths = PathArrays(5)
+    paths.size = 4
+    paths.alive[:4] = [False, True, False, True]
+    paths.pixels[:4] = [0, 1, 5, 2]
+    paths.radiance[:4] = [[1, 1, 1], [9, 9, 9], [2, 2, 2], [9, 9, 9]]
+    paths.bounces[:4] = [0, 1, 2, 3]
+    image = np.zeros((2, 3, 3))
+
+    assert compact_paths(paths, image) == 2
+    # live paths keep their order, dead ones leave their light in their pixel
+    assert paths.size == 2 and paths.pixels[:2].tolist() == [1, 2] and paths.bounces[:2].tolist() == [1, 3]
+    assert image[0, 0].tolist() == [1, 1, 1] and image[1, 2].tolist() == [2, 2, 2]
+    assert image.sum() == 9
+
+
+@pytest.mark.unittest
+def test_wavefront_renderer(box_triangles):
+    hierarchy = BoundingVolumeHierarchy(box_triangles)
+    expected = small_camera()
+    seed_random(1)
+    unidirectional_screen_sample(expected, hierarchy.flat, 32)
+
+    for bvh in (hierarchy.flat, hierarchy.wide()):
+        seed_random(2)
+        camera = small_camera()
+        # fewer slots than samples in a pass, so paths have to be refilled as others finish
+        renderer = WavefrontRenderer(camera, bvh, size=100)
+        renderer.sample(16)
+        renderer.sample(16)
+        assert renderer.paths.size == 0
+        assert camera.samples == 32 and (camera.sample_counts == 32).all()
+        # the same estimator as unidirectional, so the same image up to noise
+        assert (camera.image >= 0).all()
+        assert np.isclose(camera.image.mean(), expected.image.mean(), rtol=.1)